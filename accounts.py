@@ -0,0 +1,117 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+from dotenv import load_dotenv
+from typing import Optional
+import threading
+import asyncio
+import json
+import os
+
+load_dotenv()
+
+# Registry of the ad accounts the process can run campaigns on. ACCOUNTS_FILE is a JSON list like
+#   [{"account_id": "act_123", "name": "Client A", "access_token_env": "CLIENT_A_TOKEN", "max_concurrency": 4}]
+# where the credentials are given directly (access_token, app_id, app_secret) or as the name of the environment
+# variable that holds them (access_token_env, app_id_env, app_secret_env). Without the file the registry is the
+# single account of META_AD_ACCOUNT_ID with the META_* credentials.
+
+ACCOUNTS_FILE = os.getenv("ACCOUNTS_FILE", "accounts.json")
+
+# campaigns run at the same time on one ad account, unless the account sets max_concurrency
+ACCOUNT_CONCURRENCY = int(os.getenv("ACCOUNT_CONCURRENCY", 4))
+
+# account of the graph run, tool call or batch row being executed in this context
+current_account = ContextVar("current_account", default=None)
+
+
+def _credential(entry: dict, name: str, default_env: str) -> Optional[str]:
+    if entry.get(name):
+        return entry[name]
+    return os.getenv(entry.get(f"{name}_env") or default_env)
+
+
+@lru_cache(maxsize=None)
+def load_accounts() -> dict:
+    """ the registered accounts by account id, with their resolved credentials."""
+
+    if os.path.exists(ACCOUNTS_FILE):
+        with open(ACCOUNTS_FILE, encoding="utf-8") as f:
+            entries = json.load(f)
+    else:
+        entries = [{"account_id": os.getenv("META_AD_ACCOUNT_ID")}]
+
+    accounts = {}
+    for entry in entries:
+        accounts[entry["account_id"]] = {
+            "account_id": entry["account_id"],
+            "name": entry.get("name", entry["account_id"]),
+            "access_token": _credential(entry, "access_token", "META_ACCESS_TOKEN"),
+            "app_id": _credential(entry, "app_id", "META_APP_ID"),
+            "app_secret": _credential(entry, "app_secret", "META_APP_SECRET"),
+            "max_concurrency": int(entry.get("max_concurrency", ACCOUNT_CONCURRENCY)),
+        }
+    return accounts
+
+
+def default_account_id() -> str:
+    return os.getenv("META_AD_ACCOUNT_ID") or next(iter(load_accounts()))
+
+
+def current_account_id() -> str:
+    return current_account.get() or default_account_id()
+
+
+def get_account(account_id: Optional[str] = None) -> dict:
+    """ the registry entry of the account (the current one by default). Accounts missing from the registry
+    use the credentials of the environment."""
+
+    account_id = account_id or current_account_id()
+    if account_id in (accounts := load_accounts()):
+        return accounts[account_id]
+    return {
+        "account_id": account_id,
+        "name": account_id,
+        "access_token": os.getenv("META_ACCESS_TOKEN"),
+        "app_id": os.getenv("META_APP_ID"),
+        "app_secret": os.getenv("META_APP_SECRET"),
+        "max_concurrency": ACCOUNT_CONCURRENCY,
+    }
+
+
+@contextmanager
+def use_account(account_id: Optional[str]):
+    """ runs the block on the given account, the tools and limiters pick it up from the context.
+    None keeps the current account."""
+
+    if not account_id:
+        yield
+        return
+    token = current_account.set(account_id)
+    try:
+        yield
+    finally:
+        current_account.reset(token)
+
+
+# bounds the campaigns running at the same time on every account
+slots = {}
+slots_lock = threading.Lock()
+
+
+def account_slot(account_id: str) -> threading.Semaphore:
+    with slots_lock:
+        if account_id not in slots:
+            slots[account_id] = threading.BoundedSemaphore(get_account(account_id)["max_concurrency"])
+        return slots[account_id]
+
+
+# the same bound for the campaigns running on an event loop (service.py)
+async_slots = {}
+
+
+def async_account_slot(account_id: str) -> asyncio.Semaphore:
+    with slots_lock:
+        if account_id not in async_slots:
+            async_slots[account_id] = asyncio.Semaphore(get_account(account_id)["max_concurrency"])
+        return async_slots[account_id]
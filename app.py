@@ -1,39 +1,56 @@
 from facebook_business.exceptions import FacebookRequestError
-from langchain_google_genai import ChatGoogleGenerativeAI
 from prompt import generate_campaign_prompt
-from graph import graph
+from graph import get_graph, get_pipeline
+from graph_utilities import stream_graph_events, collect_ids
+from langchain_core.messages import AIMessage
+from images import start_ad_image_generation, new_image_path, write_upload
+from variants import launch_variants, variants_summary
+from llm_cache import bypass_cache
+from checkpoints import checkpointed_run, run_key
+from accounts import load_accounts, use_account, current_account_id
+from cache import file_digest
+from targeting import targeting_spec, resolve_audience
+from tracing import span, summarize
+from rate_limiter import meta_error_kind
+from validation import validate_campaign, record, format_errors
 import streamlit as st
-import os, base64
+
+# stream a graph run into the output column and return the final answer of the agent
+def stream_run(runnable, inputs: dict, run_id: str) -> str:
+    status = progress_area.status("Generating campaign...", expanded=True)
+    llm_text = progress_area.empty()
+    text, answer, elapsed = "", "", 0.0
+
+    # a failed run of the same inputs is resumed from its last checkpoint instead of starting over
+    with checkpointed_run(runnable, inputs, run_id) as (inputs, config):
+        for event in stream_graph_events(runnable, inputs, config):
+            if event["type"] == "token":
+                text += event["text"]
+                llm_text.markdown(text)
+                continue
+
+            update, elapsed = event["update"], event["elapsed"]
+            messages = update.get("messages") or []
+            ids = {**collect_ids(messages), **(update.get("results") or {})}
+            details = ", ".join(f"{key}: `{value}`" for key, value in ids.items())
+            if errors := update.get("errors"):
+                details += " failed: " + "; ".join(errors)
+            status.write(f"**{event['node']}** done at {elapsed:.1f}s {details}")
+
+            for message in messages:
+                if isinstance(message, AIMessage) and message.content and not message.tool_calls:
+                    answer = message.content
+
+    status.update(label=f"Finished in {elapsed:.1f}s", state="complete", expanded=False)
+    return answer
+
 
 # function to execute the user input and create campaign
 def generate(brand_name, product_name, campaign_goal, daily_budget, start_date, end_date, page_id, brand_description,
              landing_page, call_to_action, image, tone, image_style_prompt, age_min, age_max, gender,
-            interests):
-
-    if image:
-        image_path = os.path.join("./Images", image.name)
-        with open(image_path, "wb") as f:
-            f.write(image.read())
-    else:
-        image_llm = ChatGoogleGenerativeAI(model="models/gemini-2.0-flash-exp-image-generation")
-        message = {
-            "role": "user",
-            "content": image_style_prompt,
-        }
-
-        response = image_llm.invoke(
-            [message],
-            generation_config=dict(response_modalities=["TEXT", "IMAGE"]),
-        )
-
-        # Obtain image in base64 format from the LLM response
-        image_base64 = response.content[1].get("image_url").get("url").split(",")[-1]
-        with open(os.path.join("./Images", "ad_image.png"), "wb") as f:
-            f.write(base64.b64decode(image_base64))
-        image_path = os.path.join("./Images", "ad_image.png")
-
-    
-    prompt = generate_campaign_prompt(
+            interests, country="", fast_path=True, copy_variants=1, image_variants=1, bypass=False, account_id=None):
+
+    inputs = dict(
         brand_name=brand_name,
         product_name=product_name,
         campaign_goal=campaign_goal,
@@ -44,23 +61,75 @@ def generate(brand_name, product_name, campaign_goal, daily_budget, start_date,
         brand_description=brand_description,
         landing_page=landing_page,
         call_to_action=call_to_action,
-        image_path=image_path,
+        image_path="",
         age_min=age_min,
         age_max=age_max,
         tone=tone,
         gender=gender,
-        interests=interests
+        interests=interests,
+        country=country,
     )
-
-    # Invoke the graph with user prompt
-    try:
-        response = graph.invoke({"messages": [{"role": "user", "content": prompt}]})
-
-    except FacebookRequestError as e:
-        response = f"### Provide valid access credentials! \nDetails: {e}"
-
-    # Store the response in session state for later access
-    st.session_state.generated_response = response
+    # invalid details are reported right away, before any image generation, llm call or api request
+    errors = validate_campaign({**inputs, "image_style_prompt": image_style_prompt}, upload=bool(image))
+    if image and image_variants > 1:
+        errors.append("image variants are generated from the image style, set Image Variants to 1 to use the upload")
+    if errors:
+        record(rejected_campaigns=1)
+        st.session_state.generated_response = f"### Fix the campaign details: \n{format_errors(errors)}"
+        return
+
+    # replays of the same inputs are served from the llm response cache unless bypassed,
+    # every node, llm call and tool of the run is timed under the `generate` span
+    with bypass_cache(bypass), use_account(account_id), \
+            span("generate", fast_path=fast_path, variants=copy_variants * image_variants) as run:
+        if image:
+            image_path = write_upload(image, new_image_path(image.name))
+        elif copy_variants * image_variants > 1:
+            # the image variants are generated concurrently by the multi-variant launch
+            image_path = ""
+        else:
+            # generation runs in the background, the image upload waits for it while the campaign gets created
+            image_path = new_image_path("ad_image.png")
+            start_ad_image_generation(image_style_prompt, image_path)
+
+        inputs["image_path"] = image_path
+        # the audience terms the index doesn't know yet are searched while the image is generated,
+        # the interests meta has no match for are left out of the targeting and listed with the result
+        unresolved = resolve_audience(inputs)
+
+        # submitting the same inputs again after a failure resumes the failed run,
+        # the image is identified by its content or prompt rather than its (unique) path
+        account = current_account_id()
+        run_id = run_key({**inputs, "image_path": ""}, image_style_prompt, file_digest(image_path) if image else "", fast_path, account)
+
+        # Invoke the graph with user prompt
+        try:
+            if copy_variants * image_variants > 1:
+                # one campaign and ad set with an ad for every copy x image combination
+                result = launch_variants(inputs, copy_variants, image_variants, "" if image else image_style_prompt)
+                response = variants_summary(result)
+            elif fast_path:
+                # single planner llm call followed by direct tool execution, falls back to the agentic graph
+                response = stream_run(get_pipeline(), {"inputs": inputs, "messages": [], "account": account}, run_id)
+            else:
+                prompt = generate_campaign_prompt(**inputs, targeting=targeting_spec(inputs))
+                payload = {"messages": [{"role": "user", "content": prompt}], "account": account}
+                response = stream_run(get_graph(), payload, run_id)
+
+        except FacebookRequestError as e:
+            if meta_error_kind(e) == "throttle":
+                # still throttled after the retries of the scheduler
+                response = f"### Meta is throttling this ad account, try again in a few minutes. \nDetails: {e}"
+            else:
+                response = f"### Provide valid access credentials! \nDetails: {e}"
+
+        if unresolved:
+            response += f"\n\n**Interests not found on Meta, left out of the targeting:** {', '.join(unresolved)}"
+
+        # Store the response in session state for later access
+        st.session_state.generated_response = response
+
+    st.session_state.last_trace = summarize(run.trace_id)
 
 
 # Streamlit app ui:
@@ -69,6 +138,11 @@ st.set_page_config(layout="wide")
 
 left_col, right_col = st.columns([0.55,0.45],border=True)
 
+with right_col:
+    st.subheader("Agent Output", divider="gray")
+    # node by node progress of the running campaign is streamed here
+    progress_area = st.container()
+
 with left_col:
     st.subheader("Campaign Summary:", divider="gray")
     with st.form("Generate Form"):
@@ -80,6 +154,8 @@ with left_col:
             page_id = st.text_input("Page Id")
 
         with st.expander("2. Campaign Strategy"):
+            accounts = load_accounts()
+            account_id = st.selectbox("Ad Account", list(accounts), format_func=lambda a: accounts[a]["name"])
             campaign_goal = st.selectbox("Campaign Objective", ["Awareness", "Traffic", "Conversions"])
             platform = st.selectbox("Ad Platform", ["Meta", "Google"])
             start_date = st.date_input("Start Date")
@@ -97,23 +173,30 @@ with left_col:
 
         with st.expander("4. Ad Tone & Style"):
             tone = st.selectbox("Tone of Ad", ["Professional", "Witty", "Emotional", "Sarcastic"])
-            image_style_prompt = st.text_input("Image Style (optional)", placeholder="e.g., Minimalist, Vibrant, 3D")
+            image_style_prompt = st.text_input("Image Style (when no image is uploaded)", placeholder="e.g., Minimalist, Vibrant, 3D")
+            copy_variants = st.number_input("Ad Copy Variants", min_value=1, max_value=10, value=1, step=1)
+            image_variants = st.number_input("Image Variants", min_value=1, max_value=5, value=1, step=1)
         
         image = st.file_uploader("Upload Image:")
+        fast_path = st.checkbox("Fast path (plan once, then run the tools directly)", value=True)
+        bypass = st.checkbox("Bypass response cache (always call the LLMs)", value=False)
 
         submitted = st.form_submit_button("Generate Campaign")
         if submitted:
             generate(brand_name, product_name, campaign_goal, daily_budget, start_date, end_date, page_id, brand_description,
                 landing_page, call_to_action, image, tone, image_style_prompt, age_min, age_max, gender,
-                interests)
+                interests, country, fast_path, copy_variants, image_variants, bypass, account_id)
              
 with right_col:
-    st.subheader("Agent Output", divider="gray")
-
     if "generated_response" not in st.session_state:
         st.session_state.generated_response = ""
 
     st.markdown(st.session_state.generated_response)
 
+    # where the time of the last run went: durations, token usage, payload sizes and retries per span
+    if st.session_state.get("last_trace"):
+        with st.expander("Last run timings"):
+            st.dataframe(st.session_state.last_trace, hide_index=True)
+
 
 
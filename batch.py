@@ -0,0 +1,196 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from prompt import generate_campaign_prompt
+from graph_utilities import collect_ids
+from graph import get_graph, get_pipeline
+from images import start_ad_image_generation, IMAGES_DIR
+from rate_limiter import limiters
+from cache import image_cache
+from clients import get_search_tool
+from tracing import span
+from validation import validate_campaign, record, validation_stats
+from targeting import targeting_spec, prefetch as prefetch_targeting
+from checkpoints import checkpointed_run, acheckpointed_run, run_key
+from accounts import load_accounts, get_account, default_account_id, current_account_id, use_account, account_slot, \
+    async_account_slot
+import itertools
+import hashlib
+import argparse
+import inspect
+import json
+import csv
+import os
+
+# the fields of a batch row are the arguments of the campaign prompt
+CAMPAIGN_FIELDS = [name for name in inspect.signature(generate_campaign_prompt).parameters if name != "targeting"]
+
+
+def read_rows(input_path: str) -> list:
+    """ reads the campaign rows of a JSONL or CSV file. Rows without a `row_id` are keyed by their line number."""
+
+    with open(input_path, newline="", encoding="utf-8") as f:
+        if input_path.endswith(".csv"):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+    for number, row in enumerate(rows, start=1):
+        row["row_id"] = str(row.get("row_id") or number)
+    return rows
+
+
+def completed_rows(output_path: str) -> tuple:
+    """ row ids that already succeeded in a previous run of the same output file, and the account every
+    row of the file ran on, so a failed row is resumed on the same account."""
+
+    done, accounts = set(), {}
+    if not os.path.exists(output_path):
+        return done, accounts
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # a crash can leave a partially written last line
+                continue
+            if record.get("status") == "ok":
+                done.add(str(record["row_id"]))
+            if record.get("account_id"):
+                accounts[str(record["row_id"])] = record["account_id"]
+    return done, accounts
+
+
+def row_payload(row: dict, fast_path: bool, account: str) -> tuple:
+    """ the run key of the row and the input of the pipeline (fast path) or the agentic graph.
+    Starts generating the image of a row without one."""
+
+    inputs = {field: row.get(field, "") for field in CAMPAIGN_FIELDS}
+    # an invalid row fails here, before its image is generated or any llm or api call is made
+    if errors := validate_campaign({**inputs, "image_style_prompt": row.get("image_style_prompt", "")}):
+        record(rejected_campaigns=1)
+        raise ValueError("invalid campaign: " + "; ".join(errors))
+    # a row that failed before resumes from its last checkpoint and reuses the objects it created. The row id
+    # (the job id in the service) keeps identical rows or jobs from sharing, and racing on, one thread
+    key = run_key(inputs, row.get("image_style_prompt", ""), fast_path, account, row["row_id"])
+    if not inputs["image_path"]:
+        # named after the run, so rows of concurrent batches never write to the same file
+        inputs["image_path"] = os.path.join(IMAGES_DIR, f"batch_{key[:16]}.png")
+        start_ad_image_generation(row.get("image_style_prompt", ""), inputs["image_path"])
+
+    if fast_path:
+        return key, {"inputs": inputs, "messages": [], "account": account}
+    prompt = generate_campaign_prompt(**inputs, targeting=targeting_spec(inputs))
+    return key, {"messages": [{"role": "user", "content": prompt}], "account": account}
+
+
+def row_result(response: dict, account: str) -> dict:
+    ids = {**response.get("results", {}), **collect_ids(response["messages"])}
+    if "ad_id" not in ids:
+        raise RuntimeError(f"run finished without an ad: {response['messages'][-1].content}")
+    return {"account_id": account, **ids}
+
+
+def run_row(row: dict, fast_path: bool = True, graph=None, pipeline=None) -> dict:
+    """ runs one campaign through the graph and returns the ids it created.
+    `graph` and `pipeline` default to the compiled graphs of the project."""
+
+    account = row.get("account_id") or current_account_id()
+    # at most max_concurrency campaigns of an account run at the same time
+    with span("run_row", row_id=row["row_id"], fast_path=fast_path, account=account), \
+            use_account(account), account_slot(account):
+        key, payload = row_payload(row, fast_path, account)
+        runnable = (pipeline or get_pipeline()) if fast_path else (graph or get_graph())
+        with checkpointed_run(runnable, payload, key) as (payload, config):
+            response = runnable.invoke(payload, config)
+        return row_result(response, account)
+
+
+async def arun_row(row: dict, graph, pipeline, fast_path: bool = True) -> dict:
+    """ `run_row` on the event loop with graphs compiled with an async checkpointer (see service.py)."""
+
+    account = row.get("account_id") or current_account_id()
+    with span("run_row", row_id=row["row_id"], fast_path=fast_path, account=account), use_account(account):
+        async with async_account_slot(account):
+            key, payload = row_payload(row, fast_path, account)
+            runnable = pipeline if fast_path else graph
+            async with acheckpointed_run(runnable, payload, key) as (payload, config):
+                response = await runnable.ainvoke(payload, config)
+            return row_result(response, account)
+
+
+def row_hash(row: dict) -> int:
+    return int(hashlib.sha256(str(row["row_id"]).encode()).hexdigest()[:16], 16)
+
+
+def shard_rows(rows: list, assign: bool = False) -> list:
+    """ groups the rows by their `account_id` and interleaves the groups, so the workers are spread over all
+    the accounts instead of queueing on the limits of one. With `assign`, rows without an account are spread
+    over the registered accounts by a hash of their row id, so a row lands on the same account in every run
+    (its run key, checkpoints and idempotency keys include the account). Otherwise they go to the default
+    account."""
+
+    accounts = sorted(load_accounts()) if assign else []
+    groups = {account_id: [] for account_id in accounts}
+    for row in rows:
+        if not row.get("account_id"):
+            row["account_id"] = accounts[row_hash(row) % len(accounts)] if assign else default_account_id()
+        groups.setdefault(row["account_id"], []).append(row)
+    return [row for group in itertools.zip_longest(*groups.values()) for row in group if row is not None]
+
+
+def run_batch(input_path: str, output_path: str, workers: int = None, fast_path: bool = True,
+              shard: bool = False) -> None:
+    """ runs every row of the input file that hasn't succeeded yet and appends one result line per row
+    to the output file as soon as it finishes. `workers` defaults to the sum of the concurrency limits
+    of the accounts of the rows."""
+
+    done, assigned = completed_rows(output_path)
+    rows = [row for row in read_rows(input_path) if row["row_id"] not in done]
+    # failed rows keep the account of their first run, even if the registered accounts changed since
+    for row in rows:
+        row["account_id"] = row.get("account_id") or assigned.get(row["row_id"], "")
+    rows = shard_rows(rows, assign=shard)
+    accounts = {row["account_id"] for row in rows}
+    # the interests and countries of all the rows are searched up front in one go, the rows resolve them locally
+    prefetch_targeting(rows)
+    workers = workers or max(1, sum(get_account(account_id)["max_concurrency"] for account_id in accounts))
+    print(f"{len(done)} rows already completed, {len(rows)} rows to run on {len(accounts)} accounts")
+
+    with open(output_path, "a", encoding="utf-8") as out, ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_row, row, fast_path): row for row in rows}
+        for future in as_completed(futures):
+            row = futures[future]
+            try:
+                record = {"row_id": row["row_id"], "status": "ok", **future.result()}
+            except Exception as e:
+                record = {"row_id": row["row_id"], "status": "error", "account_id": row["account_id"],
+                          "error": f"{type(e).__name__}: {e}"}
+            # results are only written from this thread, flushed per row so a crash loses nothing
+            out.write(json.dumps(record) + "\n")
+            out.flush()
+            print(json.dumps(record))
+
+    print("image upload cache:", json.dumps(image_cache.stats()))
+    print("validation:", json.dumps(validation_stats))
+    # the search tool is only built when a row ran through the agentic graph
+    if get_search_tool.cache_info().currsize:
+        print("search cache:", json.dumps(get_search_tool().stats()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create Meta ad campaigns in bulk from a JSONL or CSV file.")
+    parser.add_argument("input", help="JSONL or CSV file with one campaign per row")
+    parser.add_argument("output", help="JSONL file the per-row results are appended to, rerun with the same file to resume")
+    parser.add_argument("--workers", type=int, help="number of campaigns run concurrently, "
+                        "defaults to the sum of max_concurrency of the accounts")
+    parser.add_argument("--gemini-rps", type=float, help="max Gemini requests per second across all workers")
+    parser.add_argument("--meta-rps", type=float, help="max Meta API requests per second across all workers")
+    parser.add_argument("--shard", action="store_true",
+                        help="spread the rows without an account_id over all accounts of ACCOUNTS_FILE")
+    parser.add_argument("--agentic", action="store_true", help="use the agentic tool loop instead of the fast-path pipeline")
+    args = parser.parse_args()
+
+    if args.gemini_rps:
+        limiters["gemini"].configure(args.gemini_rps)
+    if args.meta_rps:
+        limiters["meta"].configure(args.meta_rps)
+
+    run_batch(args.input, args.output, workers=args.workers, fast_path=not args.agentic, shard=args.shard)
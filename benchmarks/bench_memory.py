@@ -0,0 +1,148 @@
+"""Peak memory of the image handling of concurrent campaign runs.
+
+Every run writes an uploaded image to disk, decodes a generated image from its base64 data url and prepares
+it for upload. The "copy" mode uses the whole-buffer copies (`image.read()`, `split(",")` + `b64decode`) and
+no memory budget, the "streaming" mode the chunked writers of images.py under IMAGE_MEMORY_BUDGET. Each mode
+runs in its own process and reports the peak RSS above the baseline with the payloads already in memory.
+
+    python benchmarks/bench_memory.py --runs 8 --workers 8 --image-px 2400 --budget-mb 128
+"""
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+import subprocess
+import threading
+import tempfile
+import argparse
+import resource
+import base64
+import json
+import time
+import sys
+import io
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def rss() -> int:
+    """ resident set size of the process in bytes."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # no procfs (macos), ru_maxrss is the peak so far in bytes there
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class PeakSampler:
+    """Samples the rss in a background thread and keeps the highest value."""
+
+    def __init__(self, interval: float = 0.002) -> None:
+        self.interval = interval
+        self.peak = rss()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self) -> None:
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, rss())
+            time.sleep(self.interval)
+
+    def __enter__(self) -> "PeakSampler":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, rss())
+
+
+def copy_run(upload: io.BytesIO, data_url: str, workdir: str, index: int) -> None:
+    from images import prepare_image
+
+    upload_path = os.path.join(workdir, f"upload_{index}.png")
+    with open(upload_path, "wb") as f:
+        f.write(upload.read())
+    image_path = os.path.join(workdir, f"generated_{index}.png")
+    with open(image_path, "wb") as f:
+        f.write(base64.b64decode(data_url.split(",")[1]))
+    prepare_image(image_path)
+
+
+def streaming_run(upload: io.BytesIO, data_url: str, workdir: str, index: int) -> None:
+    from images import prepare_image, write_upload, write_base64
+
+    write_upload(upload, os.path.join(workdir, f"upload_{index}.png"))
+    image_path = os.path.join(workdir, f"generated_{index}.png")
+    write_base64(data_url, image_path)
+    prepare_image(image_path)
+
+
+def child(args) -> None:
+    """ runs the mode in this process and prints its measurements as json."""
+
+    # every run prepares its own image instead of hitting the derived file cache
+    os.environ["CACHE_DIR"] = os.path.join(args.workdir, f"cache_{args.child}")
+    os.environ["IMAGE_MEMORY_BUDGET"] = str(args.budget_mb << 20)
+    import images
+
+    if args.child == "copy":
+        images.image_memory.budget = float("inf")
+    # the upload buffers and response payloads exist before the runs in both modes
+    uploads, data_urls = [], []
+    for index in range(args.runs):
+        with open(os.path.join(args.workdir, f"source_{index}.png"), "rb") as f:
+            image_bytes = f.read()
+        uploads.append(io.BytesIO(image_bytes))
+        data_urls.append(f"data:image/png;base64,{base64.b64encode(image_bytes).decode()}")
+    del image_bytes
+
+    run = copy_run if args.child == "copy" else streaming_run
+    baseline = rss()
+    start = time.perf_counter()
+    with PeakSampler() as sampler, ThreadPoolExecutor(max_workers=args.workers) as executor:
+        list(executor.map(run, uploads, data_urls, [args.workdir] * args.runs, range(args.runs)))
+    print(json.dumps({
+        "baseline": baseline, "peak": sampler.peak, "seconds": time.perf_counter() - start,
+        "budget_peak": images.image_memory.peak if args.child == "streaming" else None,
+    }))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--image-px", type=int, default=2400, help="side of the square noise png")
+    parser.add_argument("--budget-mb", type=int, default=128, help="IMAGE_MEMORY_BUDGET of the streaming mode")
+    parser.add_argument("--child", choices=("copy", "streaming"), help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args)
+        sys.exit()
+
+    workdir = tempfile.mkdtemp(prefix="memory-bench-")
+    # distinct images, so the runs don't share a prepared file
+    for index in range(args.runs):
+        noise = os.urandom(args.image_px ** 2 * 3)
+        image = Image.frombytes("RGB", (args.image_px, args.image_px), noise)
+        image.save(os.path.join(workdir, f"source_{index}.png"))
+    image_mib = os.path.getsize(os.path.join(workdir, "source_0.png")) / 2 ** 20
+    print(f"images {image_mib:.1f} MiB, {args.runs} runs on {args.workers} workers")
+
+    print(f"{'mode':<12}{'peak MiB':>10}{'per run':>10}{'budget':>10}{'seconds':>10}")
+    for mode in ("copy", "streaming"):
+        output = subprocess.run(
+            [sys.executable, __file__, "--child", mode, "--workdir", workdir, "--runs", str(args.runs),
+             "--workers", str(args.workers), "--budget-mb", str(args.budget_mb)],
+            capture_output=True, text=True,
+        )
+        if output.returncode:
+            sys.exit(f"{mode} failed:\n{output.stderr}")
+        result = json.loads(output.stdout.splitlines()[-1])
+        extra = (result["peak"] - result["baseline"]) / 2 ** 20
+        budget = f"{result['budget_peak'] / 2 ** 20:.0f}" if result["budget_peak"] is not None else "-"
+        print(f"{mode:<12}{extra:>10.1f}{extra / args.runs:>10.1f}{budget:>10}{result['seconds']:>10.2f}")
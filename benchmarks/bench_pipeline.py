@@ -0,0 +1,143 @@
+"""End to end campaign benchmark against the offline Meta API and Gemini stand-ins.
+
+Reports p50/p95 latency, LLM turns, HTTP requests and bytes per campaign for the agentic graph and the
+fast-path pipeline, for single campaigns run one after another and for a concurrent batch.
+
+    python benchmarks/bench_pipeline.py --runs 20 --batch-rows 100 --workers 8 --llm-latency 0.8 --meta-latency 0.15
+"""
+from concurrent.futures import ThreadPoolExecutor
+from statistics import median
+from PIL import Image
+import tempfile
+import argparse
+import time
+import sys
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# isolated caches and dummy credentials, set before the project modules read them
+WORKDIR = tempfile.mkdtemp(prefix="campaign-bench-")
+os.environ.update({
+    "CACHE_DIR": os.path.join(WORKDIR, "cache"),
+    "LLM_CACHE_BYPASS": "1",
+    "GOOGLE_API_KEY": "benchmark",
+    "TAVILY_API_KEY": "benchmark",
+    "META_ACCESS_TOKEN": "benchmark",
+    "META_AD_ACCOUNT_ID": "act_1000",
+})
+
+from fakes import FakeGraphAPIAdapter, ScriptedChatModel
+from graph import build_graph, build_pipeline
+from tools import make_campaign, make_ad_set, make_ad_creative, make_ad, make_ad_image
+from clients import get_api
+from batch import run_row
+
+
+def percentile(values: list, pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def campaign_row(index: int, image_kb: int) -> dict:
+    image_path = os.path.join(WORKDIR, f"image_{index}.png")
+    # noise barely compresses, so the png is about image_kb large
+    side = max(1, int((image_kb * 1024 / 3) ** 0.5))
+    Image.frombytes("RGB", (side, side), os.urandom(side * side * 3)).save(image_path)
+    return {
+        "row_id": str(index), "brand_name": "Bench", "product_name": "Widget", "campaign_goal": "Traffic",
+        "daily_budget": "1000", "start_date": "2026-01-01", "end_date": "2026-01-31", "page_id": "12345",
+        "brand_description": "A benchmark brand", "landing_page": "https://example.com",
+        "call_to_action": "Shop Now", "image_path": image_path, "age_min": 18, "age_max": 45,
+        "tone": "Witty", "gender": "All", "interests": "tech, gadgets",
+    }
+
+
+class Counters:
+    """Snapshot of the llm and http counters, subtracting two snapshots gives the cost of the work in between."""
+
+    def __init__(self, llm: ScriptedChatModel, meta: FakeGraphAPIAdapter) -> None:
+        self.llm_turns = llm.turns
+        self.requests = meta.requests
+        self.bytes = meta.bytes_sent + meta.bytes_received
+
+    def __sub__(self, other: "Counters") -> dict:
+        return {"llm_turns": self.llm_turns - other.llm_turns, "requests": self.requests - other.requests,
+                "bytes": self.bytes - other.bytes}
+
+
+def report(name: str, latencies: list, costs: list, failures: int, wall: float = None) -> None:
+    n = len(latencies)
+    line = (f"{name:<28}{median(latencies) * 1000:>9.0f}{percentile(latencies, 95) * 1000:>9.0f}"
+            f"{sum(cost['llm_turns'] for cost in costs) / n:>8.2f}{sum(cost['requests'] for cost in costs) / n:>8.2f}"
+            f"{sum(cost['bytes'] for cost in costs) / n / 1024:>10.1f}{failures:>6}")
+    if wall is not None:
+        line += f"{n / wall:>10.2f}"
+    print(line)
+
+
+def run_single(name: str, runs: int, fast_path: bool, graph, pipeline, llm, meta, image_kb: int) -> None:
+    latencies, costs, failures = [], [], 0
+    for index in range(runs):
+        row = campaign_row(index, image_kb)
+        before, start = Counters(llm, meta), time.perf_counter()
+        try:
+            run_row(row, fast_path, graph=graph, pipeline=pipeline)
+        except Exception:
+            failures += 1
+        latencies.append(time.perf_counter() - start)
+        costs.append(Counters(llm, meta) - before)
+    report(name, latencies, costs, failures)
+
+
+def run_batch(name: str, rows: int, workers: int, fast_path: bool, graph, pipeline, llm, meta, image_kb: int) -> None:
+    batch_rows = [campaign_row(10 ** 6 + index, image_kb) for index in range(rows)]
+
+    def timed(row):
+        start = time.perf_counter()
+        try:
+            run_row(row, fast_path, graph=graph, pipeline=pipeline)
+            return time.perf_counter() - start, False
+        except Exception:
+            return time.perf_counter() - start, True
+
+    before, start = Counters(llm, meta), time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(timed, batch_rows))
+    wall = time.perf_counter() - start
+    total = Counters(llm, meta) - before
+    # only totals are known under concurrency, spread them evenly over the rows
+    costs = [{key: value / rows for key, value in total.items()}] * rows
+    report(name, [latency for latency, _ in results], costs, sum(failed for _, failed in results), wall)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10, help="single campaigns per mode")
+    parser.add_argument("--batch-rows", type=int, default=50, help="campaigns per batch run, 0 to skip")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--llm-latency", type=float, default=0.8, help="seconds per gemini call")
+    parser.add_argument("--meta-latency", type=float, default=0.15, help="seconds per meta http request")
+    parser.add_argument("--jitter", type=float, default=0.2, help="latency jitter as a fraction of the latency")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--meta-error-rate", type=float, default=0.0)
+    parser.add_argument("--meta-usage", type=float, help="ad account usage %% reported in the response headers")
+    parser.add_argument("--image-kb", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    llm = ScriptedChatModel(args.llm_latency, args.llm_latency * args.jitter, args.llm_error_rate, seed=args.seed)
+    meta = FakeGraphAPIAdapter(args.meta_latency, args.meta_latency * args.jitter, args.meta_error_rate,
+                               usage_pct=args.meta_usage, seed=args.seed).install(get_api())
+
+    tools = [make_campaign, make_ad_set, make_ad_creative, make_ad, make_ad_image]
+    graph = build_graph(llm=llm, tools=tools)
+    pipeline = build_pipeline(llm=llm, graph=graph)
+
+    print(f"{'mode':<28}{'p50 ms':>9}{'p95 ms':>9}{'turns':>8}{'reqs':>8}{'KiB':>10}{'fail':>6}{'rows/s':>10}")
+    for name, fast_path in (("agentic", False), ("fast path", True)):
+        run_single(f"{name} single", args.runs, fast_path, graph, pipeline, llm, meta, args.image_kb)
+        if args.batch_rows:
+            run_batch(f"{name} batch x{args.workers}", args.batch_rows, args.workers, fast_path,
+                      graph, pipeline, llm, meta, args.image_kb)
@@ -0,0 +1,64 @@
+"""Startup benchmark: import time of the project modules and the cost of building the graphs.
+
+Every import is measured in a fresh interpreter so module caching doesn't hide the cold start cost.
+Dummy keys are set so no prompt blocks and no request is sent.
+
+    python benchmarks/bench_startup.py --repeat 5
+"""
+from statistics import median
+import subprocess
+import argparse
+import sys
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENV = {
+    **os.environ,
+    "GOOGLE_API_KEY": os.getenv("GOOGLE_API_KEY", "benchmark"),
+    "TAVILY_API_KEY": os.getenv("TAVILY_API_KEY", "benchmark"),
+    "META_AD_ACCOUNT_ID": os.getenv("META_AD_ACCOUNT_ID", "act_0"),
+}
+
+CASES = {
+    "import prompt": "import prompt",
+    "import graph_utilities": "import graph_utilities",
+    "import tools": "import tools",
+    "import graph": "import graph",
+    "graph.get_graph() cold": "import graph; graph.get_graph()",
+    "graph.get_pipeline() cold": "import graph; graph.get_pipeline()",
+}
+
+TIMER = """
+import time
+start = time.perf_counter()
+{code}
+first = time.perf_counter() - start
+start = time.perf_counter()
+{code}
+print(first, time.perf_counter() - start)
+"""
+
+
+def measure(code: str) -> tuple:
+    """ seconds for the first run of the code in a fresh interpreter and for a rerun in the same process,
+    which is what a streamlit rerun pays."""
+
+    output = subprocess.run(
+        [sys.executable, "-c", TIMER.format(code=code)],
+        cwd=ROOT, env=ENV, capture_output=True, text=True, check=True,
+    ).stdout.split()
+    return float(output[0]), float(output[1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'case':<30}{'cold (ms)':>12}{'rerun (ms)':>12}")
+    for name, code in CASES.items():
+        runs = [measure(code) for _ in range(args.repeat)]
+        cold = median(run[0] for run in runs) * 1000
+        rerun = median(run[1] for run in runs) * 1000
+        print(f"{name:<30}{cold:>12.1f}{rerun:>12.3f}")
@@ -0,0 +1,367 @@
+"""Offline stand-ins for the Meta Marketing API and Gemini with configurable latency and error injection.
+
+`FakeGraphAPIAdapter` is a requests transport adapter mounted on the facebook_business session, so the real
+SDK code path (param encoding, batch requests, response parsing, errors) runs without network access.
+`ScriptedChatModel` replays the tool calls Gemini makes for the campaign prompt and answers structured output
+requests of the planners.
+"""
+from graph_utilities import CampaignPlan, VariantPlan, CopyVariant, collect_ids
+from langchain_core.messages import AIMessage, HumanMessage, convert_to_messages
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from requests import Response
+from urllib.parse import urlparse, parse_qsl, unquote_plus
+import threading
+import datetime
+import asyncio
+import itertools
+import hashlib
+import random
+import time
+import json
+import re
+
+RESULT_REF = re.compile(r"\{result=([\w-]+):\$\.(\w+)\}")
+
+# meta errors raised by the fake, (http status, error code, message)
+RATE_LIMIT_ERROR = (400, 17, "User request limit reached")
+TRANSIENT_ERROR = (500, 2, "Service temporarily unavailable")
+
+
+class Latency:
+    """Sleeps for `mean` seconds with a uniform jitter of +-`jitter` seconds."""
+
+    def __init__(self, mean: float = 0.0, jitter: float = 0.0, seed=None) -> None:
+        self.mean = mean
+        self.jitter = jitter
+        self.random = random.Random(seed)
+
+    def delay(self) -> float:
+        return max(0.0, self.mean + self.random.uniform(-self.jitter, self.jitter))
+
+    def sleep(self) -> None:
+        if delay := self.delay():
+            time.sleep(delay)
+
+    async def asleep(self) -> None:
+        if delay := self.delay():
+            await asyncio.sleep(delay)
+
+
+# transport adapter that answers graph api requests locally
+class FakeGraphAPIAdapter(BaseAdapter):
+    """Answers the Graph API calls made by the project (object creation, image upload, batch requests).
+    Every HTTP request sleeps for `latency` and fails with `error` with probability `error_rate`.
+    With `usage_pct` every response reports that share of the ad account quota as used in the x-ad-account-usage
+    header. Insights requests report `ads` ads with seeded daily metrics, as paged reads or async report jobs.
+    Counts requests, bytes sent and bytes received."""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 error=TRANSIENT_ERROR, usage_pct=None, seed=None, ads: int = 20) -> None:
+        super().__init__()
+        self.ads = ads
+        self.reports = {}
+        self.usage_pct = usage_pct
+        self.latency = Latency(latency, jitter, seed)
+        self.error_rate = error_rate
+        self.error = error
+        self.random = random.Random(seed)
+        self.ids = itertools.count(10 ** 12)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.calls = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def install(self, api) -> "FakeGraphAPIAdapter":
+        """ routes all the requests of a FacebookAdsApi instance to this adapter."""
+        api._session.requests.mount("https://", self)
+        return self
+
+    def stats(self) -> dict:
+        return {"requests": self.requests, "calls": self.calls,
+                "bytes_sent": self.bytes_sent, "bytes_received": self.bytes_received}
+
+    def send(self, request, **kwargs) -> Response:
+        body = request.body or b""
+        if isinstance(body, str):
+            body = body.encode()
+        with self.lock:
+            self.requests += 1
+            self.bytes_sent += len(body) + len(request.url)
+
+        self.latency.sleep()
+        if self.random.random() < self.error_rate:
+            status, payload = self.error_response(*self.error)
+        else:
+            status, payload = self.handle(request.method, request.url, body, request.headers.get("Content-Type", ""))
+
+        content = json.dumps(payload).encode()
+        with self.lock:
+            self.bytes_received += len(content)
+
+        response = Response()
+        response.status_code = status
+        response._content = content
+        response.headers = CaseInsensitiveDict({"Content-Type": "application/json"})
+        if self.usage_pct is not None:
+            response.headers["x-ad-account-usage"] = json.dumps({"acc_id_util_pct": self.usage_pct, "reset_time_duration": 60})
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        return response
+
+    @staticmethod
+    def error_response(status: int, code: int, message: str) -> tuple:
+        return status, {"error": {"message": message, "type": "OAuthException", "code": code,
+                                  "is_transient": status >= 500 or code in (4, 17, 613)}}
+
+    def handle(self, method: str, url: str, body: bytes, content_type: str) -> tuple:
+        path = [part for part in urlparse(url).path.split("/") if part]
+        # drop the api version
+        if path and re.fullmatch(r"v\d+\.\d+", path[0]):
+            path = path[1:]
+
+        if not path and method == "POST":
+            params = dict(parse_qsl(body.decode()))
+            return 200, self.handle_batch(json.loads(params["batch"]))
+
+        if path and path[-1] == "adimages":
+            digest = hashlib.md5(body).hexdigest()
+            with self.lock:
+                self.calls += 1
+            return 200, {"images": {"upload": {"hash": digest, "url": f"https://fake.cdn/{digest}.png"}}}
+
+        with self.lock:
+            self.calls += 1
+        params = dict(parse_qsl(urlparse(url).query if method == "GET" else body.decode(errors="ignore")))
+        if path and path[-1] == "insights":
+            if method == "POST":
+                # async report job, completed right away
+                report_id = str(next(self.ids))
+                with self.lock:
+                    self.reports[report_id] = {**params, "account": path[0]}
+                return 200, {"report_run_id": report_id}
+            params = {**self.reports.get(path[0], {"account": path[0]}), **params}
+            return 200, self.insights(params["account"], params)
+        if path and path[-1] == "adsets" and method == "GET":
+            return 200, self.adsets(path[0], params)
+        if method == "POST":
+            return 200, {"id": str(next(self.ids))}
+        return 200, {"id": path[-1] if path else "", "data": []}
+
+    def adsets(self, account: str, params: dict) -> dict:
+        """ one page of the ad sets of the insights ads, two ads per ad set, with seeded daily budgets."""
+        prefix = account.split("_")[-1]
+        start, limit = int(params.get("after") or 0), int(params.get("limit") or 25)
+        end = min(start + limit, (self.ads + 1) // 2)
+        page = {"data": [{"id": f"{prefix}{adset:05d}", "name": f"Ad Set {adset}",
+                          "campaign_id": f"{prefix}{adset // 5:04d}",
+                          "daily_budget": str(random.Random(f"{account}{adset}").choice([1000, 2000, 5000]))}
+                         for adset in range(start, end)]}
+        if end < (self.ads + 1) // 2:
+            page["paging"] = {"cursors": {"after": str(end)}, "next": "https://fake/next"}
+        return page
+
+    def insights(self, account: str, params: dict) -> dict:
+        """ one page of the daily ad level insights of the time range of the params."""
+        time_range = json.loads(params.get("time_range") or "{}")
+        since = datetime.date.fromisoformat(time_range.get("since", datetime.date.today().isoformat()))
+        until = datetime.date.fromisoformat(time_range.get("until", since.isoformat()))
+        days = [since + datetime.timedelta(days=n) for n in range((until - since).days + 1)]
+        rows = [(day, ad) for day in days for ad in range(self.ads)]
+        start, limit = int(params.get("after") or 0), int(params.get("limit") or 25)
+        page = {"data": [self.insights_row(account, day, ad) for day, ad in rows[start:start + limit]]}
+        if start + limit < len(rows):
+            page["paging"] = {"cursors": {"after": str(start + limit)}, "next": "https://fake/next"}
+        return page
+
+    @staticmethod
+    def insights_row(account: str, day: datetime.date, ad: int) -> dict:
+        rng, prefix = random.Random(f"{account}{day}{ad}"), account.split("_")[-1]
+        impressions = rng.randint(500, 5000)
+        clicks = int(impressions * rng.uniform(0.005, 0.03) * (1 + ad % 3))
+        conversions = int(clicks * rng.uniform(0.01, 0.1))
+        return {
+            "campaign_id": f"{prefix}{ad // 10:04d}", "campaign_name": f"Campaign {ad // 10}",
+            "adset_id": f"{prefix}{ad // 2:05d}", "adset_name": f"Ad Set {ad // 2}",
+            "ad_id": f"{prefix}{ad:06d}", "ad_name": f"Ad {ad}",
+            "date_start": day.isoformat(), "date_stop": day.isoformat(),
+            "impressions": str(impressions), "reach": str(int(impressions * 0.8)), "clicks": str(clicks),
+            "spend": f"{impressions * rng.uniform(0.002, 0.008):.2f}",
+            "actions": [{"action_type": "purchase", "value": str(conversions)}],
+            "action_values": [{"action_type": "purchase", "value": f"{conversions * rng.uniform(20, 60):.2f}"}],
+        }
+
+    @staticmethod
+    def search(params: dict) -> dict:
+        """ targeting search results: the term itself and a narrower topic for interests, the country for geo."""
+        term = params.get("q", "")
+        if params.get("type") == "adgeolocation":
+            return {"data": [{"key": term[:2].upper(), "name": term.title(), "type": "country"}]}
+        ids = [int(hashlib.md5(f"{term}{i}".encode()).hexdigest()[:12], 16) for i in range(2)]
+        return {"data": [
+            {"id": str(ids[0]), "name": term.title(), "audience_size_upper_bound": 10 ** 7, "path": ["Interests"]},
+            {"id": str(ids[1]), "name": f"{term.title()} Enthusiasts", "audience_size_upper_bound": 10 ** 5},
+        ]}
+
+    def handle_batch(self, calls: list) -> list:
+        results, responses = {}, []
+        for call in calls:
+            with self.lock:
+                self.calls += 1
+            body = RESULT_REF.sub(lambda match: results.get(match.group(1), {}).get(match.group(2), match.group(0)),
+                                  unquote_plus(call.get("body", "")))
+            url = urlparse(call.get("relative_url", ""))
+            if self.random.random() < self.error_rate or "{result=" in body:
+                status, payload = self.error_response(*self.error)
+            elif url.path.rstrip("/").endswith("search"):
+                status, payload = 200, self.search(dict(parse_qsl(url.query)))
+            elif url.path.strip("/") in self.reports:
+                status, payload = 200, {"id": url.path.strip("/"), "async_status": "Job Completed",
+                                        "async_percent_completion": 100}
+            else:
+                status, payload = 200, {"id": str(next(self.ids))}
+                if call.get("name"):
+                    results[call["name"]] = payload
+            responses.append({"code": status, "headers": [], "body": json.dumps(payload)})
+        return responses
+
+
+# structured output runnable returned by ScriptedChatModel.with_structured_output
+class ScriptedStructuredOutput:
+
+    def __init__(self, model: "ScriptedChatModel", schema) -> None:
+        self.model = model
+        self.schema = schema
+
+    def invoke(self, messages, **kwargs):
+        self.model.turn()
+        return self.reply(messages)
+
+    async def ainvoke(self, messages, **kwargs):
+        await self.model.aturn()
+        return self.reply(messages)
+
+    def reply(self, messages):
+        prompt = self.model.prompt(messages)
+        if self.schema is VariantPlan:
+            n_copies = int(re.search(r"write (\d+) distinct", prompt).group(1))
+            return VariantPlan(
+                campaign_name="Benchmark Campaign",
+                ad_set_name="Benchmark Ad Set",
+                copies=[CopyVariant(creative_name=f"Creative {i}", ad_description=f"Description {i}",
+                                    ad_headline=f"Headline {i}", ad_name=f"Ad {i}") for i in range(n_copies)],
+            )
+        return CampaignPlan(
+            campaign_name="Benchmark Campaign",
+            ad_set_name="Benchmark Ad Set",
+            creative_name="Benchmark Creative",
+            ad_description="Benchmark description",
+            ad_headline="Benchmark headline",
+            ad_name="Benchmark Ad",
+        )
+
+
+# chat model that replays the tool calls of the campaign flow
+class ScriptedChatModel:
+    """Stand-in for the Gemini chat model. For the campaign prompt it requests the image upload and the campaign
+    in the first turn, the ad set and the creative in the second, the ad in the third and then answers with the
+    ad id, threading the ids of the ToolMessages like the real model does. Every call sleeps for `latency`
+    and raises with probability `error_rate`."""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 max_turns: int = 8, seed=None) -> None:
+        self.latency = Latency(latency, jitter, seed)
+        self.error_rate = error_rate
+        self.max_turns = max_turns
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.turns = 0
+
+    def bind_tools(self, tools, **kwargs) -> "ScriptedChatModel":
+        return self
+
+    def with_structured_output(self, schema, **kwargs) -> ScriptedStructuredOutput:
+        return ScriptedStructuredOutput(self, schema)
+
+    def turn(self) -> None:
+        self.count_turn()
+        self.latency.sleep()
+        self.maybe_fail()
+
+    async def aturn(self) -> None:
+        # waits on the event loop like an async http client
+        self.count_turn()
+        await self.latency.asleep()
+        self.maybe_fail()
+
+    def count_turn(self) -> None:
+        with self.lock:
+            self.turns += 1
+
+    def maybe_fail(self) -> None:
+        if self.random.random() < self.error_rate:
+            raise RuntimeError("429 Resource has been exhausted (injected)")
+
+    @staticmethod
+    def prompt(messages) -> str:
+        if isinstance(messages, str):
+            return messages
+        for message in convert_to_messages(messages):
+            if isinstance(message, HumanMessage):
+                return message.content
+        return ""
+
+    def invoke(self, messages, **kwargs) -> AIMessage:
+        self.turn()
+        return self.reply(messages)
+
+    async def ainvoke(self, messages, **kwargs) -> AIMessage:
+        await self.aturn()
+        return self.reply(messages)
+
+    def reply(self, messages) -> AIMessage:
+        messages = convert_to_messages(messages)
+        prompt = self.prompt(messages)
+        fields = dict(re.findall(r'(\w+) = "([^"]*)"', prompt))
+        targeting = re.search(r"targeting = '([^']*)'", prompt)
+        ids = collect_ids(messages)
+        ai_turns = sum(isinstance(message, AIMessage) for message in messages)
+
+        if ai_turns >= self.max_turns:
+            calls = []
+        elif "campaign_id" not in ids:
+            calls = [
+                ("imageGeneratorTool", {"image_path": fields.get("image_path", "")}),
+                ("campaignGeneratorTool", {"campaign_name": "Benchmark Campaign",
+                                           "campaign_goal": fields.get("campaign_goal", "Traffic")}),
+            ]
+        elif "ad_set_id" not in ids:
+            calls = [
+                ("adsetGeneratorTool", {"campaign_id": ids["campaign_id"], "page_id": fields.get("page_id", ""),
+                                        "ad_set_name": "Benchmark Ad Set",
+                                        "daily_budget": fields.get("daily_budget", "10"),
+                                        **({"targeting": targeting.group(1)} if targeting else {})}),
+                ("adCreativeGeneratorTool", {"description": "Benchmark description",
+                                             "image_hash": ids.get("image_hash", ""),
+                                             "creative_name": "Benchmark Creative",
+                                             "page_id": fields.get("page_id", ""), "headline": "Benchmark"}),
+            ]
+        elif "ad_id" not in ids and "creative_id" in ids:
+            calls = [("adGeneratorTool", {"ad_set_id": ids["ad_set_id"], "creative_id": ids["creative_id"],
+                                          "ad_name": "Benchmark Ad"})]
+        else:
+            calls = []
+
+        input_tokens = sum(len(str(message.content)) for message in messages) // 4
+        usage = {"input_tokens": input_tokens, "output_tokens": 50, "total_tokens": input_tokens + 50}
+        if not calls:
+            content = f"Ad created in paused state. Ad ID: {ids['ad_id']}" if "ad_id" in ids else "Campaign failed."
+            return AIMessage(content=content, usage_metadata=usage)
+        return AIMessage(
+            content="",
+            tool_calls=[{"name": name, "args": args, "id": f"call_{self.random.getrandbits(48):x}"}
+                        for name, args in calls],
+            usage_metadata=usage,
+        )
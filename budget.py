@@ -0,0 +1,208 @@
+from insights import get_store, read_pages, aggregate, PAGE_SIZE
+from accounts import use_account, current_account_id
+from meta_batch import MetaBatch
+from tracing import span
+from cache import SqliteCache
+from datetime import date, timedelta
+from dotenv import load_dotenv
+from typing import Optional
+import numpy as np
+import pandas as pd
+import uuid
+import os
+
+load_dotenv()
+
+# Reallocation of the daily budgets of the ad sets of an account from their recent performance. All the ad sets
+# are scored and given their new budget in one vectorized pass, then only the budgets that changed enough are
+# sent, as graph api batch requests. Budgets are in the minor unit of the account currency (cents), like the
+# daily_budget of the ad set tools.
+
+# "thompson" samples the return of every ad set from its posterior, so ad sets with little data still get
+# budget to learn from, "roas" allocates proportionally to the smoothed return on ad spend
+BUDGET_METHOD = os.getenv("BUDGET_METHOD", "thompson")
+
+# max relative change of a budget per reallocation, larger jumps reset the learning phase of an ad set
+BUDGET_MAX_CHANGE = float(os.getenv("BUDGET_MAX_CHANGE", 0.2))
+
+# min daily budget of an ad set, and the relative change below which a budget is left as it is
+BUDGET_MIN = int(os.getenv("BUDGET_MIN", 100))
+BUDGET_MIN_STEP = float(os.getenv("BUDGET_MIN_STEP", 0.05))
+
+# ad sets spending less than this share of their budget are not pacing to it, they get no increase
+PACING_MIN_DELIVERY = 0.7
+
+# weight of the account wide rates in the estimates of every ad set: days of its budget and conversions
+PRIOR_DAYS = 1.0
+PRIOR_CONVERSIONS = 5.0
+
+# minor units per unit of the spend reported by the insights (2 decimal currencies)
+CURRENCY_OFFSET = 100
+
+# planned budgets by plan id, a plan is applied exactly as it was previewed or not at all
+PLAN_COLUMNS = ["adset_id", "adset_name", "daily_budget", "new_budget", "change"]
+budget_plans = SqliteCache("budget_plans", ttl=float(os.getenv("BUDGET_PLAN_TTL", 3600)))
+
+
+def posterior(spend, conversions, revenue, prior_spend) -> tuple:
+    """ the gamma posterior (shape, rate) of the conversions per unit spent of every ad set, and its value per
+    conversion, both shrunk towards the rates of the whole account."""
+
+    total_spend, total_conversions, total_revenue = spend.sum(), conversions.sum(), revenue.sum()
+    rate = total_conversions / total_spend if total_spend > 0 else 0.0
+    shape = rate * prior_spend + conversions
+    scale_rate = prior_spend + spend
+    if total_revenue > 0:
+        value = total_revenue / max(total_conversions, 1.0)
+        value = (revenue + value * PRIOR_CONVERSIONS) / (conversions + PRIOR_CONVERSIONS)
+    else:
+        # without revenue tracking every conversion is worth the same
+        value = np.ones_like(spend)
+    return shape, scale_rate, value
+
+
+def scores(spend, conversions, revenue, budget, method: str = BUDGET_METHOD, rng=None) -> np.ndarray:
+    """ the expected return per unit spent of every ad set ("roas"), or one posterior sample of it ("thompson")."""
+
+    shape, scale_rate, value = posterior(spend, conversions, revenue, prior_spend=np.median(budget) * PRIOR_DAYS)
+    if method == "thompson":
+        rng = rng or np.random.default_rng()
+        # the account has no conversions yet, every ad set gets the same flat posterior
+        sampled = rng.gamma(np.maximum(shape, 1e-9), 1.0 / scale_rate) if shape.any() else np.ones_like(spend)
+        return sampled * value
+    if method == "roas":
+        return shape / scale_rate * value
+    raise ValueError(f"unknown budget method {method!r}, use 'thompson' or 'roas'")
+
+
+def fill(weights, lower, upper, total: float, iterations: int = 60) -> np.ndarray:
+    """ clip(k * weights, lower, upper) with the k that makes it sum to `total`, found by bisection.
+    `total` is first clipped to what the bounds allow."""
+
+    total = min(max(total, lower.sum()), upper.sum())
+    weights = np.maximum(weights, 0.0)
+    if not weights.any():
+        weights = np.ones_like(lower)
+    low, high = 0.0, float(np.max(upper / np.maximum(weights, 1e-12)))
+    for _ in range(iterations):
+        k = (low + high) / 2
+        if np.clip(k * weights, lower, upper).sum() < total:
+            low = k
+        else:
+            high = k
+    return np.clip(high * weights, lower, upper)
+
+
+def allocate(budget, spend, conversions, revenue, days: int, total: Optional[float] = None,
+             method: str = BUDGET_METHOD, max_change: float = BUDGET_MAX_CHANGE, min_budget: int = BUDGET_MIN,
+             rng=None) -> np.ndarray:
+    """ the new daily budgets of the ad sets. `spend` (in minor units), `conversions` and `revenue` are the
+    totals of the last `days` days. The budgets move by at most `max_change` and sum to `total` (the current
+    total by default), proportionally to the score of every ad set."""
+
+    budget, spend = np.asarray(budget, dtype="float64"), np.asarray(spend, dtype="float64")
+    conversions, revenue = np.asarray(conversions, dtype="float64"), np.asarray(revenue, dtype="float64")
+
+    # pacing: only the ad sets that spend (most of) their budget are limited by it and get an increase
+    delivering = spend / max(days, 1) >= PACING_MIN_DELIVERY * budget
+    upper = np.where(delivering, budget * (1 + max_change), budget)
+    lower = np.minimum(np.maximum(budget * (1 - max_change), min_budget), upper)
+
+    weights = scores(spend, conversions, revenue, budget, method, rng)
+    new_budget = fill(weights, lower, upper, budget.sum() if total is None else float(total))
+    return np.floor(new_budget).astype("int64")
+
+
+def fetch_budgets(account_id: str, campaign_id: Optional[str] = None) -> pd.DataFrame:
+    """ the active ad sets of the account (or campaign) that have a daily budget, with one paged request."""
+
+    path = (campaign_id, "adsets") if campaign_id else (account_id, "adsets")
+    rows = read_pages(account_id, path, {"fields": "id,name,campaign_id,daily_budget", "limit": PAGE_SIZE,
+                                         "effective_status": '["ACTIVE"]'})
+    frame = pd.DataFrame(rows, columns=["id", "name", "campaign_id", "daily_budget"])
+    frame = frame.rename(columns={"id": "adset_id", "name": "adset_name"})
+    # ad sets of campaigns with a campaign budget have no daily budget of their own
+    frame["daily_budget"] = pd.to_numeric(frame["daily_budget"], errors="coerce")
+    return frame.dropna(subset=["daily_budget"]).astype({"daily_budget": "int64"})
+
+
+def plan_budgets(account_id: Optional[str] = None, days: int = 7, campaign_id: Optional[str] = None,
+                 total: Optional[float] = None, method: str = BUDGET_METHOD, seed: Optional[int] = None) -> pd.DataFrame:
+    """ the current and new budget of every active ad set of the account, from the insights of the last `days`
+    days in the local store (see insights.py)."""
+
+    account_id = account_id or current_account_id()
+    # the allocation of a store missing the last days would move the budgets on stale numbers
+    watermark = get_store().watermark(account_id)
+    if watermark is None or watermark < date.today() - timedelta(days=1):
+        raise RuntimeError(f"the insights of {account_id} are synced up to {watermark or 'never'}, "
+                           f"run `python insights.py` before planning budgets")
+    with use_account(account_id), span("plan_budgets", account=account_id, method=method) as current:
+        adsets = fetch_budgets(account_id, campaign_id)
+        since = date.today() - timedelta(days=days)
+        rows = get_store().query([account_id], since=since, until=date.today() - timedelta(days=1),
+                                 campaign_id=campaign_id)
+        stats = aggregate(rows, "adset")[["adset_id", "spend", "conversions", "revenue", "roas"]]
+        plan = adsets.merge(stats, on="adset_id", how="left").fillna({"spend": 0.0, "conversions": 0.0,
+                                                                       "revenue": 0.0, "roas": 0.0})
+        plan["new_budget"] = allocate(plan["daily_budget"], plan["spend"] * CURRENCY_OFFSET, plan["conversions"],
+                                      plan["revenue"] * CURRENCY_OFFSET, days, total, method,
+                                      rng=np.random.default_rng(seed))
+        plan["change"] = plan["new_budget"] - plan["daily_budget"]
+        current.set(adsets=len(plan))
+    return plan
+
+
+def save_plan(plan: pd.DataFrame, account_id: str) -> str:
+    """ stores the plan for BUDGET_PLAN_TTL seconds and returns its id, which `load_plan` takes back."""
+    plan_id = uuid.uuid4().hex[:16]
+    budget_plans.set(plan_id, {"account_id": account_id, "rows": plan[PLAN_COLUMNS].to_dict(orient="list")})
+    return plan_id
+
+
+def load_plan(plan_id: str) -> tuple:
+    """ the account and the plan saved under `plan_id`."""
+    if (saved := budget_plans.get(plan_id)) is None:
+        raise ValueError(f"unknown or expired budget plan {plan_id!r}, plan the budgets again")
+    return saved["account_id"], pd.DataFrame(saved["rows"], columns=PLAN_COLUMNS)
+
+
+def changed(plan: pd.DataFrame, min_step: float = BUDGET_MIN_STEP) -> pd.DataFrame:
+    """ the ad sets whose budget changes by at least `min_step`."""
+    return plan[(plan["change"].abs() >= min_step * plan["daily_budget"]) & (plan["change"] != 0)]
+
+
+def apply_budgets(plan: pd.DataFrame, account_id: Optional[str] = None, min_step: float = BUDGET_MIN_STEP) -> dict:
+    """ sends the new budgets that changed enough, 50 ad set updates per graph api batch request."""
+
+    account_id = account_id or current_account_id()
+    updates = changed(plan, min_step)
+    with use_account(account_id), span("apply_budgets", account=account_id, updates=len(updates)):
+        batch = MetaBatch()
+        for adset_id, new_budget in zip(updates["adset_id"], updates["new_budget"]):
+            batch.add("POST", adset_id, {"daily_budget": int(new_budget)})
+        responses = batch.execute() if len(batch) else {}
+    failed = [error for error in responses.values() if isinstance(error, Exception)]
+    return {"updated": len(responses) - len(failed), "failed": len(failed), "unchanged": len(plan) - len(updates),
+            "errors": [str(error) for error in failed[:5]]}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Reallocate the daily budgets of the ad sets of an account.")
+    parser.add_argument("--account", help="account id, META_AD_ACCOUNT_ID by default")
+    parser.add_argument("--campaign", help="only the ad sets of this campaign")
+    parser.add_argument("--days", type=int, default=7, help="days of insights the allocation is based on")
+    parser.add_argument("--total", type=float, help="total daily budget, the current total by default")
+    parser.add_argument("--method", choices=["thompson", "roas"], default=BUDGET_METHOD)
+    parser.add_argument("--apply", metavar="PLAN_ID", help="send the budgets of a plan printed by an earlier run")
+    args = parser.parse_args()
+
+    if args.apply:
+        account_id, plan = load_plan(args.apply)
+        print(apply_budgets(plan, account_id))
+    else:
+        plan = plan_budgets(args.account, args.days, args.campaign, args.total, args.method)
+        print(changed(plan).sort_values("change").to_string(index=False))
+        print("plan id:", save_plan(plan, args.account or current_account_id()))
@@ -0,0 +1,114 @@
+from dotenv import load_dotenv
+from typing import Optional
+import threading
+import hashlib
+import sqlite3
+import time
+import json
+import os
+
+load_dotenv()
+
+CACHE_DIR = os.getenv("CACHE_DIR", "./.cache")
+
+
+# small persistent key value store with TTL and least recently used eviction
+class SqliteCache:
+    """Stores JSON values in a SQLite table under CACHE_DIR. Entries older than `ttl` seconds are
+    treated as missing and the least recently used entries are evicted beyond `max_entries`."""
+
+    def __init__(self, name: str, ttl: Optional[float] = None, max_entries: Optional[int] = None,
+                 path: Optional[str] = None) -> None:
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        path = path or os.path.join(CACHE_DIR, "cache.sqlite")
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {name} "
+                "(key TEXT PRIMARY KEY, value TEXT, created REAL, last_used REAL)"
+            )
+
+    def get(self, key: str):
+        now = time.time()
+        with self.lock, self.conn:
+            row = self.conn.execute(f"SELECT value, created FROM {self.name} WHERE key = ?", (key,)).fetchone()
+            if row and self.ttl is not None and now - row[1] > self.ttl:
+                self.conn.execute(f"DELETE FROM {self.name} WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.conn.execute(f"UPDATE {self.name} SET last_used = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return json.loads(row[0])
+
+    def set(self, key: str, value) -> None:
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO {self.name} (key, value, created, last_used) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now),
+            )
+            if self.max_entries is not None:
+                self.conn.execute(
+                    f"DELETE FROM {self.name} WHERE key IN (SELECT key FROM {self.name} "
+                    "ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+
+    def stats(self) -> dict:
+        with self.lock:
+            entries = self.conn.execute(f"SELECT COUNT(*) FROM {self.name}").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+        }
+
+
+def file_digest(path: str, chunk_size: int = 1 << 20) -> str:
+    """ sha256 of a file, read in chunks so large images are never fully loaded in memory."""
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# content addressed cache of the image hashes returned by meta for uploaded images
+class ImageHashCache(SqliteCache):
+    """Maps the content hash of an image file and the ad account id to the meta image hash,
+    so a reused creative asset is never uploaded twice to the same account."""
+
+    def __init__(self, ttl: Optional[float] = None, max_entries: Optional[int] = None) -> None:
+        super().__init__("image_hashes", ttl=ttl, max_entries=max_entries)
+        self.bytes_saved = 0
+
+    @staticmethod
+    def key(image_path: str, account_id: str) -> str:
+        return f"{account_id}:{file_digest(image_path)}"
+
+    def lookup(self, key: str, image_path: str) -> Optional[str]:
+        image_hash = self.get(key)
+        if image_hash is not None:
+            self.bytes_saved += os.path.getsize(image_path)
+        return image_hash
+
+    def stats(self) -> dict:
+        return {**super().stats(), "bytes_saved": self.bytes_saved}
+
+
+image_cache = ImageHashCache(
+    ttl=float(os.getenv("IMAGE_CACHE_TTL", 30 * 24 * 3600)),
+    max_entries=int(os.getenv("IMAGE_CACHE_MAX_ENTRIES", 10000)),
+)
@@ -0,0 +1,130 @@
+from contextlib import contextmanager, asynccontextmanager
+from contextvars import ContextVar
+from cache import SqliteCache, CACHE_DIR
+from functools import lru_cache, wraps
+from dotenv import load_dotenv
+from typing import Optional
+import hashlib
+import inspect
+import sqlite3
+import json
+import os
+
+load_dotenv()
+
+# Runs of the graphs are checkpointed after every node, so a failed or interrupted run resumes from the
+# last completed node instead of starting over. The tools are idempotent within a thread of a run: a tool call
+# with the same arguments returns the ids created the first time instead of creating the object again. Running
+# the same inputs again after a run completed starts a new thread, and creates new objects.
+
+CHECKPOINT_DB = os.getenv("CHECKPOINT_DB", os.path.join(CACHE_DIR, "checkpoints.sqlite"))
+
+# results of the tool calls by idempotency key, and the last thread of every run key
+tool_results = SqliteCache("tool_results", ttl=float(os.getenv("IDEMPOTENCY_TTL", 7 * 24 * 3600)))
+run_threads = SqliteCache("run_threads", ttl=float(os.getenv("IDEMPOTENCY_TTL", 7 * 24 * 3600)))
+
+# thread of the run the current tool calls belong to, tool calls outside of a run are not deduplicated
+run_scope = ContextVar("run_scope", default=None)
+
+
+@lru_cache(maxsize=None)
+def get_checkpointer():
+    """ the sqlite checkpointer shared by the compiled graphs of the process."""
+    from langgraph.checkpoint.sqlite import SqliteSaver
+
+    os.makedirs(os.path.dirname(CHECKPOINT_DB) or ".", exist_ok=True)
+    return SqliteSaver(sqlite3.connect(CHECKPOINT_DB, check_same_thread=False))
+
+
+@asynccontextmanager
+async def async_checkpointer():
+    """ the sqlite checkpointer for graphs run with ainvoke, its connection belongs to the running event loop."""
+    from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+    os.makedirs(os.path.dirname(CHECKPOINT_DB) or ".", exist_ok=True)
+    async with AsyncSqliteSaver.from_conn_string(CHECKPOINT_DB) as saver:
+        yield saver
+
+
+def run_key(*parts) -> str:
+    """ stable key of a run from its inputs, so rerunning the same inputs resumes the same run."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()[:32]
+
+
+def idempotency_key(tool_name: str, fn, *args, **kwargs) -> Optional[str]:
+    """ key of a call of the tool function within the current run thread, the same for positional, keyword
+    and default arguments. None outside of a run."""
+
+    if (scope := run_scope.get()) is None:
+        return None
+    bound = inspect.signature(fn).bind(*args, **kwargs)
+    bound.apply_defaults()
+    return run_key(scope, tool_name, bound.arguments)
+
+
+def idempotent(tool_name: str):
+    """ decorator for the tool functions: within a run thread, the result of a successful call is stored under the
+    idempotency key of the tool call and returned again for the same arguments."""
+
+    def decorator(fn):
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            key = idempotency_key(tool_name, fn, *args, **kwargs)
+            if key is not None and (result := tool_results.get(key)) is not None:
+                return result
+            result = fn(*args, **kwargs)
+            if key is not None:
+                tool_results.set(key, result)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def thread_config(thread_id: str) -> dict:
+    return {"configurable": {"thread_id": thread_id}}
+
+
+@contextmanager
+def checkpointed_run(graph, inputs: dict, key: str):
+    """ yields the input and config to invoke the graph with for the run `key`. If the last thread of the run
+    stopped before the end (an exception or a crash) it is resumed from its last checkpoint, otherwise a new
+    thread is started. The tool calls made inside the block are idempotent within the thread, so only a resumed
+    thread reuses the objects created before."""
+
+    thread_id = run_threads.get(key)
+    pending = thread_id is not None and graph.checkpointer is not None and \
+        bool(graph.get_state(thread_config(thread_id)).next)
+    with _run_scope(inputs, key, thread_id, pending) as run:
+        yield run
+
+
+@asynccontextmanager
+async def acheckpointed_run(graph, inputs: dict, key: str):
+    """ `checkpointed_run` for graphs run with ainvoke and an async checkpointer."""
+
+    thread_id = run_threads.get(key)
+    pending = thread_id is not None and graph.checkpointer is not None and \
+        bool((await graph.aget_state(thread_config(thread_id))).next)
+    with _run_scope(inputs, key, thread_id, pending) as run:
+        yield run
+
+
+@contextmanager
+def _run_scope(inputs: dict, key: str, thread_id: Optional[str], pending: bool):
+    if pending:
+        # resume, the graph continues with the pending nodes of the checkpoint
+        inputs = None
+    else:
+        attempt = int(thread_id.rsplit(":", 1)[1]) + 1 if thread_id else 1
+        thread_id = f"{key}:{attempt}"
+        run_threads.set(key, thread_id)
+
+    # the ids of a completed thread are never reused, a new thread creates its own objects
+    token = run_scope.set(thread_id)
+    try:
+        yield inputs, thread_config(thread_id)
+    finally:
+        run_scope.reset(token)
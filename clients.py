@@ -0,0 +1,85 @@
+from accounts import get_account, current_account_id
+from functools import lru_cache
+from dotenv import load_dotenv
+import getpass
+import os
+
+load_dotenv()
+
+# The sdk clients are built on first use and cached for the whole process, so importing the project
+# modules (and every streamlit rerun) is cheap and doesn't ask for keys that are never used.
+
+MODEL = "gemini-2.5-flash-preview-04-17"
+IMAGE_MODEL = "models/gemini-2.0-flash-exp-image-generation"
+
+
+def require_env(name: str, prompt: str) -> str:
+    """ returns the environment variable, asking for it on the terminal if it is missing."""
+
+    if not os.environ.get(name):
+        os.environ[name] = getpass.getpass(prompt)
+    return os.environ[name]
+
+
+def get_api(access_token: str = None, app_id: str = None, app_secret: str = None):
+    """ the facebook ads api for a set of credentials, the credentials of the environment by default.
+    Every set of credentials gets its own pooled session that is shared by all threads."""
+
+    return _get_api(
+        access_token or os.getenv("META_ACCESS_TOKEN"),
+        app_id or os.getenv("META_APP_ID"),
+        app_secret or os.getenv("META_APP_SECRET"),
+    )
+
+
+@lru_cache(maxsize=None)
+def _get_api(access_token: str, app_id: str, app_secret: str):
+    from facebook_business.api import FacebookAdsApi
+    from meta_session import create_session
+
+    api = FacebookAdsApi(create_session(access_token, app_id, app_secret))
+    # sdk objects created without an api use the one of the environment credentials
+    if access_token == os.getenv("META_ACCESS_TOKEN"):
+        FacebookAdsApi.set_default_api(api)
+    return api
+
+
+def get_account_api(account_id: str = None):
+    """ the facebook ads api with the credentials of the ad account, the current account by default."""
+
+    account = get_account(account_id)
+    return get_api(account["access_token"], account["app_id"], account["app_secret"])
+
+
+def get_ad_account(account_id: str = None):
+    """ the ad account the tools act on: the current account of the run (see accounts.use_account) by default."""
+    return _get_ad_account(account_id or current_account_id())
+
+
+@lru_cache(maxsize=None)
+def _get_ad_account(account_id: str):
+    from facebook_business.adobjects.adaccount import AdAccount
+
+    return AdAccount(account_id, api=get_account_api(account_id))
+
+
+@lru_cache(maxsize=None)
+def get_search_tool():
+    from langchain_tavily import TavilySearch
+    from search_cache import CachedSearchTool
+
+    require_env("TAVILY_API_KEY", "Tavily API key:\n")
+    # repeated and concurrent identical queries are served from the search cache
+    return CachedSearchTool(TavilySearch(max_results = 2))
+
+
+@lru_cache(maxsize=None)
+def get_llm(model: str = MODEL):
+    from langchain_google_genai import ChatGoogleGenerativeAI
+
+    require_env("GOOGLE_API_KEY", "Enter your Google AI API key: ")
+    return ChatGoogleGenerativeAI(model=model)
+
+
+def get_image_llm():
+    return get_llm(IMAGE_MODEL)
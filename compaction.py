@@ -0,0 +1,96 @@
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage, convert_to_messages
+from dotenv import load_dotenv
+from typing import Optional
+import json
+import os
+
+load_dotenv()
+
+# Compaction of the message history sent to the llm on every agent turn. The graph state keeps the full
+# messages, only the copy sent to the llm is compacted: whitespace of the prompts is collapsed, tool outputs
+# are trimmed to the fields later steps need, and optionally the earlier turns are folded into the prompt.
+
+# max characters kept of a text field of a tool output (e.g. the content of a search result)
+SNIPPET_CHARS = int(os.getenv("COMPACT_SNIPPET_CHARS", 300))
+
+# number of recent agent turns sent verbatim, older turns are summarized. Unset keeps every turn.
+KEEP_TURNS = int(os.getenv("COMPACT_KEEP_TURNS")) if os.getenv("COMPACT_KEEP_TURNS") else None
+
+# fields of the tool outputs no later step uses, e.g. the full page text and scores of the search results
+DROP_KEYS = {"raw_content", "images", "follow_up_questions", "response_time", "score", "request_id"}
+
+
+def estimate_tokens(messages: list) -> int:
+    """ rough token count of the messages (4 characters per token), good enough to compare prompts."""
+
+    chars = 0
+    for message in convert_to_messages(messages):
+        chars += len(message.content if isinstance(message.content, str) else json.dumps(message.content))
+        chars += sum(len(json.dumps(call["args"])) for call in getattr(message, "tool_calls", []))
+    return chars // 4
+
+
+def collapse_whitespace(text: str) -> str:
+    """ strips the indentation and trailing spaces of every line and drops blank lines."""
+    return "\n".join(line.strip() for line in text.splitlines() if line.strip())
+
+
+def trim_value(value, max_chars: int = SNIPPET_CHARS):
+    if isinstance(value, dict):
+        return {key: trim_value(item, max_chars) for key, item in value.items() if key not in DROP_KEYS}
+    if isinstance(value, list):
+        return [trim_value(item, max_chars) for item in value]
+    if isinstance(value, str) and len(value) > max_chars:
+        return value[:max_chars].rstrip() + "..."
+    return value
+
+
+def compact_tool_content(content: str, max_chars: int = SNIPPET_CHARS) -> str:
+    """ trims a tool output to what later steps need: ids and hashes are kept as is, long texts are cut
+    to `max_chars` and unused fields are dropped."""
+
+    try:
+        value = json.loads(content)
+    except (TypeError, ValueError):
+        return trim_value(content, max_chars)
+    return json.dumps(trim_value(value, max_chars), separators=(",", ":"))
+
+
+def summarize_turns(messages: list) -> str:
+    """ one line per tool call of the given turns with its arguments and compacted output."""
+
+    outputs = {message.tool_call_id: message.content for message in messages if isinstance(message, ToolMessage)}
+    lines = []
+    for message in messages:
+        for call in getattr(message, "tool_calls", []):
+            output = compact_tool_content(outputs.get(call["id"], "null"))
+            lines.append(f"- {call['name']}({json.dumps(call['args'], separators=(',', ':'))}) -> {output}")
+    return "\n".join(lines)
+
+
+def compact_messages(messages: list, keep_turns: Optional[int] = KEEP_TURNS) -> list:
+    """ the messages to send to the llm. With `keep_turns`, agent turns older than the last `keep_turns`
+    are replaced by a summary of their tool calls appended to the first user message, so the sequence of
+    tool calls and tool results sent to the llm stays valid."""
+
+    compacted = []
+    for message in convert_to_messages(messages):
+        if isinstance(message, ToolMessage):
+            message = message.model_copy(update={"content": compact_tool_content(message.content)})
+        elif isinstance(message, HumanMessage) and isinstance(message.content, str):
+            message = message.model_copy(update={"content": collapse_whitespace(message.content)})
+        compacted.append(message)
+
+    if keep_turns is None or not compacted or not isinstance(compacted[0], HumanMessage):
+        return compacted
+
+    # a turn starts at an AIMessage and includes the ToolMessages answering it
+    turn_starts = [index for index, message in enumerate(compacted) if isinstance(message, AIMessage)]
+    if len(turn_starts) <= keep_turns:
+        return compacted
+    cut = turn_starts[-keep_turns] if keep_turns else len(compacted)
+    if summary := summarize_turns(compacted[1:cut]):
+        prompt = compacted[0].content + "\n\nSteps already completed (do not repeat them):\n" + summary
+    else:
+        prompt = compacted[0].content
+    return [compacted[0].model_copy(update={"content": prompt})] + compacted[cut:]
@@ -1,53 +1,253 @@
 from langgraph.graph import StateGraph, START, END
 from langgraph.graph.message import add_messages
-from langchain_google_genai import ChatGoogleGenerativeAI
-from tools import search_tool, make_campaign, make_ad_set, make_ad_creative, make_ad, make_ad_image 
-from graph_utilities import State, BasicToolNode, route_tools
-import getpass 
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import RunnableLambda
+from tools import make_campaign, make_ad_set, make_ad_creative, make_ad, make_ad_image, get_ad_insights
+from tools import BATCHABLE_TOOLS, run_batched_tool_calls
+from graph_utilities import State, PipelineState, CampaignPlan, ConcurrentToolNode, route_tools, route_pipeline, invoke_tool
+from prompt import generate_campaign_prompt, generate_plan_prompt
+from rate_limiter import get_limiter
+from llm_cache import CachedLLM
+from tracing import span, count
+from compaction import compact_messages, estimate_tokens
+from clients import MODEL, get_llm, get_search_tool
+from checkpoints import get_checkpointer
+from accounts import use_account
+from targeting import targeting_spec
+from functools import lru_cache
+import json
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 
-# store api key in environment variable
-if "GOOGLE_API_KEY" not in os.environ:
-    os.environ["GOOGLE_API_KEY"] = getpass.getpass("Enter your Google AI API key: ")
-
-graph_builder = StateGraph(State)
-
-#initalize llm 
-llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash-preview-04-17")
-
-# provide tools 
-tools = [search_tool, make_campaign, make_ad_set, make_ad_creative, make_ad, make_ad_image]
-
-# create llm with tools that has knowledge of tool input arguments schema 
-llm_with_tools = llm.bind_tools(tools)
-
-# define various nodes of the graph 
-def chatbot_with_tools(state: State):
-    return {"messages":[llm_with_tools.invoke(state['messages'])]}
-
-tool_node = BasicToolNode(tools = tools)
-
-# create the nodes of the graph
-graph_builder.add_node("chatbot_with_tools", chatbot_with_tools)
-graph_builder.add_node("tools", tool_node)
-
-# create edges of the graph
-graph_builder.add_edge("tools", "chatbot_with_tools")
-graph_builder.add_edge(START, "chatbot_with_tools")
-
-graph_builder.add_conditional_edges(
-    "chatbot_with_tools",
-    route_tools,
-    #define the output to a specific node in graph
-    {"tools": "tools", END: END},
-)
-
-# create the graph
-graph = graph_builder.compile()
-
-
-
-
+# The graphs are compiled on first use by get_graph / get_pipeline (or `graph.graph` / `graph.pipeline`)
+# and cached for the whole process, so importing this module doesn't build any sdk client.
+
+
+def get_tools() -> list:
+    # provide tools, the budget allocator moves the money of running ad sets and is not given to the campaign agent
+    return [get_search_tool(), make_campaign, make_ad_set, make_ad_creative, make_ad, make_ad_image, get_ad_insights]
+
+
+def build_graph(llm=None, tools=None, checkpointer=None):
+    """ compiles the agentic graph, `llm` and `tools` default to the gemini model and the project tools.
+    With a `checkpointer` the state is saved after every node, runs then need a thread_id in their config."""
+
+    graph_builder = StateGraph(State)
+
+    #initalize llm 
+    llm = llm or get_llm()
+    tools = tools or get_tools()
+
+    # create llm with tools that has knowledge of tool input arguments schema 
+    # repeated prompts are served from the local response cache
+    llm_with_tools = CachedLLM(
+        llm.bind_tools(tools),
+        model = MODEL,
+        settings = {"tools": [tool.name for tool in tools]},
+        limiter = get_limiter("gemini", MODEL),
+    )
+
+    # define various nodes of the graph 
+    # the history is compacted before every turn, the state keeps the full tool outputs
+    def chatbot_with_tools(state: State):
+        with span("chatbot_with_tools", messages=len(state['messages'])):
+            messages = compact_messages(state['messages'])
+            count(tokens_before=estimate_tokens(state['messages']), tokens_after=estimate_tokens(messages))
+            return {"messages":[llm_with_tools.invoke(messages)]}
+
+    # the same turn for `ainvoke` / `astream` of the graph
+    async def achatbot_with_tools(state: State):
+        with span("chatbot_with_tools", messages=len(state['messages'])):
+            messages = compact_messages(state['messages'])
+            count(tokens_before=estimate_tokens(state['messages']), tokens_after=estimate_tokens(messages))
+            return {"messages":[await llm_with_tools.ainvoke(messages)]}
+
+    # independent tool calls of a turn run concurrently, bounded by TOOL_CONCURRENCY, and several
+    # meta object creations of the same turn are sent as one graph api batch request
+    tool_node = ConcurrentToolNode(
+        tools = tools,
+        max_concurrency = int(os.getenv("TOOL_CONCURRENCY", "4")),
+        batcher = run_batched_tool_calls,
+        batch_tools = BATCHABLE_TOOLS,
+    )
+
+    # create the nodes of the graph, with an async version used when the graph is run with ainvoke
+    graph_builder.add_node("chatbot_with_tools", RunnableLambda(chatbot_with_tools, afunc=achatbot_with_tools))
+    graph_builder.add_node("tools", RunnableLambda(tool_node, afunc=tool_node.acall))
+
+    # create edges of the graph
+    graph_builder.add_edge("tools", "chatbot_with_tools")
+    graph_builder.add_edge(START, "chatbot_with_tools")
+
+    graph_builder.add_conditional_edges(
+        "chatbot_with_tools",
+        route_tools,
+        #define the output to a specific node in graph
+        {"tools": "tools", END: END},
+    )
+
+    # create the graph
+    return graph_builder.compile(checkpointer=checkpointer)
+
+
+# Fast-path pipeline: a single planner llm call writes all the creative text and the tools
+# are then executed directly, wiring the ids between them. The agentic graph above is used
+# as a fallback if any step fails.
+
+def pipeline_step(tool, build_args):
+    """ creates a pipeline node that invokes the tool with arguments built from the state.
+    The step is skipped once an earlier step has failed."""
+
+    def step(state: PipelineState):
+        if state.get("errors"):
+            return {}
+        try:
+            with use_account(state.get("account")):
+                result = invoke_tool(tool, build_args(state["inputs"], state.get("plan", {}), state.get("results", {})))
+        except Exception as e:
+            return {"errors": [f"{tool.name}: {e}"]}
+        return {"results": result}
+
+    return step
+
+
+upload_image = pipeline_step(make_ad_image, lambda inputs, plan, results: {
+    "image_path": inputs["image_path"],
+})
+create_campaign = pipeline_step(make_campaign, lambda inputs, plan, results: {
+    "campaign_name": plan["campaign_name"],
+    "campaign_goal": inputs["campaign_goal"],
+})
+create_ad_set = pipeline_step(make_ad_set, lambda inputs, plan, results: {
+    "campaign_id": results["campaign_id"],
+    "page_id": inputs["page_id"],
+    "ad_set_name": plan["ad_set_name"],
+    "daily_budget": str(inputs["daily_budget"]),
+    "targeting": json.dumps(targeting_spec(inputs)),
+})
+create_ad_creative = pipeline_step(make_ad_creative, lambda inputs, plan, results: {
+    "description": plan["ad_description"],
+    "image_hash": results["image_hash"],
+    "creative_name": plan["creative_name"],
+    "page_id": inputs["page_id"],
+    "headline": plan["ad_headline"],
+})
+create_ad = pipeline_step(make_ad, lambda inputs, plan, results: {
+    "ad_set_id": results["ad_set_id"],
+    "creative_id": results["creative_id"],
+    "ad_name": plan["ad_name"],
+})
+
+
+def finalize(state: PipelineState):
+    results = state["results"]
+    summary = (
+        "Ad created in paused state.\n\n"
+        f"- Campaign ID: {results['campaign_id']}\n"
+        f"- Ad Set ID: {results['ad_set_id']}\n"
+        f"- Creative ID: {results['creative_id']}\n"
+        f"- Ad ID: {results['ad_id']}"
+    )
+    return {"messages": [AIMessage(content=summary)]}
+
+
+def build_pipeline(llm=None, graph=None, checkpointer=None):
+    """ compiles the fast-path pipeline, `graph` is the agentic graph used as the fallback."""
+
+    pipeline_builder = StateGraph(PipelineState)
+    llm = llm or get_llm()
+    graph = graph or get_graph()
+
+    # llm that answers with all the creative text of the campaign as structured output
+    planner_llm = CachedLLM(
+        llm.with_structured_output(CampaignPlan),
+        model = MODEL,
+        settings = {"output": CampaignPlan.__name__},
+        output_model = CampaignPlan,
+        limiter = get_limiter("gemini", MODEL),
+    )
+
+    def plan_campaign(state: PipelineState):
+        try:
+            with span("plan_campaign"):
+                plan = planner_llm.invoke(generate_plan_prompt(**state["inputs"]))
+        except Exception as e:
+            return {"errors": [f"planner: {e}"]}
+        return {"plan": plan.model_dump()}
+
+    async def aplan_campaign(state: PipelineState):
+        try:
+            with span("plan_campaign"):
+                plan = await planner_llm.ainvoke(generate_plan_prompt(**state["inputs"]))
+        except Exception as e:
+            return {"errors": [f"planner: {e}"]}
+        return {"plan": plan.model_dump()}
+
+    def fallback_inputs(state: PipelineState) -> dict:
+        prompt = generate_campaign_prompt(**state["inputs"], targeting=targeting_spec(state["inputs"]))
+        if results := state.get("results"):
+            prompt += f"\nThe following outputs were already created, reuse them instead of repeating those steps: {results}\n"
+        return {"messages": [{"role": "user", "content": prompt}], "account": state.get("account")}
+
+    def fallback(state: PipelineState):
+        """ hands the run over to the agentic graph, passing on the ids that were already created."""
+        with span("fallback", errors=state.get("errors", [])):
+            response = graph.invoke(fallback_inputs(state))
+        return {"messages": response["messages"]}
+
+    async def afallback(state: PipelineState):
+        with span("fallback", errors=state.get("errors", [])):
+            response = await graph.ainvoke(fallback_inputs(state))
+        return {"messages": response["messages"]}
+
+    # create the nodes of the pipeline
+    # the steps calling the meta sdk stay synchronous, ainvoke runs them on its executor
+    pipeline_builder.add_node("plan_campaign", RunnableLambda(plan_campaign, afunc=aplan_campaign))
+    pipeline_builder.add_node("upload_image", upload_image)
+    pipeline_builder.add_node("create_campaign", create_campaign)
+    pipeline_builder.add_node("create_ad_set", create_ad_set)
+    pipeline_builder.add_node("create_ad_creative", create_ad_creative)
+    pipeline_builder.add_node("create_ad", create_ad)
+    pipeline_builder.add_node("finalize", finalize)
+    pipeline_builder.add_node("fallback", RunnableLambda(fallback, afunc=afallback))
+
+    # image upload doesn't depend on the plan so it runs in parallel with the planner llm
+    pipeline_builder.add_edge(START, "plan_campaign")
+    pipeline_builder.add_edge(START, "upload_image")
+    pipeline_builder.add_edge("plan_campaign", "create_campaign")
+    pipeline_builder.add_edge("create_campaign", "create_ad_set")
+    pipeline_builder.add_edge(["plan_campaign", "upload_image"], "create_ad_creative")
+    pipeline_builder.add_edge(["create_ad_set", "create_ad_creative"], "create_ad")
+
+    pipeline_builder.add_conditional_edges(
+        "create_ad",
+        route_pipeline,
+        {"finalize": "finalize", "fallback": "fallback"},
+    )
+    pipeline_builder.add_edge("finalize", END)
+    pipeline_builder.add_edge("fallback", END)
+
+    # create the pipeline
+    return pipeline_builder.compile(checkpointer=checkpointer)
+
+
+# the graphs of the app and the batch runner are checkpointed, so failed runs can be resumed
+@lru_cache(maxsize=None)
+def get_graph():
+    return build_graph(checkpointer=get_checkpointer())
+
+
+@lru_cache(maxsize=None)
+def get_pipeline():
+    return build_pipeline(graph=get_graph(), checkpointer=get_checkpointer())
+
+
+def __getattr__(name):
+    # `from graph import graph, pipeline` keeps working, the graphs are only compiled when first accessed
+    if name == "graph":
+        return get_graph()
+    if name == "pipeline":
+        return get_pipeline()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,13 +1,76 @@
-from langchain_core.messages import ToolMessage
+from langchain_core.messages import ToolMessage, AIMessageChunk
 from langgraph.graph.message import add_messages
 from langgraph.graph import END
 from typing_extensions import TypedDict
 from typing import Annotated
+from concurrent.futures import ThreadPoolExecutor
+from pydantic import BaseModel, Field
+from tracing import span
+from accounts import use_account
+from validation import validate_tool_call, rejection, record
+import contextvars
+import asyncio
+import operator
+import time
 import json
 
 # define the shared state of the graph
 class State(TypedDict):
     messages: Annotated[list, add_messages]
+    # ad account the tools act on, the credentials are looked up in the account registry
+    account: str
+
+
+def merge_dicts(left: dict, right: dict) -> dict:
+    """ reducer used to merge the results of parallel pipeline steps."""
+    return {**(left or {}), **(right or {})}
+
+
+# state of the fast-path pipeline: form inputs, the llm plan and the ids created by each step
+class PipelineState(TypedDict):
+    messages: Annotated[list, add_messages]
+    account: str
+    inputs: dict
+    plan: dict
+    results: Annotated[dict, merge_dicts]
+    errors: Annotated[list, operator.add]
+
+
+# structured output of the planner llm for the fast-path pipeline
+class CampaignPlan(BaseModel):
+    """Creative text for every step of the Meta Ad Campaign"""
+    campaign_name: str = Field(description="Name of the Campaign")
+    ad_set_name: str = Field(description="Name of the Ad set under the campaign")
+    creative_name: str = Field(description="A name for the ad creative that comes under the ad set")
+    ad_description: str = Field(description="A catchy one liner description for the ad")
+    ad_headline: str = Field(description="A catchy headline for the ad")
+    ad_name: str = Field(description="A name for the ad")
+
+
+# one ad copy of a multi-variant campaign
+class CopyVariant(BaseModel):
+    """Creative text of one ad variant"""
+    creative_name: str = Field(description="A name for the ad creative of this variant")
+    ad_description: str = Field(description="A catchy one liner description for the ad")
+    ad_headline: str = Field(description="A catchy headline for the ad")
+    ad_name: str = Field(description="A name for the ad of this variant")
+
+
+# structured output of the planner llm for multi-variant campaigns
+class VariantPlan(BaseModel):
+    """Creative text of a Meta Ad Campaign with several ad copy variants"""
+    campaign_name: str = Field(description="Name of the Campaign")
+    ad_set_name: str = Field(description="Name of the Ad set under the campaign")
+    copies: list[CopyVariant] = Field(description="Distinct ad copy variants to A/B test")
+
+
+def invoke_tool(tool, args: dict):
+    """ invokes the tool inside a `tool:<name>` span that records the size of the arguments and the result."""
+
+    with span(f"tool:{tool.name}", args_bytes=len(json.dumps(args, default=str))) as current:
+        result = tool.invoke(args)
+        current.set(result_bytes=len(json.dumps(result, default=str)))
+    return result
 
 
 # tool node to infer tool calls and invoke the tools with provided arguments
@@ -18,22 +81,152 @@ class BasicToolNode:
         self.tools_by_name = {tool.name: tool for tool in tools}
     
     def __call__(self, inputs: dict):
+        # the tools act on the ad account of the run
+        with use_account(inputs.get("account")):
+            return self.run_tool_calls(inputs)
+
+    async def acall(self, inputs: dict):
+        """ the node of the async graphs: the blocking sdk calls of the tools run on an executor."""
+        with use_account(inputs.get("account")):
+            return await self.arun_tool_calls(inputs)
+
+    async def arun_tool_calls(self, inputs: dict):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, contextvars.copy_context().run, self.run_tool_calls, inputs)
+
+    def prevalidate(self, tool_calls: list) -> tuple:
+        """ the tool calls whose arguments pass the args schema of their tool, with the normalized arguments,
+        and an error ToolMessage for each of the others by tool call id. The rejected calls are answered right
+        away instead of failing at the api after a round trip."""
+
+        valid, rejected = [], {}
+        for tool_call in tool_calls:
+            if (tool := self.tools_by_name.get(tool_call["name"])) is None:
+                checked, details = None, [{"field": None, "input": tool_call["name"],
+                                           "message": f"unknown tool, use one of: {', '.join(self.tools_by_name)}"}]
+            else:
+                checked, details = validate_tool_call(tool, tool_call)
+            if checked is None:
+                rejected[tool_call["id"]] = ToolMessage(
+                    content = json.dumps(rejection(tool_call, details)),
+                    name = tool_call['name'],
+                    tool_call_id = tool_call['id'],
+                    status = "error",
+                )
+            else:
+                valid.append(checked)
+        record(tool_calls=len(tool_calls), rejected_calls=len(rejected), round_trips_avoided=len(rejected))
+        return valid, rejected
+
+    def run_tool_calls(self, inputs: dict):
         if messages := inputs.get("messages", []):
             message  = messages[-1]
         else:
             raise ValueError("No message found in input")
-        outputs = []
-        for tool_call in message.tool_calls:
-            tool_result = self.tools_by_name[tool_call["name"]].invoke(
-                tool_call["args"])
-            outputs.append(
-                ToolMessage(
-                    content = json.dumps(tool_result),
-                    name = tool_call['name'],
-                    tool_call_id = tool_call['id'],
-                )
+        tool_calls, rejected = self.prevalidate(message.tool_calls)
+        outputs = dict(rejected)
+        for tool_call in tool_calls:
+            tool_result = invoke_tool(self.tools_by_name[tool_call["name"]], tool_call["args"])
+            outputs[tool_call["id"]] = ToolMessage(
+                content = json.dumps(tool_result),
+                name = tool_call['name'],
+                tool_call_id = tool_call['id'],
             )
-        return {"messages": outputs}
+        return {"messages": [outputs[tool_call["id"]] for tool_call in message.tool_calls]}
+
+
+# tool node that runs independent tool calls of the same turn concurrently
+class ConcurrentToolNode(BasicToolNode):
+    """A node that runs all the tools requested in the last AIMessage on a bounded thread pool.
+    ToolMessages keep the order of the tool calls and a failing call is reported as an error ToolMessage.
+    When a turn has several calls of the `batch_tools`, they are sent together through `batcher`, a function
+    that takes the tool calls and returns the result (or exception) of each one by tool call id."""
+
+    def __init__(self, tools: list, max_concurrency: int = 4, batcher=None, batch_tools=()) -> None:
+        super().__init__(tools)
+        self.max_concurrency = max_concurrency
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="tool")
+        self.batcher = batcher
+        self.batch_tools = set(batch_tools)
+
+    @staticmethod
+    def tool_message(tool_call: dict, tool_result) -> ToolMessage:
+        if isinstance(tool_result, Exception):
+            return ToolMessage(
+                content = json.dumps({"error": f"{type(tool_result).__name__}: {tool_result}"}),
+                name = tool_call['name'],
+                tool_call_id = tool_call['id'],
+                status = "error",
+            )
+        return ToolMessage(
+            content = json.dumps(tool_result),
+            name = tool_call['name'],
+            tool_call_id = tool_call['id'],
+        )
+
+    def run_tool_call(self, tool_call: dict):
+        try:
+            return invoke_tool(self.tools_by_name[tool_call["name"]], tool_call["args"])
+        except Exception as e:
+            return e
+
+    def run_batch(self, tool_calls: list) -> dict:
+        try:
+            with span("tool_batch", calls=len(tool_calls), tools=[tool_call["name"] for tool_call in tool_calls]):
+                return self.batcher(tool_calls)
+        except Exception as e:
+            return {tool_call["id"]: e for tool_call in tool_calls}
+
+    def partition(self, inputs: dict) -> tuple:
+        """ the tool calls of the last message: the calls run one by one, the calls sent in one batch (when
+        there are at least two batchable ones) and the error messages of the rejected calls by tool call id."""
+
+        if messages := inputs.get("messages", []):
+            message  = messages[-1]
+        else:
+            raise ValueError("No message found in input")
+        tool_calls, rejected = self.prevalidate(message.tool_calls)
+
+        batched = [tool_call for tool_call in tool_calls if tool_call["name"] in self.batch_tools]
+        if self.batcher is None or len(batched) < 2:
+            batched = []
+        batched_ids = {tool_call["id"] for tool_call in batched}
+        single = [tool_call for tool_call in tool_calls if tool_call["id"] not in batched_ids]
+        return message.tool_calls, single, batched, rejected
+
+    def run_tool_calls(self, inputs: dict):
+        all_calls, tool_calls, batched, rejected = self.partition(inputs)
+
+        # the copied context makes the tool spans children of the current span
+        futures = {
+            tool_call["id"]: self.executor.submit(contextvars.copy_context().run, self.run_tool_call, tool_call)
+            for tool_call in tool_calls
+        }
+        results = self.run_batch(batched) if batched else {}
+        results.update({tool_call_id: future.result() for tool_call_id, future in futures.items()})
+        return {"messages": self.tool_messages(all_calls, results, rejected)}
+
+    def tool_messages(self, tool_calls: list, results: dict, rejected: dict) -> list:
+        # ToolMessages are returned in the order of the tool calls
+        return [rejected[tool_call["id"]] if tool_call["id"] in rejected else
+                self.tool_message(tool_call, results[tool_call["id"]]) for tool_call in tool_calls]
+
+    async def arun_tool_calls(self, inputs: dict):
+        all_calls, tool_calls, batched, rejected = self.partition(inputs)
+
+        # the tool calls wait on the executor without blocking the event loop
+        loop = asyncio.get_running_loop()
+        pending = [
+            loop.run_in_executor(self.executor, contextvars.copy_context().run, self.run_tool_call, tool_call)
+            for tool_call in tool_calls
+        ]
+        if batched:
+            pending.append(loop.run_in_executor(self.executor, contextvars.copy_context().run, self.run_batch, batched))
+        done = await asyncio.gather(*pending)
+
+        results = done.pop() if batched else {}
+        results.update({tool_call["id"]: result for tool_call, result in zip(tool_calls, done)})
+        return {"messages": self.tool_messages(all_calls, results, rejected)}
 
 
 def route_tools(state: State):
@@ -51,7 +244,47 @@ def route_tools(state: State):
     return END
 
 
+def route_pipeline(state: PipelineState):
+    """ used in conditional_edge to hand the run over to the agentic loop if any pipeline step failed.
+    Otherwise route to the final summary."""
+
+    if state.get("errors"):
+        return "fallback"
+    return "finalize"
+
+
+def collect_ids(messages: list) -> dict:
+    """ collects the ids returned by the tools (campaign_id, ad_set_id, ...) from the ToolMessages of a run."""
+
+    ids = {}
+    for message in messages:
+        if not isinstance(message, ToolMessage):
+            continue
+        try:
+            content = json.loads(message.content)
+        except (TypeError, ValueError):
+            continue
+        if isinstance(content, dict):
+            ids.update({key: value for key, value in content.items() if key.endswith(("_id", "_hash"))})
+    return ids
+
+
+def stream_graph_events(graph, inputs: dict, config: dict = None):
+    """ streams a graph run as events: {"type": "token", "text"} for the llm text as it is generated and
+    {"type": "update", "node", "update", "elapsed"} whenever a node (also of a nested graph) completes."""
+
+    start = time.perf_counter()
+    for namespace, mode, chunk in graph.stream(inputs, config, stream_mode=["messages", "updates"], subgraphs=True):
+        if mode == "messages":
+            message, metadata = chunk
+            if isinstance(message, AIMessageChunk) and isinstance(message.content, str) and message.content:
+                yield {"type": "token", "text": message.content}
+        else:
+            for node, update in chunk.items():
+                yield {"type": "update", "node": node, "update": update or {}, "elapsed": time.perf_counter() - start}
+
+
 def stream_graph_updates(graph, user_input: str):
-    for event in graph.stream({"messages": [{"role": "user", "content": user_input}]}):
-        for value in event.values():
-            print("Assistant:", value["messages"][-1].content)
\ No newline at end of file
+    for event in stream_graph_events(graph, {"messages": [{"role": "user", "content": user_input}]}):
+        if event["type"] == "update" and event["update"].get("messages"):
+            print("Assistant:", event["update"]["messages"][-1].content)
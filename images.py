@@ -0,0 +1,256 @@
+from concurrent.futures import ThreadPoolExecutor, Future
+from rate_limiter import get_limiter
+from llm_cache import CachedLLM
+from tracing import span, annotate
+from cache import CACHE_DIR, file_digest
+from clients import get_image_llm, IMAGE_MODEL
+from dotenv import load_dotenv
+from typing import Optional
+from contextlib import contextmanager
+from PIL import Image, ImageOps
+import contextvars
+import threading
+import base64
+import uuid
+import re
+import io
+import os
+
+load_dotenv()
+
+IMAGES_DIR = "./Images"
+
+# Images are resized and re-encoded before upload. Meta recommends at least 1080px on the short side of a feed
+# creative, larger images are scaled down to it (never up). The quality is lowered in steps down to
+# IMAGE_MIN_QUALITY until the file fits IMAGE_MAX_BYTES. Set IMAGE_FORMAT= (empty) to upload the files as is.
+IMAGE_MIN_SIDE = int(os.getenv("IMAGE_MIN_SIDE", 1080))
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "JPEG").upper()
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", 90))
+IMAGE_MIN_QUALITY = int(os.getenv("IMAGE_MIN_QUALITY", 70))
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", 1 << 20))
+
+# bytes of decoded images and base64 payloads held in memory at once by the worker threads of the process,
+# a larger image waits until it can run alone
+IMAGE_MEMORY_BUDGET = int(os.getenv("IMAGE_MEMORY_BUDGET", 256 << 20))
+
+# size of the chunks images are copied and decoded in
+CHUNK_SIZE = 1 << 20
+
+# derived files by content hash of the source image and the settings
+PREPARED_DIR = os.path.join(CACHE_DIR, "prepared_images")
+EXTENSIONS = {"JPEG": ".jpg", "WEBP": ".webp", "PNG": ".png"}
+
+# background image generations, keyed by the path the image is written to
+executor = ThreadPoolExecutor(max_workers=int(os.getenv("IMAGE_WORKERS", 2)), thread_name_prefix="image")
+pending = {}
+pending_lock = threading.Lock()
+
+
+# counting semaphore over bytes instead of slots
+class MemoryBudget:
+    """Bounds the bytes reserved at the same time. `reserve(n)` blocks while the reservations of other threads
+    would exceed the budget, a reservation above the whole budget waits until it is the only one."""
+
+    def __init__(self, budget: int) -> None:
+        self.budget = budget
+        self.reserved = 0
+        self.peak = 0
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def reserve(self, size: int):
+        size = min(size, self.budget)
+        with self.condition:
+            self.condition.wait_for(lambda: self.reserved + size <= self.budget)
+            self.reserved += size
+            self.peak = max(self.peak, self.reserved)
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.reserved -= size
+                self.condition.notify_all()
+
+
+image_memory = MemoryBudget(IMAGE_MEMORY_BUDGET)
+
+
+def new_image_path(name: str = "ad_image.png") -> str:
+    """ a collision free path under IMAGES_DIR, so concurrent runs never overwrite each other's images."""
+    os.makedirs(IMAGES_DIR, exist_ok=True)
+    return os.path.join(IMAGES_DIR, f"{uuid.uuid4().hex[:12]}_{os.path.basename(name)}")
+
+
+def write_upload(upload, image_path: str, chunk_size: int = CHUNK_SIZE) -> str:
+    """ copies a file like object (e.g. a streamlit upload) to the path a chunk at a time."""
+
+    upload.seek(0)
+    with open(image_path, "wb") as f:
+        while chunk := upload.read(chunk_size):
+            f.write(chunk)
+    return image_path
+
+
+def _encode(image: Image.Image, quality: int) -> bytes:
+    buffer = io.BytesIO()
+    if IMAGE_FORMAT == "PNG":
+        image.save(buffer, "PNG", optimize=True)
+    else:
+        image.save(buffer, IMAGE_FORMAT, quality=quality, optimize=True, progressive=IMAGE_FORMAT == "JPEG")
+    return buffer.getvalue()
+
+
+def prepare_image(image_path: str) -> str:
+    """ the path of the upload ready version of the image: scaled down to the recommended size, re-encoded
+    within the quality bounds and stripped of its metadata. Derived files are cached by content hash."""
+
+    if not IMAGE_FORMAT:
+        return image_path
+
+    settings = f"{IMAGE_MIN_SIDE}-{IMAGE_FORMAT}-{IMAGE_QUALITY}-{IMAGE_MIN_QUALITY}-{IMAGE_MAX_BYTES}"
+    prepared_path = os.path.join(PREPARED_DIR, f"{file_digest(image_path)[:32]}-{settings}{EXTENSIONS[IMAGE_FORMAT]}")
+    if os.path.exists(prepared_path):
+        annotate(prepared_cache_hit=True)
+        return prepared_path
+
+    with Image.open(image_path) as source:
+        # jpegs are decoded right at a reduced scale that still covers the target size
+        source.draft("RGB", (IMAGE_MIN_SIDE, IMAGE_MIN_SIDE))
+        # the decoded pixels (4 bytes each at most) plus the resized copy, only the header is read so far
+        with image_memory.reserve(source.width * source.height * 4 * 2), \
+                span("prepare_image", format=IMAGE_FORMAT) as current:
+            current.set(source_bytes=os.path.getsize(image_path))
+            return _prepare(source, prepared_path, current)
+
+
+def _prepare(source: Image.Image, prepared_path: str, current) -> str:
+    # apply the exif rotation before the exif data is dropped
+    image = ImageOps.exif_transpose(source)
+    if min(image.size) > IMAGE_MIN_SIDE:
+        scale = IMAGE_MIN_SIDE / min(image.size)
+        image = image.resize((round(image.width * scale), round(image.height * scale)), Image.LANCZOS)
+    if IMAGE_FORMAT == "JPEG" and image.mode != "RGB":
+        # jpeg has no alpha channel, transparent pixels become white
+        background = Image.new("RGB", image.size, "white")
+        background.paste(image, mask=image.convert("RGBA").getchannel("A"))
+        image = background
+    elif image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if "transparency" in image.info or "A" in image.getbands() else "RGB")
+
+    # without its info the image is encoded without the exif, icc or text chunks of the source
+    image.info = {}
+    quality = IMAGE_QUALITY
+    data = _encode(image, quality)
+    while len(data) > IMAGE_MAX_BYTES and quality > IMAGE_MIN_QUALITY:
+        quality = max(IMAGE_MIN_QUALITY, quality - 5)
+        data = _encode(image, quality)
+
+    # written under a temporary name, concurrent runs preparing the same image never see a partial file
+    os.makedirs(PREPARED_DIR, exist_ok=True)
+    temp_path = f"{prepared_path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, prepared_path)
+    current.set(image_bytes=len(data), quality=quality, size=f"{image.width}x{image.height}")
+
+    return prepared_path
+
+
+# incremental base64 decoder
+class Base64Decoder:
+    """Decodes base64 text fed in pieces of any size. Characters outside of the base64 alphabet (line breaks)
+    are skipped and the last incomplete quantum of a piece is carried over to the next one."""
+
+    ALPHABET = re.compile(r"[^A-Za-z0-9+/=]")
+
+    def __init__(self) -> None:
+        self.carry = ""
+
+    def feed(self, text: str) -> bytes:
+        text = self.carry + self.ALPHABET.sub("", text)
+        end = len(text) - len(text) % 4
+        self.carry = text[end:]
+        return base64.b64decode(text[:end])
+
+    def close(self) -> bytes:
+        if self.carry.rstrip("="):
+            raise ValueError("truncated base64 data")
+        return b""
+
+
+def write_base64(data: str, image_path: str, chunk_size: int = CHUNK_SIZE) -> None:
+    """ decodes a base64 string (or data url) to a file a chunk at a time instead of in one big copy."""
+
+    decoder = Base64Decoder()
+    start = data.find(",", 0, 256) + 1 if data.startswith("data:") else 0
+    # the payload stays in memory until it is decoded, plus one chunk of text and bytes in flight
+    with image_memory.reserve(len(data) + 2 * chunk_size), open(image_path, "wb") as f:
+        for offset in range(start, len(data), chunk_size):
+            f.write(decoder.feed(data[offset:offset + chunk_size]))
+        f.write(decoder.close())
+
+
+# generate an ad image from a style prompt and store it at the given path
+def generate_ad_image(image_style_prompt: str, image_path: str, variant: int = 0) -> str:
+    # the variant number keeps image variants of the same prompt from sharing a cached response
+    image_llm = CachedLLM(
+        get_image_llm(),
+        model=IMAGE_MODEL,
+        settings={"variant": variant},
+        limiter=get_limiter("gemini", IMAGE_MODEL),
+    )
+    message = {
+        "role": "user",
+        "content": image_style_prompt,
+    }
+
+    with span("generate_ad_image", variant=variant) as current:
+        response = image_llm.invoke(
+            [message],
+            generation_config=dict(response_modalities=["TEXT", "IMAGE"]),
+        )
+
+        # Obtain image in base64 format from the LLM response
+        write_base64(response.content[1].get("image_url").get("url"), image_path)
+        current.set(image_bytes=os.path.getsize(image_path))
+
+    return image_path
+
+
+def start_ad_image_generation(image_style_prompt: str, image_path: str) -> Future:
+    """ starts generating the image in the background. `wait_for_image` blocks until it is written,
+    so the campaign can be created while the image is still being generated."""
+
+    key = os.path.abspath(image_path)
+    # the copied context carries settings like the cache bypass into the worker thread
+    future = executor.submit(contextvars.copy_context().run, generate_ad_image, image_style_prompt, image_path)
+    with pending_lock:
+        pending[key] = future
+    return future
+
+
+def image_available(image_path: str) -> bool:
+    """ whether the image exists or is being generated in the background. A generation that failed before
+    anyone waited for it doesn't count."""
+    with pending_lock:
+        future = pending.get(os.path.abspath(image_path))
+    if os.path.isfile(image_path):
+        return True
+    return future is not None and not (future.done() and future.exception() is not None)
+
+
+def wait_for_image(image_path: str, timeout: Optional[float] = None) -> str:
+    """ waits for a background generation of the image (if any) and raises its error if it failed."""
+
+    key = os.path.abspath(image_path)
+    with pending_lock:
+        future = pending.get(key)
+    if future is not None:
+        try:
+            future.result(timeout=timeout)
+        finally:
+            # a failed generation is dropped too, only one still running on a timeout stays pending
+            with pending_lock:
+                if future.done() and pending.get(key) is future:
+                    del pending[key]
+    return image_path
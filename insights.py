@@ -0,0 +1,340 @@
+from cache import CACHE_DIR
+from clients import get_ad_account, get_account_api
+from accounts import use_account, current_account_id, load_accounts
+from meta_batch import MetaBatch
+from rate_limiter import call_meta
+from tracing import span
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from dotenv import load_dotenv
+from typing import Optional
+import numpy as np
+import pandas as pd
+import threading
+import sqlite3
+import time
+import os
+
+load_dotenv()
+
+# Local store of the daily performance of every ad, synced from the insights of the ad accounts.
+# A sync only pulls the days after the watermark of the account (plus INSIGHTS_LOOKBACK_DAYS, since Meta keeps
+# updating the conversions of recent days), small ranges with one paged request, larger ones as async report
+# jobs that run on Meta's side in parallel. Dashboards and the agent then query the store, not the api.
+
+INSIGHTS_DB = os.getenv("INSIGHTS_DB", os.path.join(CACHE_DIR, "insights.sqlite"))
+
+# days pulled by the first sync of an account, and the recent days pulled again by every sync
+INSIGHTS_HISTORY_DAYS = int(os.getenv("INSIGHTS_HISTORY_DAYS", 90))
+INSIGHTS_LOOKBACK_DAYS = int(os.getenv("INSIGHTS_LOOKBACK_DAYS", 3))
+
+# ranges longer than INSIGHTS_SYNC_DAYS are pulled as async report jobs of up to INSIGHTS_WINDOW_DAYS each
+INSIGHTS_SYNC_DAYS = int(os.getenv("INSIGHTS_SYNC_DAYS", 7))
+INSIGHTS_WINDOW_DAYS = int(os.getenv("INSIGHTS_WINDOW_DAYS", 30))
+
+# action types counted as conversions, their action values are the revenue
+CONVERSION_ACTIONS = set(os.getenv("INSIGHTS_CONVERSION_ACTIONS", "purchase,lead").split(","))
+
+# seconds between the status checks of the report jobs, and until a job is given up
+POLL_INTERVAL = 2.0
+JOB_TIMEOUT = 900.0
+PAGE_SIZE = 500
+
+FIELDS = ["campaign_id", "campaign_name", "adset_id", "adset_name", "ad_id", "ad_name", "date_start",
+          "impressions", "reach", "clicks", "spend", "actions", "action_values"]
+
+# summed metrics of the store, the rates are derived from the sums after grouping
+METRICS = ["impressions", "reach", "clicks", "spend", "conversions", "revenue"]
+DIMENSIONS = {
+    "account": ["account_id"],
+    "campaign": ["account_id", "campaign_id", "campaign_name"],
+    "adset": ["account_id", "campaign_id", "adset_id", "adset_name"],
+    "ad": ["account_id", "adset_id", "ad_id", "ad_name"],
+    "date": ["date"],
+}
+
+COLUMNS = ["account_id", "date", "campaign_id", "campaign_name", "adset_id", "adset_name", "ad_id", "ad_name",
+           *METRICS]
+
+
+# daily insights of the ads in a SQLite table, clustered by account and date
+class InsightsStore:
+    """One row per (account, date, ad), upserted so pulling a day again replaces it. The table is stored in
+    primary key order (WITHOUT ROWID), so date range scans of an account read contiguous pages, and indexed by
+    campaign and ad set for the drill downs. `watermarks` keeps the last day synced per account."""
+
+    def __init__(self, path: str = INSIGHTS_DB) -> None:
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS insights (account_id TEXT, date TEXT, campaign_id TEXT, "
+                "campaign_name TEXT, adset_id TEXT, adset_name TEXT, ad_id TEXT, ad_name TEXT, "
+                "impressions INTEGER, reach INTEGER, clicks INTEGER, spend REAL, conversions REAL, revenue REAL, "
+                "PRIMARY KEY (account_id, date, ad_id)) WITHOUT ROWID"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS insights_campaign ON insights (campaign_id, date)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS insights_adset ON insights (adset_id, date)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS watermarks (account_id TEXT PRIMARY KEY, until TEXT, synced REAL)"
+            )
+
+    def watermark(self, account_id: str) -> Optional[date]:
+        with self.lock:
+            row = self.conn.execute("SELECT until FROM watermarks WHERE account_id = ?", (account_id,)).fetchone()
+        return date.fromisoformat(row[0]) if row else None
+
+    def upsert(self, account_id: str, rows: list, until: Optional[date] = None) -> None:
+        """ stores the rows of the account, and moves its watermark to `until` in the same transaction."""
+        with self.lock, self.conn:
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO insights ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                [tuple(row[column] for column in COLUMNS) for row in rows],
+            )
+            if until:
+                self.conn.execute("INSERT OR REPLACE INTO watermarks VALUES (?, ?, ?)",
+                                  (account_id, until.isoformat(), time.time()))
+
+    def query(self, account_ids: Optional[list] = None, since: Optional[date] = None, until: Optional[date] = None,
+              campaign_id: Optional[str] = None, adset_ids: Optional[list] = None) -> pd.DataFrame:
+        """ the daily rows matching the filters as a DataFrame, with numeric metric columns."""
+
+        clauses, params = [], []
+        if account_ids:
+            clauses.append(f"account_id IN ({', '.join('?' * len(account_ids))})")
+            params += list(account_ids)
+        if since:
+            clauses.append("date >= ?")
+            params.append(since.isoformat())
+        if until:
+            clauses.append("date <= ?")
+            params.append(until.isoformat())
+        if campaign_id:
+            clauses.append("campaign_id = ?")
+            params.append(campaign_id)
+        if adset_ids:
+            clauses.append(f"adset_id IN ({', '.join('?' * len(adset_ids))})")
+            params += list(adset_ids)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self.lock:
+            frame = pd.read_sql_query(f"SELECT {', '.join(COLUMNS)} FROM insights{where}", self.conn, params=params)
+        frame["date"] = pd.to_datetime(frame["date"])
+        frame[METRICS] = frame[METRICS].astype("float64")
+        return frame
+
+    def status(self) -> list:
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT w.account_id, w.until, w.synced, COUNT(i.ad_id) FROM watermarks w "
+                "LEFT JOIN insights i ON i.account_id = w.account_id GROUP BY w.account_id"
+            ).fetchall()
+        return [{"account_id": account_id, "until": until, "synced": synced, "rows": count}
+                for account_id, until, synced, count in rows]
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store() -> InsightsStore:
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = InsightsStore()
+        return _store
+
+
+def parse_row(account_id: str, row) -> dict:
+    """ the store row of an insights row of the api."""
+
+    actions = {action["action_type"]: float(action["value"]) for action in row.get("actions") or []}
+    values = {action["action_type"]: float(action["value"]) for action in row.get("action_values") or []}
+    return {
+        "account_id": account_id,
+        "date": row["date_start"],
+        "campaign_id": row.get("campaign_id"),
+        "campaign_name": row.get("campaign_name"),
+        "adset_id": row.get("adset_id"),
+        "adset_name": row.get("adset_name"),
+        "ad_id": row["ad_id"],
+        "ad_name": row.get("ad_name"),
+        "impressions": int(row.get("impressions") or 0),
+        "reach": int(row.get("reach") or 0),
+        "clicks": int(row.get("clicks") or 0),
+        "spend": float(row.get("spend") or 0),
+        "conversions": sum(actions.get(action, 0.0) for action in CONVERSION_ACTIONS),
+        "revenue": sum(values.get(action, 0.0) for action in CONVERSION_ACTIONS),
+    }
+
+
+def report_params(since: date, until: date) -> dict:
+    return {
+        "level": "ad",
+        "time_increment": 1,
+        "time_range": {"since": since.isoformat(), "until": until.isoformat()},
+        "limit": PAGE_SIZE,
+    }
+
+
+def date_windows(since: date, until: date, days: int) -> list:
+    """ the (since, until) ranges of at most `days` days covering since..until."""
+    windows, start = [], since
+    while start <= until:
+        end = min(start + timedelta(days=days - 1), until)
+        windows.append((start, end))
+        start = end + timedelta(days=1)
+    return windows
+
+
+def read_pages(account_id: str, path: tuple, params: dict) -> list:
+    """ the rows of all the pages of a graph api edge. The pages are read as plain json, building an sdk
+    object per row costs more than the request, and a failed page is retried on its own."""
+
+    api = get_account_api(account_id)
+    params, rows = dict(params), []
+    while True:
+        page = call_meta(lambda: api.call("GET", path, params=dict(params)).json(), account_id)
+        rows += page.get("data", [])
+        if "next" not in page.get("paging", {}):
+            return rows
+        params["after"] = page["paging"]["cursors"]["after"]
+
+
+def read_insights(account_id: str, path: tuple, params: dict) -> list:
+    rows = read_pages(account_id, path, {**params, "fields": ",".join(FIELDS)})
+    return [parse_row(account_id, row) for row in rows]
+
+
+def fetch_insights(account_id: str, since: date, until: date) -> list:
+    """ the rows of a short range with one paged request."""
+    return read_insights(account_id, (account_id, "insights"), report_params(since, until))
+
+
+def fetch_insights_async(account_id: str, windows: list):
+    """ starts an async report job per window and yields the rows of every job as soon as it is completed.
+    The jobs run on Meta's side at the same time, their status is polled with one batch request."""
+
+    account = get_ad_account(account_id)
+    jobs = set()
+    for since, until in windows:
+        job = call_meta(lambda: account.get_insights(fields=FIELDS, params=report_params(since, until),
+                                                     is_async=True), account_id)
+        jobs.add(job.get_id())
+
+    deadline = time.monotonic() + JOB_TIMEOUT
+    while jobs:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"insights report jobs {', '.join(jobs)} of {account_id} not completed")
+        time.sleep(POLL_INTERVAL)
+        batch = MetaBatch()
+        names = {batch.add("GET", job_id, {"fields": "async_status,async_percent_completion"}): job_id
+                 for job_id in jobs}
+        for name, response in batch.execute().items():
+            if isinstance(response, Exception):
+                # the status is checked again with the next poll
+                continue
+            if response.get("async_status") in ("Job Failed", "Job Skipped"):
+                raise RuntimeError(f"insights report job {names[name]} of {account_id}: {response['async_status']}")
+            if response.get("async_status") == "Job Completed":
+                jobs.discard(names[name])
+                yield read_insights(account_id, (names[name], "insights"), {"limit": PAGE_SIZE})
+
+
+def sync_account(account_id: Optional[str] = None, store: Optional[InsightsStore] = None,
+                 today: Optional[date] = None) -> dict:
+    """ pulls the insights of the account (the current one by default) since its watermark into the store."""
+
+    account_id = account_id or current_account_id()
+    store = store or get_store()
+    until = today or date.today()
+    watermark = store.watermark(account_id)
+    if watermark:
+        since = min(watermark, until) - timedelta(days=INSIGHTS_LOOKBACK_DAYS)
+    else:
+        since = until - timedelta(days=INSIGHTS_HISTORY_DAYS - 1)
+    days = (until - since).days + 1
+    is_async = days > INSIGHTS_SYNC_DAYS
+
+    with use_account(account_id), span("insights_sync", account=account_id, days=days, is_async=is_async) as current:
+        if is_async:
+            count = 0
+            for rows in fetch_insights_async(account_id, date_windows(since, until, INSIGHTS_WINDOW_DAYS)):
+                store.upsert(account_id, rows)
+                count += len(rows)
+            # the watermark only moves once every window is stored, an interrupted sync starts over
+            store.upsert(account_id, [], until)
+        else:
+            rows = fetch_insights(account_id, since, until)
+            store.upsert(account_id, rows, until)
+            count = len(rows)
+        current.set(rows=count)
+    return {"account_id": account_id, "since": since.isoformat(), "until": until.isoformat(), "rows": count,
+            "is_async": is_async}
+
+
+def sync_all(account_ids: Optional[list] = None, workers: int = 4) -> list:
+    """ syncs the accounts (all registered ones by default) in parallel."""
+
+    account_ids = account_ids or list(load_accounts())
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(sync_account, account_ids))
+
+
+# vectorized aggregation of the daily rows, used by the insights page and the agent tool
+
+def aggregate(frame: pd.DataFrame, by: str = "campaign") -> pd.DataFrame:
+    """ sums the metrics per campaign, ad set, ad, account or date and adds the rates computed from the sums."""
+
+    keys = DIMENSIONS[by]
+    # the names of an object can change over time, the ids are grouped on and the last name is kept
+    names = [key for key in keys if key.endswith("_name")]
+    ids = [key for key in keys if key not in names]
+    grouped = frame.groupby(ids, sort=False)
+    totals = grouped[METRICS].sum()
+    if names:
+        totals = totals.join(grouped[names].last())
+    return add_rates(totals.reset_index()[[*keys, *METRICS]])
+
+
+def ratio(numerator, denominator, scale: float = 1.0) -> np.ndarray:
+    """ numerator / denominator * scale element wise, 0 where the denominator is 0."""
+    numerator, denominator = np.asarray(numerator, dtype="float64"), np.asarray(denominator, dtype="float64")
+    return np.divide(numerator * scale, denominator, out=np.zeros_like(numerator), where=denominator > 0)
+
+
+def add_rates(frame: pd.DataFrame) -> pd.DataFrame:
+    """ ctr and conversion rate in percent, cpc, cpm, cost per conversion and roas of summed metrics."""
+
+    frame = frame.copy()
+    frame["ctr"] = ratio(frame["clicks"], frame["impressions"], 100)
+    frame["cpc"] = ratio(frame["spend"], frame["clicks"])
+    frame["cpm"] = ratio(frame["spend"], frame["impressions"], 1000)
+    frame["cvr"] = ratio(frame["conversions"], frame["clicks"], 100)
+    frame["cpa"] = ratio(frame["spend"], frame["conversions"])
+    frame["roas"] = ratio(frame["revenue"], frame["spend"])
+    return frame
+
+
+def performance(by: str = "campaign", days: int = 7, account_ids: Optional[list] = None,
+                campaign_id: Optional[str] = None, top: Optional[int] = None) -> pd.DataFrame:
+    """ the aggregated metrics of the last `days` days from the store, by spend."""
+
+    since = date.today() - timedelta(days=days - 1)
+    frame = aggregate(get_store().query(account_ids, since=since, campaign_id=campaign_id), by)
+    frame = frame.sort_values("spend", ascending=False) if by != "date" else frame.sort_values("date")
+    return frame.head(top) if top else frame
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Sync the insights of the ad accounts into the local store.")
+    parser.add_argument("--accounts", nargs="*", help="account ids, all registered accounts by default")
+    parser.add_argument("--workers", type=int, default=4, help="accounts synced in parallel")
+    args = parser.parse_args()
+
+    for result in sync_all(args.accounts, args.workers):
+        print(result)
+    print(performance(by="campaign", days=INSIGHTS_LOOKBACK_DAYS + 4).to_string(index=False))
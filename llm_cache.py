@@ -0,0 +1,131 @@
+from langchain_core.messages import BaseMessage, convert_to_messages, messages_from_dict, messages_to_dict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pydantic import BaseModel
+from cache import SqliteCache
+from tracing import annotate, count
+from rate_limiter import call_with_retries, acall_with_retries, gemini_error_kind
+from dotenv import load_dotenv
+from typing import Optional
+import hashlib
+import json
+import os
+
+load_dotenv()
+
+# responses of the llms keyed on the normalized prompt, model and settings
+response_cache = SqliteCache(
+    "llm_responses",
+    ttl=float(os.getenv("LLM_CACHE_TTL", 24 * 3600)),
+    max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", 1000)),
+)
+
+# set LLM_CACHE_BYPASS=1 (or use `bypass_cache`) to always call the llm
+cache_bypass = ContextVar("cache_bypass", default=os.getenv("LLM_CACHE_BYPASS", "") == "1")
+
+
+@contextmanager
+def bypass_cache(bypass: bool = True):
+    """ skips the response cache for the llm calls made inside the block."""
+    token = cache_bypass.set(bypass)
+    try:
+        yield
+    finally:
+        cache_bypass.reset(token)
+
+
+def normalize_content(content):
+    if isinstance(content, str):
+        return " ".join(content.split())
+    if isinstance(content, list):
+        return [normalize_content(part) for part in content]
+    if isinstance(content, dict):
+        return {key: normalize_content(value) for key, value in content.items()}
+    return content
+
+
+def cache_key(messages, model: str, settings: dict) -> str:
+    """ hash of the prompt with whitespace collapsed and the random tool call ids left out,
+    so the same form inputs give the same key."""
+
+    if isinstance(messages, str):
+        messages = [{"role": "user", "content": messages}]
+    normalized = []
+    for message in convert_to_messages(messages):
+        normalized.append({
+            "type": message.type,
+            "content": normalize_content(message.content),
+            "tool_calls": [[call["name"], call["args"]] for call in getattr(message, "tool_calls", [])],
+        })
+    payload = json.dumps({"model": model, "settings": settings, "messages": normalized}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+# drop in wrapper around an llm runnable that serves repeated prompts from the response cache
+class CachedLLM:
+    """Calls `runnable.invoke` only for prompts that are not in the response cache. Message responses are stored
+    as message dicts, structured output is stored as the dump of `output_model`. `limiter` is only acquired
+    when the llm is actually called, and throttled or failed calls are retried through it."""
+
+    def __init__(self, runnable, model: str, settings: Optional[dict] = None,
+                 output_model: Optional[type[BaseModel]] = None, limiter=None, cache: SqliteCache = response_cache) -> None:
+        self.runnable = runnable
+        self.model = model
+        self.settings = settings or {}
+        self.output_model = output_model
+        self.limiter = limiter
+        self.cache = cache
+
+    def invoke(self, messages, **kwargs):
+        key = cache_key(messages, self.model, {**self.settings, **kwargs})
+        if (cached := self.lookup(key)) is not None:
+            return self.load(cached)
+
+        if self.limiter is not None:
+            # 429s and server errors are retried with backoff, throttling slows the limiter down
+            response = call_with_retries(
+                lambda: self.runnable.invoke(messages, **kwargs), self.limiter, gemini_error_kind)
+        else:
+            response = self.runnable.invoke(messages, **kwargs)
+        self.store(key, response)
+        return response
+
+    async def ainvoke(self, messages, **kwargs):
+        """ `invoke` for the async graphs: the llm call and the limiter waits don't block the event loop."""
+
+        key = cache_key(messages, self.model, {**self.settings, **kwargs})
+        if (cached := self.lookup(key)) is not None:
+            return self.load(cached)
+
+        if self.limiter is not None:
+            response = await acall_with_retries(
+                lambda: self.runnable.ainvoke(messages, **kwargs), self.limiter, gemini_error_kind)
+        else:
+            response = await self.runnable.ainvoke(messages, **kwargs)
+        self.store(key, response)
+        return response
+
+    def lookup(self, key: str):
+        if not cache_bypass.get() and (cached := self.cache.get(key)) is not None:
+            annotate(model=self.model, cache_hit=True)
+            return cached
+        annotate(model=self.model, cache_hit=False)
+        return None
+
+    def store(self, key: str, response) -> None:
+        # token usage reported by the model, structured output has none
+        if usage := getattr(response, "usage_metadata", None):
+            count(input_tokens=usage.get("input_tokens", 0), output_tokens=usage.get("output_tokens", 0))
+        self.cache.set(key, self.dump(response))
+
+    def dump(self, response):
+        if isinstance(response, BaseMessage):
+            return messages_to_dict([response])[0]
+        if isinstance(response, BaseModel):
+            return response.model_dump()
+        return response
+
+    def load(self, cached):
+        if self.output_model is not None:
+            return self.output_model.model_validate(cached)
+        return messages_from_dict([cached])[0]
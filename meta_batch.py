@@ -0,0 +1,166 @@
+from rate_limiter import MAX_RETRIES, meta_limiter, meta_error_kind, meta_create_error_kind, backoff_delay
+from clients import get_account_api
+from tracing import span
+from typing import Optional
+import time
+import json
+import re
+
+# max number of calls graph api accepts in one batch request
+BATCH_LIMIT = 50
+
+# reference to the result of an earlier call of the same batch, e.g. {result=campaign:$.id}
+RESULT_REF = re.compile(r"\{result=([\w-]+):\$\.(\w+)\}")
+
+
+# collects graph api calls and sends them in batch requests
+class MetaBatch:
+    """Collects Graph API calls and sends them in batch requests of up to 50 calls.
+    A call can use the id created by an earlier call through `MetaBatch.ref(name)`. References inside one
+    batch request are resolved by graph api, references to calls of an earlier batch request are filled in
+    before sending. Calls whose dependency failed are not sent. Sending waits for the rate limiter of the
+    ad account, and throttled or transiently failed calls are resent. Calls creating an object (a POST to an
+    edge like act_1/campaigns) are only resent when they were throttled, as a call without a response or with
+    a server error may have created the object. An error of the whole batch request counts as the error of
+    every call sent in it."""
+
+    def __init__(self, api=None) -> None:
+        self.api = api or get_account_api()
+        self.calls = []
+
+    def __len__(self) -> int:
+        return len(self.calls)
+
+    @staticmethod
+    def ref(name: str, field: str = "id") -> str:
+        return f"{{result={name}:$.{field}}}"
+
+    def add(self, method: str, path: str, params: Optional[dict] = None, name: Optional[str] = None) -> str:
+        """ queues a call and returns its name, which can be used in `MetaBatch.ref` by later calls."""
+
+        name = name or f"call_{len(self.calls)}"
+        self.calls.append({"name": name, "method": method, "path": path, "params": params or {}})
+        return name
+
+    def execute(self, max_retries: int = MAX_RETRIES) -> dict:
+        """ sends all queued calls and returns the response body (or a FacebookRequestError) of each call by name.
+        Calls that were throttled, failed transiently or got no response, alone or with the whole batch request,
+        are resent with jittered backoff, creates only when throttled or never sent."""
+
+        # the sdk is imported lazily like in clients.py, it is loaded by the time a batch is sent
+        from facebook_business.exceptions import FacebookRequestError
+        from requests import RequestException
+
+        results = {}
+        limiter = meta_limiter()
+        for start in range(0, len(self.calls), BATCH_LIMIT):
+            pending = self.calls[start:start + BATCH_LIMIT]
+            with span("meta_batch", calls=len(pending)) as current:
+                for attempt in range(max_retries + 1):
+                    if attempt:
+                        current.add(retries=1)
+                    current.add(throttled_ms=limiter.acquire() * 1000)
+                    chunk = self._resolve_calls(pending, results)
+                    try:
+                        self._execute_chunk(chunk, results)
+                    except (FacebookRequestError, RequestException) as e:
+                        # a throttled request ran none of the calls, after a timeout or a server error it is
+                        # unknown which ran, so the creates are only resent when throttled or unsent
+                        for call in chunk:
+                            results.setdefault(call["name"], e)
+                    pending, kinds = self._retryable(pending, results, last_attempt=attempt == max_retries)
+                    if not pending:
+                        limiter.recover()
+                        break
+                    delay = backoff_delay(attempt)
+                    if "throttle" in kinds:
+                        limiter.slow_down()
+                        limiter.pause(delay)
+                    else:
+                        time.sleep(delay)
+                current.set(errors=sum(isinstance(results[call["name"]], Exception)
+                                       for call in self.calls[start:start + BATCH_LIMIT]))
+        return results
+
+    def _resolve_calls(self, calls: list, results: dict) -> list:
+        resolved = []
+        for call in calls:
+            try:
+                params = self._resolve(call["params"], results)
+            except KeyError as e:
+                results[call["name"]] = RuntimeError(f"dependency {e} of {call['name']} failed")
+                continue
+            resolved.append({**call, "params": params})
+        return resolved
+
+    @staticmethod
+    def _retryable(calls: list, results: dict, last_attempt: bool) -> tuple:
+        """ the calls to resend and the kinds of their errors. Calls that failed because a call they reference
+        is resent are resent with it. On the last attempt calls without a response are marked as failed."""
+
+        kinds, retry = set(), set()
+        for call in calls:
+            result, creates = results.get(call["name"]), MetaBatch.creates(call)
+            if result is None:
+                if creates:
+                    results[call["name"]] = RuntimeError(f"no response for {call['name']}, it may have been created")
+                    continue
+                kind = "transient"
+            elif isinstance(result, Exception):
+                kind = meta_create_error_kind(result) if creates else meta_error_kind(result)
+            else:
+                continue
+            references = {name for name, _ in RESULT_REF.findall(json.dumps(call["params"]))}
+            if kind:
+                kinds.add(kind)
+                retry.add(call["name"])
+            elif references & retry:
+                retry.add(call["name"])
+
+        if last_attempt:
+            for call in calls:
+                results.setdefault(call["name"], RuntimeError(f"no response for {call['name']}"))
+            return [], kinds
+        for name in retry:
+            results.pop(name, None)
+        return [call for call in calls if call["name"] in retry], kinds
+
+    @staticmethod
+    def creates(call: dict) -> bool:
+        """ whether the call creates an object, updates of an object (a POST to its id) are idempotent."""
+        return call["method"] == "POST" and "/" in call["path"].strip("/")
+
+    @staticmethod
+    def _resolve(params: dict, results: dict) -> dict:
+        """ fills in references to calls that already ran in an earlier batch request."""
+
+        def substitute(match):
+            name, field = match.groups()
+            if name not in results:
+                # the call is part of the same batch request, graph api resolves it
+                return match.group(0)
+            result = results[name]
+            if isinstance(result, Exception):
+                raise KeyError(name)
+            return str(result[field])
+
+        return json.loads(RESULT_REF.sub(substitute, json.dumps(params)))
+
+    def _execute_chunk(self, chunk: list, results: dict) -> None:
+        if not chunk:
+            return
+        batch = self.api.new_batch()
+        for call in chunk:
+            entry = batch.add(
+                call["method"],
+                call["path"],
+                params=call["params"],
+                success=lambda response, name=call["name"]: results.__setitem__(name, response.json()),
+                failure=lambda response, name=call["name"]: results.__setitem__(name, response.error()),
+            )
+            # name the call so later calls of the batch can reference its result
+            entry["name"] = call["name"]
+            entry["omit_response_on_success"] = False
+
+        # calls that got no response (e.g. timed out on the server) are left out of the results
+        batch.execute()
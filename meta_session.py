@@ -0,0 +1,131 @@
+from requests.adapters import HTTPAdapter, BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.exceptions import ConnectionError as RequestsConnectionError, ConnectTimeout, ReadTimeout
+from requests import Response
+from urllib3.connection import HTTPConnection
+from rate_limiter import record_meta_usage
+from dotenv import load_dotenv
+import threading
+import socket
+import ssl
+import os
+
+load_dotenv()
+
+# Pooled http sessions for the meta sdk. The default FacebookSession opens a requests session with the default
+# pool of 10 connections, so with more worker threads connections are set up and torn down for every call.
+
+# max open connections per session, should be at least the number of threads calling the api
+POOL_SIZE = int(os.getenv("META_POOL_SIZE", 32))
+
+# seconds to connect and to wait for a response (image uploads can take a while)
+TIMEOUT = (float(os.getenv("META_CONNECT_TIMEOUT", 10)), float(os.getenv("META_READ_TIMEOUT", 120)))
+
+# set META_HTTP2=1 to send the requests over http/2 through httpx (pip install "httpx[http2]")
+HTTP2 = os.getenv("META_HTTP2", "") == "1"
+
+
+# requests adapter with a connection pool sized for the worker threads
+class KeepAliveAdapter(HTTPAdapter):
+    """Keeps up to `pool_size` connections alive per host with TCP keep-alive enabled, so idle connections
+    between batch rows are not dropped by the network. Threads wait for a free connection instead of
+    opening extra ones that would be thrown away. Retries are left to the rate limiter."""
+
+    def __init__(self, pool_size: int = POOL_SIZE) -> None:
+        super().__init__(pool_connections=4, pool_maxsize=pool_size, pool_block=True, max_retries=0)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        super().init_poolmanager(*args, **kwargs)
+
+
+# requests adapter that sends the requests over http/2 with httpx
+class Http2Adapter(BaseAdapter):
+    """Multiplexes the requests of all threads over a few http/2 connections. Needs httpx with the
+    http2 extra installed. The tls settings and proxy of a request are those of its httpx client, so there is
+    a client per combination of them (usually just one). httpx errors are raised as the requests errors
+    the sdk and the rate limiter expect."""
+
+    def __init__(self, pool_size: int = POOL_SIZE) -> None:
+        super().__init__()
+        import httpx
+
+        self.httpx = httpx
+        self.pool_size = pool_size
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def get_client(self, verify=True, cert=None, proxy=None):
+        key = (verify, cert, proxy)
+        with self.lock:
+            if key not in self.clients:
+                self.clients[key] = self.httpx.Client(
+                    http2=True,
+                    verify=ssl_context(verify, cert),
+                    proxy=proxy,
+                    limits=self.httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+                )
+            return self.clients[key]
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None) -> Response:
+        if isinstance(timeout, tuple):
+            timeout = self.httpx.Timeout(timeout[1], connect=timeout[0])
+        proxies = proxies or {}
+        client = self.get_client(verify, tuple(cert) if isinstance(cert, list) else cert,
+                                 proxies.get("https") or proxies.get("all"))
+        try:
+            reply = client.request(
+                request.method, request.url, headers=dict(request.headers), content=request.body, timeout=timeout,
+            )
+        except self.httpx.TimeoutException as e:
+            # connect and pool timeouts mean the request was never sent
+            unsent = isinstance(e, (self.httpx.ConnectTimeout, self.httpx.PoolTimeout))
+            raise (ConnectTimeout if unsent else ReadTimeout)(f"{type(e).__name__}: {e}", request=request) from e
+        except self.httpx.TransportError as e:
+            raise RequestsConnectionError(f"{type(e).__name__}: {e}", request=request) from e
+
+        response = Response()
+        response.status_code = reply.status_code
+        response.reason = reply.reason_phrase
+        response.headers = CaseInsensitiveDict(reply.headers)
+        response._content = reply.content
+        response.encoding = reply.encoding
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self) -> None:
+        with self.lock:
+            for client in self.clients.values():
+                client.close()
+            self.clients.clear()
+
+
+def ssl_context(verify, cert):
+    """ the httpx `verify` of the requests `verify` (a bool or a ca bundle path) and `cert` (a path or a
+    (cert, key) pair)."""
+
+    if verify is True and not cert:
+        return True
+    if isinstance(verify, str):
+        context = ssl.create_default_context(**{"capath" if os.path.isdir(verify) else "cafile": verify})
+    else:
+        context = ssl.create_default_context()
+    if verify is False:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    if cert:
+        context.load_cert_chain(*((cert,) if isinstance(cert, str) else cert))
+    return context
+
+
+def create_session(access_token: str, app_id: str = None, app_secret: str = None, pool_size: int = POOL_SIZE,
+                   timeout: tuple = TIMEOUT, http2: bool = HTTP2):
+    """ a FacebookSession with a pooled (or http/2) transport and the usage headers wired to the rate limiters."""
+    from facebook_business.session import FacebookSession
+
+    session = FacebookSession(app_id, app_secret, access_token, timeout=timeout)
+    session.requests.mount("https://", Http2Adapter(pool_size) if http2 else KeepAliveAdapter(pool_size))
+    # the rate limiters adapt to the usage headers of every graph api response
+    session.requests.hooks["response"].append(record_meta_usage)
+    return session
@@ -0,0 +1,56 @@
+from insights import get_store, sync_all, aggregate, add_rates, METRICS, DIMENSIONS
+from accounts import load_accounts
+from datetime import date, timedelta
+import streamlit as st
+
+# Performance of the ads from the local insights store, the metrics are aggregated with pandas / numpy
+# over the daily rows so the page stays fast for thousands of ads. "Sync" pulls the new days from Meta.
+
+st.set_page_config(layout="wide")
+st.subheader("Campaign Insights", divider="gray")
+
+
+@st.cache_data(ttl=300, show_spinner=False)
+def load_rows(account_ids: tuple, since: date, until: date):
+    return get_store().query(list(account_ids), since=since, until=until)
+
+
+accounts = load_accounts()
+controls = st.columns([0.4, 0.2, 0.2, 0.2])
+account_ids = controls[0].multiselect("Ad Accounts", list(accounts), default=list(accounts),
+                                      format_func=lambda a: accounts[a]["name"])
+days = controls[1].selectbox("Period", [7, 14, 30, 90], format_func=lambda d: f"Last {d} days")
+level = controls[2].selectbox("Group by", [by for by in DIMENSIONS if by != "date"], index=1)
+
+if controls[3].button("Sync from Meta", use_container_width=True):
+    with st.spinner("Pulling insights..."):
+        results = sync_all(account_ids)
+    load_rows.clear()
+    st.toast(f"Synced {sum(result['rows'] for result in results)} rows")
+
+until = date.today()
+rows = load_rows(tuple(account_ids), until - timedelta(days=days - 1), until)
+
+if rows.empty:
+    st.info("No insights stored for these accounts yet, sync them from Meta first.")
+else:
+    # totals of the period, the rates are computed from the summed metrics
+    totals = add_rates(rows[METRICS].sum().to_frame().T).iloc[0]
+    kpis = st.columns(6)
+    kpis[0].metric("Spend", f"${totals['spend']:,.2f}")
+    kpis[1].metric("Impressions", f"{totals['impressions']:,.0f}")
+    kpis[2].metric("Clicks", f"{totals['clicks']:,.0f}")
+    kpis[3].metric("CTR", f"{totals['ctr']:.2f}%")
+    kpis[4].metric("Conversions", f"{totals['conversions']:,.0f}")
+    kpis[5].metric("ROAS", f"{totals['roas']:.2f}")
+
+    daily = aggregate(rows, "date").sort_values("date").set_index("date")
+    charts = st.columns(2)
+    charts[0].line_chart(daily[["spend", "revenue"]])
+    charts[1].line_chart(daily[["ctr", "cvr"]])
+
+    table = aggregate(rows, level).sort_values("spend", ascending=False)
+    st.dataframe(table, hide_index=True, use_container_width=True)
+
+with st.expander("Sync status"):
+    st.dataframe(get_store().status(), hide_index=True)
@@ -1,3 +1,6 @@
+import json
+
+
 def generate_campaign_prompt(
     brand_name,
     product_name,
@@ -10,8 +13,11 @@ def generate_campaign_prompt(
     landing_page,
     call_to_action,
     image_path,
-    age_min, age_max, tone, gender, interests
+    age_min, age_max, tone, gender, interests,
+    country="", targeting=None
 ):
+    # the targeting spec resolved from the audience fields (see targeting.targeting_spec) is passed on as is
+    targeting_arg = f"\n   - targeting = '{json.dumps(targeting)}'" if targeting else ""
     return f"""
     
 You are a campaign automation agent for Meta Ads. Extract only the required fields needed for each tool call from the data provided below as per the
@@ -35,14 +41,14 @@ Using the provided inputs, generate a complete Facebook ad campaign by calling t
    - start_date = "{start_date}"
    - end_date = "{end_date}"
    - age_min = {age_min}
-   - age_max = {age_max}
+   - age_max = {age_max}{targeting_arg}
 
 3. Create a creative using `make_ad_creative` with:
    - ad_creative_name = <Give an appropriate name to generate ad creative>
    - page_id = "{page_id}"
    - ad_description = <Give a good description for ad creative based on the decription: {brand_description}"
    - landing_page_url = "{landing_page}"
-   - ad_headline = <Give a catchy headline based on brand name: {brand_name}, product name: {product_name} & description: {brand_description}>
+   - headline = <Give a catchy headline based on brand name: {brand_name}, product name: {product_name} & description: {brand_description}>
    - call_to_action = "{call_to_action}"
    - image_path = "{image_path}"
 
@@ -52,12 +58,60 @@ Using the provided inputs, generate a complete Facebook ad campaign by calling t
    - creative_id = <use creative ID from step 3>
 
 Make sure each step passes its output (like campaign_id, ad_set_id, creative_id) correctly to the next step.
+Tool calls that don't depend on each other's output (like uploading the image with `make_ad_image` to get the image_hash and
+creating the campaign) can be requested together in the same turn.
 
 Pause the ad after creation. Output the final ad ID at the end. 
 Or Ask for valid credentials if not provided.
 """
 
 
+# prompt for the fast-path pipeline: a single llm call writes all the creative text and
+# the tools are then executed without going back to the llm
+def generate_plan_prompt(
+    brand_name,
+    product_name,
+    campaign_goal,
+    brand_description,
+    call_to_action,
+    tone, gender, interests,
+    **kwargs
+):
+    return f"""
+
+You are a copywriter for Meta Ads. Write the creative text for a complete Facebook ad campaign in one go.
+
+Brand details:
+ - Brand name: {brand_name}
+ - Product name: {product_name}
+ - Brand description: {brand_description}
+ - Campaign objective: {campaign_goal}
+ - Call to action: {call_to_action}
+
+Keep this user preferences in mind when creating creative elements:
+ - Tone of the content: {tone}
+ - Gender for which the ad content is created: {gender}
+ - Interest of the target audience: {interests}
+
+Provide:
+ - campaign_name: an appropriate name based on the brand name, product name & campaign objective
+ - ad_set_name: an appropriate name for the ad set
+ - creative_name: an appropriate name for the ad creative
+ - ad_description: a good one liner description for the ad based on the brand description
+ - ad_headline: a catchy headline based on the brand name, product name & description
+ - ad_name: an appropriate name for the ad
+"""
+
+
+# prompt for multi-variant campaigns: one llm call writes several distinct ad copies to A/B test
+def generate_variants_prompt(n_copies, **inputs):
+    return generate_plan_prompt(**inputs) + f"""
+Instead of a single creative, write {n_copies} distinct ad copy variants in `copies`, each with its own
+creative_name, ad_description, ad_headline and ad_name. Vary the angle of each copy so they can be A/B tested
+against each other.
+"""
+
+
 
 # Optional Prompt Templates 
 
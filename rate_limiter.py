@@ -0,0 +1,302 @@
+from tracing import count
+from accounts import current_account_id
+from dotenv import load_dotenv
+from typing import Optional
+import threading
+import asyncio
+import random
+import time
+import json
+import re
+import os
+
+load_dotenv()
+
+# rate a limiter without a configured rate falls back to once the api reports throttling
+THROTTLED_RPS = float(os.getenv("THROTTLED_RPS", 2))
+
+# retries of a throttled or transiently failing api call, with jittered exponential backoff
+MAX_RETRIES = int(os.getenv("RETRY_MAX", 4))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", 1.0))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", 60.0))
+
+
+# token bucket shared by every thread of the process
+class RateLimiter:
+    """Allows `rate` calls per second on average with bursts of up to `burst` calls.
+    A limiter without a rate never blocks until the api reports throttling.
+    The rate adapts to the api: `report_usage` scales it down as the reported usage approaches 100%,
+    `slow_down` halves it after a throttling error and every successful call wins back a quarter of it.
+    A limiter with a `parent` (e.g. one ad account under the meta limiter) also waits for the parent."""
+
+    def __init__(self, rate: Optional[float] = None, burst: int = 1, parent: Optional["RateLimiter"] = None) -> None:
+        self.lock = threading.Lock()
+        self.parent = parent
+        self.scale = 1.0
+        self.blocked_until = 0.0
+        self.configure(rate, burst)
+
+    def configure(self, rate: Optional[float], burst: int = 1) -> None:
+        with self.lock:
+            self.rate = rate
+            self.burst = max(burst, 1)
+            self.tokens = float(self.burst)
+            self.updated = time.monotonic()
+
+    def current_rate(self) -> Optional[float]:
+        """ the rate after adapting to the api, None for no limit."""
+        if self.scale >= 1:
+            return self.rate
+        base = self.rate or (self.parent.rate if self.parent else None) or THROTTLED_RPS
+        return base * self.scale
+
+    def report_usage(self, usage_pct: float) -> None:
+        """ full rate up to 75% of the quota used, then down to 5% of it at 99%."""
+        with self.lock:
+            self.scale = 1.0 if usage_pct < 75 else max(0.05, (100 - usage_pct) / 25)
+
+    def slow_down(self) -> None:
+        with self.lock:
+            self.scale = max(0.05, self.scale / 2)
+
+    def recover(self) -> None:
+        with self.lock:
+            self.scale = min(1.0, self.scale * 1.25)
+
+    def pause(self, seconds: float) -> None:
+        """ blocks every caller of the limiter for the given seconds, e.g. until the api regains access."""
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def try_acquire(self) -> float:
+        """ takes a call without blocking, returns 0 if it was allowed or the seconds to wait before trying again."""
+        with self.lock:
+            now = time.monotonic()
+            rate = self.current_rate()
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            if not rate:
+                return 0.0
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / rate
+
+    def acquire(self) -> float:
+        """ blocks until a call is allowed by the limiter and returns the seconds it waited."""
+        waited = self.parent.acquire() if self.parent else 0.0
+        while wait := self.try_acquire():
+            time.sleep(wait)
+            waited += wait
+        return waited
+
+    async def aacquire(self) -> float:
+        """ like `acquire`, but waits without blocking the event loop."""
+        waited = await self.parent.aacquire() if self.parent else 0.0
+        while wait := self.try_acquire():
+            await asyncio.sleep(wait)
+            waited += wait
+        return waited
+
+
+def _env_rate(name: str) -> Optional[float]:
+    value = os.getenv(name)
+    return float(value) if value else None
+
+
+# process wide limiters for the external apis, configured with GEMINI_RPS / META_RPS
+limiters = {
+    "gemini": RateLimiter(_env_rate("GEMINI_RPS")),
+    "meta": RateLimiter(_env_rate("META_RPS")),
+}
+
+# adaptive limiters per ad account / model, under the process wide limiter of their api
+keyed_limiters = {}
+keyed_lock = threading.Lock()
+
+
+def get_limiter(api: str, key: Optional[str] = None) -> RateLimiter:
+    """ the limiter of an ad account (meta) or a model (gemini), the process wide one without a key."""
+
+    if key is None:
+        return limiters[api]
+    with keyed_lock:
+        if (api, key) not in keyed_limiters:
+            keyed_limiters[(api, key)] = RateLimiter(parent=limiters[api])
+        return keyed_limiters[(api, key)]
+
+
+def meta_limiter(account_id: Optional[str] = None) -> RateLimiter:
+    """ the limiter of the ad account, the current account by default."""
+    return get_limiter("meta", account_id or current_account_id())
+
+
+# meta error codes of throttling (https://developers.facebook.com/docs/graph-api/overview/rate-limiting)
+# and of temporary server errors
+META_THROTTLE_CODES = {4, 17, 32, 613} | set(range(80000, 80015))
+META_TRANSIENT_CODES = {1, 2, 341}
+
+
+def meta_error_kind(error: Exception) -> Optional[str]:
+    """ "throttle", "transient" or None for errors that retrying won't fix."""
+
+    if hasattr(error, "api_error_code"):
+        code = error.api_error_code()
+        if code in META_THROTTLE_CODES:
+            return "throttle"
+        if code in META_TRANSIENT_CODES or error.api_transient_error() or (error.http_status() or 0) >= 500:
+            return "transient"
+        return None
+    # connection errors and timeouts of requests
+    if type(error).__name__ in ("ConnectionError", "Timeout", "ReadTimeout", "ConnectTimeout"):
+        return "transient"
+    return None
+
+
+# connection errors of requests that never reached the server: the request was not sent at all. ConnectError is
+# the httpx error of the http/2 transport (see meta_session.py)
+UNSENT_ERRORS = re.compile(r"NewConnectionError|Connection refused|NameResolutionError|Failed to resolve|ConnectError:")
+
+
+def meta_create_error_kind(error: Exception) -> Optional[str]:
+    """ `meta_error_kind` for calls that create an object. Only the errors of a request that provably did not
+    run are retried: throttling, and connections that could not be opened. After a timeout or a server error
+    the object may have been created, resending it could make a second campaign, ad set or ad."""
+
+    if hasattr(error, "api_error_code"):
+        return "throttle" if error.api_error_code() in META_THROTTLE_CODES else None
+    name = type(error).__name__
+    if name == "ConnectTimeout" or (name == "ConnectionError" and UNSENT_ERRORS.search(str(error))):
+        return "transient"
+    return None
+
+
+def gemini_error_kind(error: Exception) -> Optional[str]:
+    """ "throttle" for 429s, "transient" for 5xx and timeouts, None otherwise."""
+
+    name, message = type(error).__name__, str(error)
+    if name in ("ResourceExhausted", "TooManyRequests") or "429" in message:
+        return "throttle"
+    if name in ("ServiceUnavailable", "InternalServerError", "DeadlineExceeded", "Timeout") or \
+            re.search(r"\b50[023]\b", message):
+        return "transient"
+    return None
+
+
+def backoff_delay(attempt: int) -> float:
+    """ exponential backoff with full jitter, so throttled workers don't retry in lockstep."""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def call_with_retries(fn, limiter: RateLimiter, error_kind, max_retries: int = MAX_RETRIES):
+    """ calls `fn` once the limiter allows it. Throttling errors slow the limiter down and pause it for every
+    caller, transient errors are retried after a backoff, other errors are raised right away."""
+
+    for attempt in range(max_retries + 1):
+        count(throttled_ms=limiter.acquire() * 1000)
+        try:
+            result = fn()
+        except Exception as e:
+            if (delay := _retry_delay(e, limiter, error_kind, attempt, max_retries)) is None:
+                raise
+            time.sleep(delay)
+            continue
+        limiter.recover()
+        return result
+
+
+async def acall_with_retries(afn, limiter: RateLimiter, error_kind, max_retries: int = MAX_RETRIES):
+    """ async version of `call_with_retries` for coroutine functions, waits without blocking the event loop."""
+
+    for attempt in range(max_retries + 1):
+        count(throttled_ms=await limiter.aacquire() * 1000)
+        try:
+            result = await afn()
+        except Exception as e:
+            if (delay := _retry_delay(e, limiter, error_kind, attempt, max_retries)) is None:
+                raise
+            await asyncio.sleep(delay)
+            continue
+        limiter.recover()
+        return result
+
+
+def _retry_delay(error: Exception, limiter: RateLimiter, error_kind, attempt: int, max_retries: int) -> Optional[float]:
+    """ seconds to sleep before retrying the failed call, None to raise the error. A throttled limiter is
+    slowed down and paused for every caller instead, so the caller itself doesn't sleep."""
+
+    kind = error_kind(error)
+    if kind is None or attempt == max_retries:
+        return None
+    count(retries=1)
+    delay = backoff_delay(attempt)
+    if kind == "throttle":
+        limiter.slow_down()
+        limiter.pause(delay)
+        return 0.0
+    return delay
+
+
+def call_meta(fn, account_id: Optional[str] = None):
+    """ calls the meta api through the limiter of the ad account, retrying throttling and transient errors."""
+    return call_with_retries(fn, meta_limiter(account_id), meta_error_kind)
+
+
+def call_meta_create(fn, lookup=None, account_id: Optional[str] = None):
+    """ calls a meta api create through the limiter of the ad account. Throttled and unsent requests are
+    retried like by `call_meta`. After an error that leaves it unknown whether the object was created (a
+    timeout, a server error), `lookup(started)` searches the object created since `started` (a timestamp)
+    and returns it, or None. The create is only sent again when nothing was found, and not at all without
+    a lookup."""
+
+    limiter, started = meta_limiter(account_id), time.time()
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            return call_with_retries(fn, limiter, meta_create_error_kind)
+        except Exception as e:
+            if lookup is None or meta_error_kind(e) is None or attempt == MAX_RETRIES:
+                raise
+        count(retries=1)
+        time.sleep(backoff_delay(attempt))
+        if (found := call_meta(lambda: lookup(started), account_id)) is not None:
+            return found
+
+
+# usage headers of the graph api responses, see the rate limiting docs linked above
+ACCOUNT_IN_PATH = re.compile(r"/(act_\d+)")
+
+
+def _header_json(headers, name: str):
+    try:
+        return json.loads(headers.get(name) or "null")
+    except ValueError:
+        return None
+
+
+def record_meta_usage(response, *args, **kwargs):
+    """ requests response hook that adapts the meta limiters to the usage reported by graph api:
+    x-app-usage for the whole app, x-ad-account-usage and x-business-use-case-usage for the ad account."""
+
+    headers = response.headers
+    if app_usage := _header_json(headers, "x-app-usage"):
+        limiters["meta"].report_usage(max(app_usage.values(), default=0))
+
+    match = ACCOUNT_IN_PATH.search(response.url or "")
+    limiter = meta_limiter(match.group(1) if match else None)
+    usage_pct, regain_seconds = None, 0
+    if account_usage := _header_json(headers, "x-ad-account-usage"):
+        usage_pct = float(account_usage.get("acc_id_util_pct", 0))
+        if usage_pct >= 100:
+            regain_seconds = float(account_usage.get("reset_time_duration", 0))
+    for entries in (_header_json(headers, "x-business-use-case-usage") or {}).values():
+        for entry in entries:
+            pct = max(entry.get("call_count", 0), entry.get("total_cputime", 0), entry.get("total_time", 0))
+            usage_pct = max(usage_pct or 0, pct)
+            regain_seconds = max(regain_seconds, 60 * entry.get("estimated_time_to_regain_access", 0))
+    if usage_pct is not None:
+        limiter.report_usage(usage_pct)
+    if regain_seconds:
+        limiter.pause(regain_seconds)
+    return response
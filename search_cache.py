@@ -0,0 +1,109 @@
+from concurrent.futures import Future
+from langchain_core.tools import BaseTool
+from pydantic import PrivateAttr
+from cache import SqliteCache
+from tracing import annotate
+from dotenv import load_dotenv
+import threading
+import hashlib
+import json
+import re
+import os
+
+load_dotenv()
+
+# Results of the web search tool keyed on the normalized query, campaigns for the same brand or vertical
+# repeat the same searches. Results older than SEARCH_CACHE_TTL seconds are fetched again.
+search_cache = SqliteCache(
+    "search_results",
+    ttl=float(os.getenv("SEARCH_CACHE_TTL", 6 * 3600)),
+    max_entries=int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", 5000)),
+)
+
+PUNCTUATION = re.compile(r"[^\w\s]")
+
+
+def normalize_query(query: str) -> str:
+    """ lower case, punctuation dropped and whitespace collapsed: "Best running shoes?" == "best  running shoes"."""
+    return " ".join(PUNCTUATION.sub(" ", query.lower()).split())
+
+
+def search_key(tool_name: str, args: dict) -> str:
+    args = {key: value for key, value in args.items() if value is not None}
+    if isinstance(args.get("query"), str):
+        args["query"] = normalize_query(args["query"])
+    payload = json.dumps({"tool": tool_name, "args": args}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+# drop in wrapper around the search tool with the same name and schema
+class CachedSearchTool(BaseTool):
+    """Serves repeated searches from the search cache. Concurrent calls with the same key wait for the one
+    search in flight instead of sending their own. Errors are not cached, neither raised ones nor the
+    {"error": ...} results the search tool returns for api failures."""
+
+    tool: BaseTool
+    cache: SqliteCache = search_cache
+
+    # searches in flight by key, and the calls served from the cache, sent and that waited for a search in flight
+    _inflight: dict = PrivateAttr(default_factory=dict)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _counts: dict = PrivateAttr(default_factory=lambda: {"hits": 0, "searches": 0, "deduplicated": 0})
+
+    def __init__(self, tool: BaseTool, **kwargs) -> None:
+        super().__init__(tool=tool, name=tool.name, description=tool.description, args_schema=tool.args_schema,
+                         handle_tool_error=tool.handle_tool_error,
+                         handle_validation_error=tool.handle_validation_error, **kwargs)
+
+    def _run(self, *args, run_manager=None, **kwargs):
+        key = search_key(self.name, kwargs)
+        if (cached := self.cache.get(key)) is not None:
+            self._record("hits", cache_hit=True)
+            return cached
+
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+        if not owner:
+            self._record("deduplicated", cache_hit=True, deduplicated=True)
+            return future.result()
+
+        try:
+            # a search that finished between the lookup and the lock needs no second request
+            if (result := self.cache.get(key)) is None:
+                self._record("searches", cache_hit=False)
+                result = self.tool.invoke(kwargs)
+                if isinstance(result, dict) and "error" in result:
+                    # the error can be the exception itself, which isn't json
+                    result = {**result, "error": str(result["error"])}
+                else:
+                    self.cache.set(key, result)
+            else:
+                self._record("hits", cache_hit=True)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    def _record(self, outcome: str, **attributes) -> None:
+        with self._lock:
+            self._counts[outcome] += 1
+        annotate(**attributes)
+
+    def stats(self) -> dict:
+        """ hit rate of the calls, counting the calls that shared a search in flight as hits."""
+
+        with self._lock:
+            counts = dict(self._counts)
+        calls = sum(counts.values())
+        return {
+            **counts,
+            "hit_rate": (counts["hits"] + counts["deduplicated"]) / calls if calls else 0.0,
+            "entries": self.cache.stats()["entries"],
+        }
@@ -0,0 +1,194 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException
+from pydantic import BaseModel, Field
+from graph import build_graph, build_pipeline
+from batch import arun_row, CAMPAIGN_FIELDS
+from validation import validate_campaign, record
+from checkpoints import async_checkpointer
+from tracing import span, summarize
+from cache import CACHE_DIR
+from dotenv import load_dotenv
+from typing import Optional
+import threading
+import asyncio
+import sqlite3
+import time
+import json
+import uuid
+import os
+
+load_dotenv()
+
+# Headless service mode: campaign jobs are posted over http, queued in SQLite and run concurrently on one
+# event loop with the async graphs, clients poll the job for its status and result.
+#
+#   uvicorn service:app --port 8000
+#   curl -X POST localhost:8000/jobs -H 'Content-Type: application/json' -d '{"campaign": {...}}'
+#   curl localhost:8000/jobs/<job_id>
+
+JOBS_DB = os.getenv("JOBS_DB", os.path.join(CACHE_DIR, "jobs.sqlite"))
+
+# jobs running at the same time, and the threads the blocking sdk calls of the tools run on
+SERVICE_CONCURRENCY = int(os.getenv("SERVICE_CONCURRENCY", 16))
+SERVICE_THREADS = int(os.getenv("SERVICE_THREADS", 32))
+
+# seconds an idle worker waits before looking for queued jobs again, submitting a job wakes it up earlier
+POLL_INTERVAL = 1.0
+
+# durable job queue in a SQLite table
+class JobQueue:
+    """Jobs are `queued`, `running`, `ok` or `error`. Workers claim the oldest queued job atomically, so jobs
+    can also be submitted from other processes sharing the database. Jobs left running by a stopped service
+    are queued again by `requeue_running` and resume from their checkpoints."""
+
+    def __init__(self, path: str = JOBS_DB) -> None:
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock, self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, status TEXT, fast_path INTEGER, row TEXT, "
+                "result TEXT, error TEXT, trace_id TEXT, created REAL, started REAL, finished REAL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+
+    def submit(self, row: dict, fast_path: bool = True) -> str:
+        job_id = uuid.uuid4().hex
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO jobs (id, status, fast_path, row, created) VALUES (?, 'queued', ?, ?, ?)",
+                (job_id, int(fast_path), json.dumps(row), time.time()),
+            )
+        return job_id
+
+    def claim(self) -> Optional[dict]:
+        """ marks the oldest queued job as running and returns it, None if the queue is empty."""
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                "UPDATE jobs SET status = 'running', started = ? WHERE id = "
+                "(SELECT id FROM jobs WHERE status = 'queued' ORDER BY created LIMIT 1) RETURNING *",
+                (time.time(),),
+            ).fetchone()
+        return self.load(row) if row else None
+
+    def finish(self, job_id: str, result: Optional[dict] = None, error: Optional[str] = None,
+               trace_id: Optional[str] = None) -> None:
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, trace_id = ?, finished = ? WHERE id = ?",
+                ("error" if error else "ok", json.dumps(result), error, trace_id, time.time(), job_id),
+            )
+
+    def requeue_running(self) -> int:
+        with self.lock, self.conn:
+            return self.conn.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running'").rowcount
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self.load(row) if row else None
+
+    def counts(self) -> dict:
+        with self.lock:
+            return dict(self.conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    @staticmethod
+    def load(row: sqlite3.Row) -> dict:
+        job = dict(row)
+        job["fast_path"] = bool(job["fast_path"])
+        job["row"] = json.loads(job["row"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+
+# body of POST /jobs
+class JobRequest(BaseModel):
+    campaign: dict = Field(description="The campaign as a batch row: the arguments of the campaign prompt, "
+                                       "and optionally image_style_prompt and account_id")
+    fast_path: bool = Field(default=True, description="Use the fast-path pipeline instead of the agentic graph")
+
+
+async def run_job(job: dict, graph, pipeline) -> None:
+    row = {**job["row"], "row_id": job["id"]}
+    with span("job", job_id=job["id"]) as current:
+        try:
+            result = await arun_row(row, graph, pipeline, job["fast_path"])
+        except Exception as e:
+            queue.finish(job["id"], error=f"{type(e).__name__}: {e}", trace_id=current.trace_id)
+            return
+    queue.finish(job["id"], result=result, trace_id=current.trace_id)
+
+
+async def worker(wakeup: asyncio.Event, graph, pipeline) -> None:
+    """ runs queued jobs one after another, SERVICE_CONCURRENCY workers share the event loop."""
+
+    while True:
+        if (job := queue.claim()) is None:
+            try:
+                await asyncio.wait_for(wakeup.wait(), POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            wakeup.clear()
+            continue
+        await run_job(job, graph, pipeline)
+
+
+queue = JobQueue()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # the pipeline steps calling the meta sdk run on the default executor of the loop
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=SERVICE_THREADS, thread_name_prefix="service"))
+    async with async_checkpointer() as checkpointer:
+        graph = build_graph(checkpointer=checkpointer)
+        pipeline = build_pipeline(graph=graph, checkpointer=checkpointer)
+        queue.requeue_running()
+        app.state.wakeup = asyncio.Event()
+        workers = [asyncio.create_task(worker(app.state.wakeup, graph, pipeline)) for _ in range(SERVICE_CONCURRENCY)]
+        yield
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+
+app = FastAPI(title="Meta Ad Campaign Agent", lifespan=lifespan)
+
+
+@app.post("/jobs", status_code=202)
+async def submit_job(request: JobRequest) -> dict:
+    unknown = set(request.campaign) - set(CAMPAIGN_FIELDS) - {"image_style_prompt", "account_id"}
+    if unknown:
+        raise HTTPException(status_code=422, detail=f"unknown campaign fields: {', '.join(sorted(unknown))}")
+    # the required fields and their values, the image is generated from `image_style_prompt` without a path
+    fields = [*CAMPAIGN_FIELDS, "image_style_prompt"]
+    if errors := validate_campaign({field: request.campaign.get(field, "") for field in fields}):
+        record(rejected_campaigns=1)
+        raise HTTPException(status_code=422, detail=errors)
+
+    job_id = queue.submit(request.campaign, request.fast_path)
+    app.state.wakeup.set()
+    return {"job_id": job_id, "status": "queued"}
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str) -> dict:
+    if (job := queue.get(job_id)) is None:
+        raise HTTPException(status_code=404, detail="job not found")
+    return job
+
+
+@app.get("/jobs/{job_id}/timings")
+async def get_job_timings(job_id: str) -> list:
+    """ the span summary of a finished job, while its trace is still among the recent ones in memory."""
+    if (job := queue.get(job_id)) is None or not job["trace_id"]:
+        raise HTTPException(status_code=404, detail="no trace for the job")
+    return summarize(job["trace_id"])
+
+
+@app.get("/health")
+async def health() -> dict:
+    return {"jobs": queue.counts(), "workers": SERVICE_CONCURRENCY}
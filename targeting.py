@@ -0,0 +1,298 @@
+from cache import CACHE_DIR
+from tracing import span, annotate
+from dotenv import load_dotenv
+from typing import Optional
+import threading
+import difflib
+import sqlite3
+import bisect
+import time
+import json
+import re
+import os
+
+load_dotenv()
+
+# Local index of Meta targeting ids. The interests and countries of the form are resolved offline against the
+# results of earlier targeting searches: exact name, then prefix, then fuzzy match. Terms that match nothing are
+# searched in bulk (one graph api batch request) by a background thread, so a campaign never waits for a
+# targeting search and the next campaign with the same terms is resolved locally.
+
+TARGETING_DB = os.getenv("TARGETING_DB", os.path.join(CACHE_DIR, "targeting.sqlite"))
+
+# seconds the search results (also empty ones) are kept before a term is searched again
+TARGETING_TTL = float(os.getenv("TARGETING_TTL", 30 * 24 * 3600))
+
+# country of the ad sets whose campaign doesn't give one
+DEFAULT_COUNTRY = os.getenv("TARGETING_DEFAULT_COUNTRY", "US")
+
+# min similarity (0..1) of a fuzzy match, and the results kept per search
+FUZZY_CUTOFF = 0.85
+SEARCH_LIMIT = 5
+
+# meta graph api targeting search per kind of the index
+SEARCHES = {
+    "interest": {"type": "adinterest"},
+    "country": {"type": "adgeolocation", "location_types": json.dumps(["country"])},
+}
+
+GENDERS = {"male": [1], "female": [2]}
+
+# country names and codes people use that are not the ISO code meta expects
+COUNTRY_ALIASES = {
+    "uk": "GB", "great britain": "GB", "britain": "GB", "england": "GB", "scotland": "GB", "wales": "GB",
+    "northern ireland": "GB", "usa": "US", "america": "US", "united states of america": "US", "el": "GR",
+    "uae": "AE", "emirates": "AE", "south korea": "KR", "korea": "KR", "holland": "NL", "czechia": "CZ",
+    "russia": "RU", "vietnam": "VN",
+}
+
+# marks a term that was never fuzzy matched, None is a memoized miss
+NOT_MATCHED = object()
+
+# age range meta accepts for ad sets
+MIN_AGE, MAX_AGE = 18, 65
+
+NON_WORD = re.compile(r"[^\w]+")
+
+
+def normalize(term: str) -> str:
+    return " ".join(NON_WORD.sub(" ", term.lower()).split())
+
+
+def split_terms(text) -> list:
+    """ the terms of a comma separated form field (or list), without blanks and duplicates."""
+    terms = text if isinstance(text, list) else str(text or "").split(",")
+    return list(dict.fromkeys(term.strip() for term in terms if term and term.strip()))
+
+
+# index of the targeting search results, in memory for the lookups and in sqlite across runs
+class TargetingIndex:
+    """Maps normalized names (and the search terms that led to them) to targeting ids per kind. Lookups are a
+    dict hit or a binary search over the sorted names, fuzzy matches are memoized. Lookups don't take the lock:
+    a refresh replaces the sorted names and the memo instead of changing them. Terms that are not found are
+    queued for the next bulk search. Searched terms without results are remembered, so they are not searched
+    again until TARGETING_TTL."""
+
+    def __init__(self, path: str = TARGETING_DB, ttl: float = TARGETING_TTL) -> None:
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {kind: {} for kind in SEARCHES}
+        self.keys = {kind: [] for kind in SEARCHES}
+        self.fuzzy = {}
+        # terms to search by (kind, normalized term)
+        self.pending = {}
+        self.refresh_requested = threading.Event()
+        self.refresher = None
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS targeting "
+                "(kind TEXT, key TEXT, id TEXT, name TEXT, audience INTEGER, updated REAL, PRIMARY KEY (kind, key))"
+            )
+            rows = self.conn.execute(
+                "SELECT kind, key, id, name, audience FROM targeting WHERE updated > ?", (time.time() - ttl,)
+            ).fetchall()
+        for kind, key, target_id, name, audience in rows:
+            if kind in self.entries:
+                self.entries[kind][key] = (target_id, name, audience)
+        self._sort_keys()
+
+    def _sort_keys(self) -> None:
+        # only names with an id take part in the prefix and fuzzy matches
+        for kind, entries in self.entries.items():
+            self.keys[kind] = sorted(key for key, entry in entries.items() if entry[0])
+        # replaced rather than cleared, lookups keep reading the memo they started with
+        self.fuzzy = {}
+
+    def lookup(self, kind: str, term: str) -> Optional[dict]:
+        """ the {"id", "name"} of the term, None if it is unknown (it is then queued for a search)
+        or has no results."""
+
+        key = normalize(term)
+        if not key:
+            return None
+        entries = self.entries[kind]
+        if key in entries:
+            entry = entries[key]
+        elif (match := self._prefix_match(kind, key)) or (match := self._fuzzy_match(kind, key)):
+            entry = entries[match]
+        else:
+            with self.lock:
+                self.pending.setdefault((kind, key), (kind, term))
+            self.refresh_requested.set()
+            self._start_refresher()
+            return None
+        return {"id": entry[0], "name": entry[1]} if entry[0] else None
+
+    def _prefix_match(self, kind: str, key: str) -> Optional[str]:
+        # "yoga" matches "yoga fitness", the name with the largest audience wins among the first few
+        keys, entries = self.keys[kind], self.entries[kind]
+        start = bisect.bisect_left(keys, key)
+        candidates = [candidate for candidate in keys[start:start + SEARCH_LIMIT] if candidate.startswith(key + " ")]
+        return max(candidates, key=lambda candidate: entries[candidate][2] or 0, default=None)
+
+    def _fuzzy_match(self, kind: str, key: str) -> Optional[str]:
+        # "photografy" matches "photography", memoized since difflib compares against every name
+        fuzzy, keys = self.fuzzy, self.keys[kind]
+        if (match := fuzzy.get((kind, key), NOT_MATCHED)) is NOT_MATCHED:
+            matches = difflib.get_close_matches(key, keys, n=1, cutoff=FUZZY_CUTOFF)
+            match = fuzzy[(kind, key)] = matches[0] if matches else None
+        return match
+
+    def add_results(self, kind: str, term: str, results: list) -> None:
+        """ stores the results of a search: every result under its name and the best one under the term."""
+
+        now = time.time()
+        rows = [(kind, normalize(result["name"]), result["id"], result["name"], result.get("audience"), now)
+                for result in results]
+        best = max(results, key=lambda result: result.get("audience") or 0, default=None)
+        best = best or {"id": None, "name": None}
+        rows.append((kind, normalize(term), best["id"], best["name"], best.get("audience"), now))
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO targeting VALUES (?, ?, ?, ?, ?, ?)", rows)
+            for _, key, target_id, name, audience, _ in rows:
+                self.entries[kind][key] = (target_id, name, audience)
+            self._sort_keys()
+
+    def take_pending(self) -> list:
+        with self.lock:
+            pending, self.pending = list(self.pending.values()), {}
+        return pending
+
+    def refresh(self, terms: Optional[list] = None) -> int:
+        """ searches the (kind, term) pairs, the queued misses by default, in graph api batch requests.
+        Returns the number of terms searched."""
+        from meta_batch import MetaBatch
+
+        terms = self.take_pending() if terms is None else terms
+        if not terms:
+            return 0
+        with span("targeting_refresh", terms=len(terms)):
+            batch = MetaBatch()
+            names = {}
+            for kind, term in terms:
+                names[batch.add("GET", "search", {**SEARCHES[kind], "q": term, "limit": SEARCH_LIMIT})] = (kind, term)
+            for name, response in batch.execute().items():
+                if isinstance(response, Exception):
+                    continue
+                kind, term = names[name]
+                self.add_results(kind, term, [parse_result(kind, result) for result in response.get("data", [])])
+        return len(terms)
+
+    def _start_refresher(self) -> None:
+        with self.lock:
+            if self.refresher is None:
+                self.refresher = threading.Thread(target=self._refresh_loop, daemon=True, name="targeting")
+                self.refresher.start()
+
+    def _refresh_loop(self) -> None:
+        while True:
+            self.refresh_requested.wait()
+            # misses of campaigns starting at about the same time go into one batch request
+            time.sleep(1.0)
+            self.refresh_requested.clear()
+            try:
+                self.refresh()
+            except Exception:
+                # the terms stay unresolved and are queued again by their next lookup
+                pass
+
+
+def parse_result(kind: str, result: dict) -> dict:
+    if kind == "country":
+        return {"id": result["key"], "name": result["name"]}
+    return {"id": str(result["id"]), "name": result["name"], "audience": result.get("audience_size_upper_bound")}
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index() -> TargetingIndex:
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = TargetingIndex()
+        return _index
+
+
+def resolve_country(term: str) -> Optional[str]:
+    """ the ISO code of a country given by code or name."""
+    term = term.strip()
+    if alias := COUNTRY_ALIASES.get(normalize(term)):
+        return alias
+    if re.fullmatch(r"[A-Za-z]{2}", term):
+        return term.upper()
+    result = get_index().lookup("country", term)
+    return result["id"] if result else None
+
+
+def resolve_interests(text) -> tuple:
+    """ the {"id", "name"} of the comma separated interests that could be resolved, and the ones that couldn't."""
+    resolved, unresolved = [], []
+    for term in split_terms(text):
+        if result := get_index().lookup("interest", term):
+            resolved.append(result)
+        else:
+            unresolved.append(term)
+    return list({result["id"]: result for result in resolved}.values()), unresolved
+
+
+def targeting_spec(inputs: dict) -> dict:
+    """ the ad set targeting of the audience fields of a campaign: countries, age range, gender and interests.
+    Unresolved terms are left out (and searched in the background), so the audience is broader, not empty."""
+
+    countries = [code for code in map(resolve_country, split_terms(inputs.get("country"))) if code]
+    spec = {"geo_locations": {"countries": countries or [DEFAULT_COUNTRY]}}
+
+    age_min, age_max = int(inputs.get("age_min") or 0), int(inputs.get("age_max") or 0)
+    if age_min:
+        spec["age_min"] = min(max(age_min, MIN_AGE), MAX_AGE)
+    if age_max:
+        spec["age_max"] = min(max(age_max, spec.get("age_min", MIN_AGE)), MAX_AGE)
+    if genders := GENDERS.get(str(inputs.get("gender", "")).lower()):
+        spec["genders"] = genders
+
+    interests, unresolved = resolve_interests(inputs.get("interests"))
+    if interests:
+        spec["flexible_spec"] = [{"interests": interests}]
+    if unresolved:
+        annotate(unresolved_interests=unresolved)
+    return spec
+
+
+def prefetch(rows: list) -> int:
+    """ searches the interests and countries of all the rows that are not in the index yet, in one go before
+    a batch starts. Returns the number of terms searched."""
+
+    index = get_index()
+    for row in rows:
+        targeting_spec(row)
+    return index.refresh()
+
+
+def resolve_audience(inputs: dict) -> list:
+    """ searches the terms of one campaign that are not in the index yet and waits for the search, for callers
+    that can spend one batch request on it (the app). Returns the interests that still can't be resolved."""
+    try:
+        prefetch([inputs])
+    except Exception:
+        # the terms are queued again by the lookups below and searched in the background
+        pass
+    return resolve_interests(inputs.get("interests"))[1]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Search Meta targeting ids into the local index.")
+    parser.add_argument("--interests", default="", help="comma separated interests")
+    parser.add_argument("--countries", default="", help="comma separated country names")
+    args = parser.parse_args()
+
+    terms = [("interest", term) for term in split_terms(args.interests)]
+    terms += [("country", term) for term in split_terms(args.countries)]
+    print(f"searched {get_index().refresh(terms)} terms")
+    print(json.dumps(targeting_spec({"interests": args.interests, "country": args.countries}), indent=2))
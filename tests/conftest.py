@@ -0,0 +1,19 @@
+import tempfile
+import sys
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# the offline fakes of the benchmarks
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+# isolated caches and dummy credentials, set before the project modules read them
+os.environ.update({
+    "CACHE_DIR": tempfile.mkdtemp(prefix="tests-"),
+    "META_ACCESS_TOKEN": "test",
+    "META_AD_ACCOUNT_ID": "act_1000",
+    "TRACE_FILE": "",
+    # retries back off for milliseconds instead of seconds
+    "RETRY_BASE_DELAY": "0.001",
+    "THROTTLED_RPS": "1000",
+})
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+from budget import fill, allocate, PACING_MIN_DELIVERY
+
+
+def adsets(n: int, seed: int = 7) -> dict:
+    rng = np.random.default_rng(seed)
+    budget = rng.choice([1000, 2000, 5000, 10000], size=n).astype("float64")
+    spend = budget * 7 * rng.uniform(0.3, 1.0, size=n)
+    conversions = rng.poisson(spend / 100 * 0.03).astype("float64")
+    return {"budget": budget, "spend": spend, "conversions": conversions, "revenue": conversions * 3000}
+
+
+def test_fill_reaches_the_total_within_the_bounds():
+    weights = np.array([1.0, 2.0, 3.0, 0.0])
+    lower, upper = np.array([10.0, 10.0, 10.0, 10.0]), np.array([100.0, 100.0, 50.0, 100.0])
+    filled = fill(weights, lower, upper, total=150.0)
+    assert filled.sum() == pytest.approx(150.0)
+    assert (filled >= lower - 1e-9).all() and (filled <= upper + 1e-9).all()
+    assert filled[1] > filled[0]
+
+
+def test_fill_clips_the_total_to_the_bounds():
+    lower, upper = np.array([10.0, 20.0]), np.array([30.0, 40.0])
+    assert fill(np.ones(2), lower, upper, total=1000.0).sum() == pytest.approx(70.0)
+    assert fill(np.ones(2), lower, upper, total=0.0).sum() == pytest.approx(30.0)
+
+
+def test_fill_spreads_evenly_without_weights():
+    filled = fill(np.zeros(3), np.zeros(3), np.full(3, 100.0), total=90.0)
+    assert filled == pytest.approx([30.0, 30.0, 30.0])
+
+
+@pytest.mark.parametrize("method", ["thompson", "roas"])
+def test_allocate_keeps_the_total_and_the_change_bounds(method):
+    data = adsets(500)
+    new_budget = allocate(**data, days=7, method=method, max_change=0.2, min_budget=100,
+                          rng=np.random.default_rng(1))
+    # floored to whole minor units, at most one unit lost per ad set
+    assert data["budget"].sum() - len(new_budget) <= new_budget.sum() <= data["budget"].sum()
+    assert (new_budget >= np.floor(data["budget"] * 0.8)).all()
+    assert (new_budget <= data["budget"] * 1.2).all()
+
+
+def test_allocate_gives_no_increase_to_ad_sets_not_pacing():
+    data = adsets(200)
+    data["spend"][:50] = data["budget"][:50] * 7 * PACING_MIN_DELIVERY * 0.5
+    data["conversions"][:50] = data["spend"][:50]
+    new_budget = allocate(**data, days=7, method="roas")
+    assert (new_budget[:50] <= data["budget"][:50]).all()
+
+
+def test_allocate_moves_budget_to_the_better_ad_sets():
+    budget = np.full(2, 1000.0)
+    spend = budget * 7
+    new_budget = allocate(budget, spend, np.array([5.0, 50.0]), np.array([500.0, 5000.0]) * 100, days=7,
+                          method="roas")
+    assert new_budget[1] > budget[1] and new_budget[0] < budget[0]
+    assert new_budget.sum() == pytest.approx(budget.sum(), abs=2)
+
+
+def test_allocate_respects_a_new_total():
+    data = adsets(100)
+    total = data["budget"].sum() * 1.1
+    new_budget = allocate(**data, days=7, total=total, method="roas")
+    assert new_budget.sum() <= total
+    assert (new_budget <= data["budget"] * 1.2).all()
@@ -0,0 +1,72 @@
+from requests.exceptions import ConnectionError, ReadTimeout
+import pytest
+from fakes import FakeGraphAPIAdapter, RATE_LIMIT_ERROR, TRANSIENT_ERROR
+from meta_session import KeepAliveAdapter
+from clients import get_api
+from meta_batch import MetaBatch
+from rate_limiter import meta_limiter
+
+
+class FailingAdapter(FakeGraphAPIAdapter):
+    """Fails the first `failures` http requests as a whole: with a meta error response, or by raising
+    `error` when it is an exception."""
+
+    def __init__(self, error, failures: int = 1) -> None:
+        super().__init__(error_rate=0.0 if isinstance(error, Exception) else 1.0, error=error)
+        self.failures = failures
+
+    def send(self, request, **kwargs):
+        with self.lock:
+            failing, self.failures = self.failures > 0, self.failures - 1
+        if not failing:
+            self.error_rate = 0.0
+        elif isinstance(self.error, Exception):
+            with self.lock:
+                self.requests += 1
+            raise self.error
+        return super().send(request, **kwargs)
+
+
+@pytest.fixture
+def meta():
+    yield lambda error: FailingAdapter(error).install(get_api())
+    get_api()._session.requests.mount("https://", KeepAliveAdapter())
+
+
+def campaign_batch() -> MetaBatch:
+    batch = MetaBatch(get_api())
+    batch.add("POST", "act_1000/campaigns", {"name": "Campaign"}, name="campaign")
+    batch.add("POST", "act_1000/adsets", {"campaign_id": MetaBatch.ref("campaign")}, name="adset")
+    batch.add("GET", "12345", {"fields": "name"}, name="page")
+    return batch
+
+
+def test_throttled_batch_request_is_resent(meta):
+    adapter = meta(RATE_LIMIT_ERROR)
+    results = campaign_batch().execute()
+    # the throttled request ran nothing, every call is sent again, the creates too
+    assert all("id" in result for result in results.values())
+    assert adapter.requests == 2
+    assert meta_limiter().scale < 1
+
+
+def test_failed_batch_request_resends_only_the_reads(meta):
+    adapter = meta(TRANSIENT_ERROR)
+    results = campaign_batch().execute()
+    # the creates may have run, they fail instead of making a second campaign
+    assert isinstance(results["campaign"], Exception) and isinstance(results["adset"], Exception)
+    assert "id" in results["page"]
+    assert adapter.requests == 2
+
+
+@pytest.mark.parametrize("error, resent", [
+    (ConnectionError("NewConnectionError: Connection refused"), True),
+    (ReadTimeout("read timed out"), False),
+])
+def test_batch_request_without_a_response(meta, error, resent):
+    meta(error)
+    results = campaign_batch().execute()
+    # a connection that could not be opened sent nothing, after a timeout the creates may have run
+    assert isinstance(results["campaign"], dict) is resent
+    assert isinstance(results["adset"], dict) is resent
+    assert "id" in results["page"]
@@ -0,0 +1,128 @@
+from datetime import date
+import pytest
+from validation import numeric_id, non_empty, whole_amount, hex_hash, url, age_range, validate_campaign, \
+    validate_tool_call, rejection
+from tools import GenerateAdSet, GenerateCampaign, campaign_goal, make_ad_set
+
+VALID = {
+    "brand_name": "Acme", "product_name": "Rocket", "campaign_goal": "Traffic", "daily_budget": "1000",
+    "page_id": "12345", "landing_page": "https://acme.example/rocket", "call_to_action": "Learn More",
+    "start_date": date(2026, 1, 1), "end_date": date(2026, 1, 31), "age_min": 18, "age_max": 65,
+    "image_style_prompt": "Minimalist",
+}
+
+
+@pytest.mark.parametrize("value, expected", [(" 123 ", "123"), (42, "42")])
+def test_numeric_id(value, expected):
+    assert numeric_id(value) == expected
+
+
+@pytest.mark.parametrize("value", ["act_123", "12a", "", "-1"])
+def test_numeric_id_rejects(value):
+    with pytest.raises(ValueError):
+        numeric_id(value)
+
+
+def test_non_empty():
+    assert non_empty("  name ") == "name"
+    with pytest.raises(ValueError):
+        non_empty("   ")
+
+
+@pytest.mark.parametrize("value, expected", [("1000", "1000"), (250, "250"), ("12.0", "12"), (" 7 ", "7")])
+def test_whole_amount(value, expected):
+    assert whole_amount(value) == expected
+
+
+@pytest.mark.parametrize("value", ["0", "-5", "10.5", "ten", "", "inf", "-inf", "nan", float("inf"), "1e400"])
+def test_whole_amount_rejects(value):
+    with pytest.raises(ValueError):
+        whole_amount(value)
+
+
+def test_hex_hash():
+    assert hex_hash("0123456789abcdef0123456789ABCDEF") == "0123456789abcdef0123456789ABCDEF"
+    for value in ("0123", "g" * 32, "0123456789abcdef0123456789abcdef0"):
+        with pytest.raises(ValueError):
+            hex_hash(value)
+
+
+def test_url():
+    assert url(" https://acme.example/a?b=1 ") == "https://acme.example/a?b=1"
+    for value in ("acme.example", "ftp://acme.example", "https://", "https://a b"):
+        with pytest.raises(ValueError):
+            url(value)
+
+
+def test_age_range():
+    age_range(18, 65)
+    age_range(0, 30)
+    age_range(None, None)
+    for ages in ((40, 20), (float("inf"), 20), ("x", 20)):
+        with pytest.raises(ValueError):
+            age_range(*ages)
+
+
+def test_campaign_goal_by_name_or_objective():
+    assert campaign_goal("traffic") == "Traffic"
+    assert campaign_goal("LINK_CLICKS") == "Traffic"
+    with pytest.raises(ValueError):
+        campaign_goal("sales")
+
+
+def test_validate_campaign_accepts_valid_inputs():
+    assert validate_campaign(VALID) == []
+    assert validate_campaign({**VALID, "start_date": "2026-01-01", "end_date": "2026-01-01", "age_max": 0}) == []
+
+
+@pytest.mark.parametrize("change, field", [
+    ({"brand_name": " "}, "brand_name"),
+    ({"page_id": "act_1"}, "page_id"),
+    ({"campaign_goal": "Sales"}, "campaign_goal"),
+    ({"daily_budget": "inf"}, "daily_budget"),
+    ({"daily_budget": "12.5"}, "daily_budget"),
+    ({"landing_page": "acme"}, "landing_page"),
+    ({"call_to_action": "Buy"}, "call_to_action"),
+    ({"end_date": date(2025, 12, 31)}, "end_date"),
+    ({"start_date": "tomorrow"}, "dates"),
+    ({"age_min": 50, "age_max": 20}, "age_min"),
+    ({"image_path": "/does/not/exist.png"}, "image_path"),
+    ({"image_style_prompt": " "}, "image_style_prompt"),
+])
+def test_validate_campaign_reports_every_problem(change, field):
+    errors = validate_campaign({**VALID, **change})
+    assert len(errors) == 1 and field in errors[0]
+
+
+def test_validate_campaign_accepts_an_upload_without_a_style():
+    assert validate_campaign({**VALID, "image_style_prompt": ""}, upload=True) == []
+
+
+def test_validate_tool_call_normalizes_the_arguments():
+    call = {"name": make_ad_set.name, "id": "1", "args": {
+        "campaign_id": " 123", "page_id": 456, "ad_set_name": "Set", "daily_budget": "1000.0",
+        "targeting": '{"geo_locations": {"countries": ["US"]}}'}}
+    checked, details = validate_tool_call(make_ad_set, call)
+    assert details is None
+    assert checked["args"]["campaign_id"] == "123" and checked["args"]["page_id"] == "456"
+    assert checked["args"]["daily_budget"] == "1000"
+
+
+def test_validate_tool_call_rejects_with_details():
+    call = {"name": make_ad_set.name, "id": "1", "args": {
+        "campaign_id": "abc", "page_id": "456", "ad_set_name": "", "daily_budget": "inf"}}
+    checked, details = validate_tool_call(make_ad_set, call)
+    assert checked is None
+    assert {detail["field"] for detail in details} == {"campaign_id", "ad_set_name", "daily_budget"}
+    assert rejection(call, details)["error"] == "invalid_arguments"
+
+
+@pytest.mark.parametrize("targeting", ['{"age_min": 20}', "not json",
+                                       '{"geo_locations": {"countries": ["US"]}, "age_min": 40, "age_max": 30}'])
+def test_ad_set_targeting_is_checked(targeting):
+    with pytest.raises(ValueError):
+        GenerateAdSet(campaign_id="1", page_id="2", ad_set_name="Set", daily_budget="100", targeting=targeting)
+
+
+def test_campaign_schema_normalizes_the_goal():
+    assert GenerateCampaign(campaign_name="C", campaign_goal="link_clicks").campaign_goal == "Traffic"
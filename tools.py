@@ -1,22 +1,22 @@
 from langchain_core.tools import tool
-from facebook_business.api import FacebookAdsApi
-from facebook_business.adobjects.adaccount import AdAccount
-from langchain_tavily import TavilySearch
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator
+from rate_limiter import call_meta, call_meta_create
+from cache import image_cache
+from meta_batch import MetaBatch
+from images import wait_for_image, prepare_image, image_available
+from clients import get_ad_account
+from tracing import annotate
+from checkpoints import idempotent, idempotency_key, tool_results
+from targeting import DEFAULT_COUNTRY
+from validation import numeric_id, non_empty, whole_amount, hex_hash, age_range
 from dotenv import load_dotenv
 from datetime import datetime
-import getpass, os
+from typing import Optional, Literal
+import json
+import os
 
 load_dotenv()
 
-# initialize facebook client
-FacebookAdsApi.init(
-    access_token=os.getenv("META_ACCESS_TOKEN"),
-    app_id=os.getenv("META_APP_ID"),
-    app_secret=os.getenv("META_APP_SECRET")
-)
-account = AdAccount(os.getenv("META_AD_ACCOUNT_ID"))
-
 # user input to valid api call arguments mapping dict 
 CAMPAIGN_OBJECTIVE_MAP = {
     "Awareness": "REACH",
@@ -34,19 +34,55 @@ CTA_MAP = {
     }
 
 
+def campaign_goal(value) -> str:
+    """ the key of CAMPAIGN_OBJECTIVE_MAP for a goal given by name (in any case) or by its meta objective."""
+    value = str(value).strip()
+    for goal, objective in CAMPAIGN_OBJECTIVE_MAP.items():
+        if value.lower() in (goal.lower(), objective.lower()):
+            return goal
+    raise ValueError(f"unknown campaign goal {value!r}, use one of: {', '.join(CAMPAIGN_OBJECTIVE_MAP)}")
+
+
 # Pydantic schemas for tool call arguments strcuture 
+# the validators reject (or normalize) the arguments Meta would reject, before any api call is made
 
 class GenerateCampaign(BaseModel):
     """Generates a Meta Ad Campaign"""
     campaign_name: str = Field(description="Name of the Campaign")
-    campaign_goal: str = Field(description="Objective of the Campaign")
+    campaign_goal: str = Field(description=f"Objective of the Campaign, one of: {', '.join(CAMPAIGN_OBJECTIVE_MAP)}")
+
+    _name = field_validator("campaign_name", mode="before")(non_empty)
+
+    @field_validator("campaign_goal", mode="before")
+    @classmethod
+    def known_goal(cls, value):
+        return campaign_goal(value)
 
 class GenerateAdSet(BaseModel):
     """Generates a Meta Ad Set under an Ad Campaign"""
     campaign_id: str = Field(description="A campaign id used to generate an ad set under the campaign")
     page_id: str = Field(description="The id of the page for which the campaign runs the ad")
     ad_set_name: str = Field(description="Name of the Ad set under the campaign")
-    daily_budget: str = Field(description="Daily budget for the adset")
+    daily_budget: str = Field(description="Daily budget for the adset, a whole number")
+    targeting: Optional[str] = Field(default=None, description="The targeting spec JSON of the ad set exactly as given in the campaign details")
+
+    _ids = field_validator("campaign_id", "page_id", mode="before")(numeric_id)
+    _name = field_validator("ad_set_name", mode="before")(non_empty)
+    _budget = field_validator("daily_budget", mode="before")(whole_amount)
+
+    @field_validator("targeting", mode="before")
+    @classmethod
+    def targeting_spec(cls, value):
+        if value is None or value == "":
+            return None
+        try:
+            spec = json.loads(value) if isinstance(value, str) else value
+        except ValueError:
+            raise ValueError("is not valid JSON, pass the targeting spec exactly as given") from None
+        if not isinstance(spec, dict) or not spec.get("geo_locations"):
+            raise ValueError("must be a JSON object with geo_locations")
+        age_range(spec.get("age_min"), spec.get("age_max"))
+        return json.dumps(spec)
 
 class GenerateAdCreative(BaseModel):
     """Generates a Meta Ad Creative under an Ad Set"""
@@ -54,52 +90,72 @@ class GenerateAdCreative(BaseModel):
     image_hash: str = Field(description="A hexadecimal string representing an uploaded image")
     creative_name: str = Field(description="A name for the ad creative that comes under the ad set")
     page_id: str = Field(description="The id of the page for which the campaign runs the ad")
+    headline: str = Field(default="My Page Like Ad", description="A catchy headline for the ad")
+
+    _texts = field_validator("description", "creative_name", "headline", mode="before")(non_empty)
+    _hash = field_validator("image_hash", mode="before")(hex_hash)
+    _page = field_validator("page_id", mode="before")(numeric_id)
     
 class GenerateImageHash(BaseModel):
     """Uploads an image from given file path and creates an image hash"""
     image_path: str = Field(description="A path to the image used in ad creative")
 
+    @field_validator("image_path", mode="before")
+    @classmethod
+    def existing_image(cls, value):
+        value = non_empty(value)
+        if not image_available(value):
+            raise ValueError(f"no image at {value!r}, use the image_path given in the campaign details")
+        return value
+
 class GenerateAd(BaseModel):
     """Generates a Meta Ad under an Ad set using the Ad creative."""
     ad_set_id: str = Field(description="Id of the Ad set under which the ad will run.")
     ad_name: str = Field(description="A name for the ad")
     creative_id: str = Field(description="Id of the Ad Creative that has the creative elements for the Ad.")
 
+    _ids = field_validator("ad_set_id", "creative_id", mode="before")(numeric_id)
+    _name = field_validator("ad_name", mode="before")(non_empty)
 
-# Tools for Campaign Creation and a search tool for enhancing agent knowledge
+class GetAdInsights(BaseModel):
+    """Reports the spend, impressions, clicks, CTR, conversions and ROAS of the existing ads of the ad account"""
+    level: Literal["account", "campaign", "adset", "ad", "date"] = Field(default="campaign", description="Level to report: account, campaign, adset, ad or date")
+    days: int = Field(default=7, ge=1, le=365, description="Number of most recent days to report")
+    campaign_id: Optional[str] = Field(default=None, description="Only report the ad sets / ads of this campaign")
 
-if not os.environ.get("TAVILY_API_KEY"):
-    os.environ["TAVILY_API_KEY"] = getpass.getpass("Tavily API key:\n")
+class AllocateBudgets(BaseModel):
+    """Reallocates the daily budgets of the active ad sets of the ad account based on their recent performance"""
+    campaign_id: Optional[str] = Field(default=None, description="Only reallocate between the ad sets of this campaign")
+    days: int = Field(default=7, ge=1, le=90, description="Number of most recent days of performance to base the allocation on")
+    method: Literal["thompson", "roas"] = Field(default="thompson", description="thompson (keeps testing ad sets with little data) or roas (proportional to the return on ad spend)")
+    total_daily_budget: Optional[str] = Field(default=None, description="Total daily budget to distribute, in the unit of the ad set daily budget. Defaults to the current total")
+    plan_id: Optional[str] = Field(default=None, description="Id of a plan returned by an earlier call, only when the user confirmed it: sends exactly the budgets of that plan. Without it the changes are only proposed")
 
-search_tool = TavilySearch(max_results = 2)
+    _total = field_validator("total_daily_budget", mode="before")(lambda value: None if value in (None, "") else whole_amount(value))
 
 
-@tool("campaignGeneratorTool", args_schema=GenerateCampaign)
-def make_campaign(campaign_goal, campaign_name):    
-    fields = [
-    ]
-    params = {
+
+# Tools for Campaign Creation, the search tool for enhancing agent knowledge is built lazily by clients.get_search_tool
+
+
+# api call parameters of each tool, shared by the tools and the batched tool execution
+
+def campaign_params(campaign_goal, campaign_name):
+    return {
          'objective': CAMPAIGN_OBJECTIVE_MAP.get(campaign_goal),
          'status': 'PAUSED',
          'buying_type': 'AUCTION',
          'name': campaign_name,
-     }  
-    campaign = account.create_campaign(
-        fields=fields,
-        params=params,
-    )
-    campaign_id = campaign['id']
+     }
 
-    return {"campaign_id": campaign_id}
-    
 
-@tool("adsetGeneratorTool", args_schema=GenerateAdSet)
-def make_ad_set(campaign_id, page_id, ad_set_name, daily_budget):
-    fields = [
-    ]
-    params = {
+def ad_set_params(campaign_id, page_id, ad_set_name, daily_budget, targeting=None):
+    # the tools get the targeting spec as json, it is resolved from the audience fields by targeting.targeting_spec
+    if isinstance(targeting, str):
+        targeting = json.loads(targeting)
+    return {
         'status': 'PAUSED',
-        'targeting': {'geo_locations': {'countries': ['US']}},
+        'targeting': targeting or {'geo_locations': {'countries': [DEFAULT_COUNTRY]}},
         'daily_budget': daily_budget,
         'billing_event': 'IMPRESSIONS',
         'bid_amount': '20',
@@ -108,30 +164,91 @@ def make_ad_set(campaign_id, page_id, ad_set_name, daily_budget):
         'promoted_object': {'page_id': page_id},
         'name': ad_set_name,
     }
-    ad_set = account.create_ad_set(
+
+
+def ad_creative_params(description, creative_name, page_id, image_hash, headline="My Page Like Ad"):
+    return {
+        'body': description,
+        'image_hash': image_hash,
+        'name': creative_name,
+        'object_id': page_id,
+        'title': headline,
+    }
+
+
+def ad_params(ad_set_id, creative_id, ad_name):
+    return {
+        'status': 'PAUSED',
+        'adset_id': ad_set_id,
+        'name': ad_name,
+        'creative': {'creative_id': creative_id},
+        'ad_format': 'DESKTOP_FEED_STANDARD',
+    }
+
+
+def find_created(edge: str, name: str, since: float):
+    """ the object of the account named `name` and created since `since` (a timestamp), or None. `edge` is the
+    getter of the account edge, e.g. "get_campaigns". Used after a create failed without telling whether the
+    object was made."""
+
+    objects = getattr(get_ad_account(), edge)(fields=["id", "name", "created_time"], params={
+        "filtering": [{"field": "name", "operator": "EQUAL", "value": name}],
+        "limit": 10,
+    })
+    for found in objects:
+        created = datetime.strptime(found["created_time"], "%Y-%m-%dT%H:%M:%S%z").timestamp()
+        # a minute of slack for the clock of this machine
+        if found["name"] == name and created >= since - 60:
+            return found
+    return None
+
+
+# every api call goes through call_meta, which waits for the rate limiter of the ad account
+# and retries throttling and transient errors. Creates only retry errors of requests that did not run, and
+# after a timeout or a server error look for the object before creating it again. Within a run the object
+# creations are idempotent, the image upload is already deduplicated by the content of the image.
+
+@tool("campaignGeneratorTool", args_schema=GenerateCampaign)
+@idempotent("campaignGeneratorTool")
+def make_campaign(campaign_goal, campaign_name):    
+    fields = [
+    ]
+    params = campaign_params(campaign_goal, campaign_name)
+    campaign = call_meta_create(lambda: get_ad_account().create_campaign(
         fields=fields,
         params=params,
-    )
+    ), lookup=lambda since: find_created("get_campaigns", campaign_name, since))
+    campaign_id = campaign['id']
+
+    return {"campaign_id": campaign_id}
+    
+
+@tool("adsetGeneratorTool", args_schema=GenerateAdSet)
+@idempotent("adsetGeneratorTool")
+def make_ad_set(campaign_id, page_id, ad_set_name, daily_budget, targeting=None):
+    fields = [
+    ]
+    params = ad_set_params(campaign_id, page_id, ad_set_name, daily_budget, targeting)
+    ad_set = call_meta_create(lambda: get_ad_account().create_ad_set(
+        fields=fields,
+        params=params,
+    ), lookup=lambda since: find_created("get_ad_sets", ad_set_name, since))
     ad_set_id = ad_set.get_id()
 
     return {"ad_set_id": ad_set_id}
 
 
 @tool("adCreativeGeneratorTool", args_schema=GenerateAdCreative)
-def make_ad_creative(description, creative_name, page_id, image_hash):
+@idempotent("adCreativeGeneratorTool")
+def make_ad_creative(description, creative_name, page_id, image_hash, headline="My Page Like Ad"):
     fields = [
     ]
-    params = {
-        'body': description,
-        'image_hash': image_hash,
-        'name': creative_name,
-        'object_id': page_id,
-        'title': 'My Page Like Ad',
-    }
-    creative = account.create_ad_creative(
+    params = ad_creative_params(description, creative_name, page_id, image_hash, headline)
+    # creatives spend nothing, a failed create is not looked up and fails the call
+    creative = call_meta_create(lambda: get_ad_account().create_ad_creative(
         fields=fields,
         params=params,
-    )
+    ))
     creative_id = creative.get_id()
 
     return {"creative_id": creative_id}
@@ -139,29 +256,121 @@ def make_ad_creative(description, creative_name, page_id, image_hash):
 
 @tool("imageGeneratorTool", args_schema=GenerateImageHash)
 def make_ad_image(image_path):
-    image = account.create_ad_image(params={
-        'filename': image_path
-    })
+    # the image may still be generated in the background
+    wait_for_image(image_path)
+
+    # reuse the hash of an identical image already uploaded to this account
+    cache_key = image_cache.key(image_path, get_ad_account().get_id())
+    if (image_hash := image_cache.lookup(cache_key, image_path)) is not None:
+        annotate(cache_hit=True)
+        return {"image_hash": image_hash}
+
+    # resized and recompressed copy of the image, the cache stays keyed by the original file
+    upload_path = prepare_image(image_path)
+    annotate(cache_hit=False, image_bytes=os.path.getsize(upload_path))
+    image = call_meta(lambda: get_ad_account().create_ad_image(params={
+        'filename': upload_path
+    }))
     image_hash = image['hash']
+    image_cache.set(cache_key, image_hash)
 
     return {"image_hash": image_hash}
 
 
 @tool("adGeneratorTool", args_schema=GenerateAd)
+@idempotent("adGeneratorTool")
 def make_ad(ad_set_id, creative_id, ad_name):
     fields = [
     ]
-    params = {
-        'status': 'PAUSED',
-        'adset_id': ad_set_id,
-        'name': ad_name,
-        'creative': {'creative_id': creative_id},
-        'ad_format': 'DESKTOP_FEED_STANDARD',
-    }
-    ad = account.create_ad(
+    params = ad_params(ad_set_id, creative_id, ad_name)
+    ad = call_meta_create(lambda: get_ad_account().create_ad(
         fields=fields,
         params=params,
-    )
+    ), lookup=lambda since: find_created("get_ads", ad_name, since))
     ad_id = ad.get_id()
 
-    return {"ad_id": ad_id}
\ No newline at end of file
+    return {"ad_id": ad_id}
+
+
+# rows of an insights report returned to the agent, by spend
+INSIGHTS_TOP = 20
+
+
+@tool("adInsightsTool", args_schema=GetAdInsights)
+def get_ad_insights(level="campaign", days=7, campaign_id=None):
+    # answered from the local store synced by insights.py, without an api call,
+    # pandas is only imported once the agent asks for insights
+    from insights import performance
+
+    frame = performance(by=level, days=days, account_ids=[get_ad_account().get_id()], campaign_id=campaign_id,
+                        top=INSIGHTS_TOP)
+    return {"insights": json.loads(frame.to_json(orient="records", date_format="iso", double_precision=4))}
+
+
+@tool("budgetAllocatorTool", args_schema=AllocateBudgets)
+def allocate_budgets(campaign_id=None, days=7, method="thompson", total_daily_budget=None, plan_id=None):
+    # a dry run that returns the id of the plan, only a previewed plan is applied, and exactly as previewed
+    from budget import plan_budgets, apply_budgets, changed, save_plan, load_plan
+
+    if plan_id:
+        account_id, plan = load_plan(plan_id)
+        if account_id != get_ad_account().get_id():
+            raise ValueError(f"budget plan {plan_id} belongs to {account_id}")
+        return {"plan_id": plan_id, **apply_budgets(plan, account_id)}
+
+    account_id = get_ad_account().get_id()
+    total = float(total_daily_budget) if total_daily_budget else None
+    plan = plan_budgets(account_id, days, campaign_id, total, method)
+    moves = changed(plan).sort_values("change", key=lambda change: change.abs(), ascending=False)
+    return {
+        "plan_id": save_plan(plan, account_id),
+        "ad_sets": len(plan),
+        "total_before": int(plan["daily_budget"].sum()),
+        "total_after": int(plan["new_budget"].sum()),
+        "changes": json.loads(moves.head(INSIGHTS_TOP)[["adset_id", "adset_name", "daily_budget", "new_budget", "roas"]]
+                              .to_json(orient="records", double_precision=4)),
+    }
+
+
+# tools whose api call can be sent in a graph api batch: tool name -> (account edge, params builder, result key)
+BATCHABLE_TOOLS = {
+    make_campaign.name: ("campaigns", campaign_params, "campaign_id"),
+    make_ad_set.name: ("adsets", ad_set_params, "ad_set_id"),
+    make_ad_creative.name: ("adcreatives", ad_creative_params, "creative_id"),
+    make_ad.name: ("ads", ad_params, "ad_id"),
+}
+
+
+def run_batched_tool_calls(tool_calls: list) -> dict:
+    """ sends the api calls of several tool calls in graph api batch requests.
+    Returns the tool result (or the exception) of each tool call by tool call id."""
+
+    batch = MetaBatch()
+    names, keys, results = {}, {}, {}
+    for tool_call in tool_calls:
+        edge, build_params, _ = BATCHABLE_TOOLS[tool_call["name"]]
+        try:
+            params = build_params(**tool_call["args"])
+            keys[tool_call["id"]] = idempotency_key(tool_call["name"], build_params, **tool_call["args"])
+        except (TypeError, ValueError) as e:
+            results[tool_call["id"]] = e
+            continue
+        # the object was already created by this run
+        if keys[tool_call["id"]] and (result := tool_results.get(keys[tool_call["id"]])) is not None:
+            results[tool_call["id"]] = result
+            continue
+        names[tool_call["id"]] = batch.add("POST", f"{get_ad_account().get_id()}/{edge}", params)
+    responses = batch.execute() if len(batch) else {}
+
+    for tool_call in tool_calls:
+        if tool_call["id"] not in names:
+            continue
+        response = responses[names[tool_call["id"]]]
+        result_key = BATCHABLE_TOOLS[tool_call["name"]][2]
+        if isinstance(response, Exception):
+            results[tool_call["id"]] = response
+            continue
+        results[tool_call["id"]] = {result_key: response["id"]}
+        if keys[tool_call["id"]]:
+            tool_results.set(keys[tool_call["id"]], results[tool_call["id"]])
+    return results
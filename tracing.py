@@ -0,0 +1,146 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from cache import CACHE_DIR
+from dotenv import load_dotenv
+from typing import Optional
+import threading
+import time
+import json
+import uuid
+import os
+
+load_dotenv()
+
+# finished spans are appended to TRACE_FILE as json lines, set TRACE_FILE= (empty) to only keep them in memory
+TRACE_FILE = os.getenv("TRACE_FILE", os.path.join(CACHE_DIR, "traces.jsonl"))
+
+# number of recent traces kept in memory for the summaries
+MAX_TRACES = 50
+
+current_span = ContextVar("current_span", default=None)
+
+
+# timed unit of work of a trace, e.g. a node, an llm call or a tool invocation
+class Span:
+    """A named, timed unit of work. Spans started inside another span (also in threads that copied the
+    context) become its children and share its trace id. Numeric attributes can be accumulated with `add`."""
+
+    def __init__(self, name: str, parent: Optional["Span"] = None, **attributes) -> None:
+        self.name = name
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = dict(attributes)
+        self.status = "ok"
+        self.start_time = time.time()
+        self.start = time.perf_counter()
+        self.duration = None
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def add(self, **counters) -> None:
+        for key, value in counters.items():
+            self.attributes[key] = self.attributes.get(key, 0) + value
+
+    def end(self) -> None:
+        self.duration = time.perf_counter() - self.start
+
+    def to_dict(self) -> dict:
+        """ the span with the field names of the OpenTelemetry (OTLP json) span."""
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id,
+            "name": self.name,
+            "startTimeUnixNano": int(self.start_time * 1e9),
+            "endTimeUnixNano": int((self.start_time + (self.duration or 0)) * 1e9),
+            "attributes": self.attributes,
+            "status": self.status,
+        }
+
+
+# writes finished spans to a json lines file and keeps the recent traces in memory
+class SpanExporter:
+
+    def __init__(self, path: Optional[str] = TRACE_FILE, max_traces: int = MAX_TRACES) -> None:
+        self.path = path
+        self.max_traces = max_traces
+        self.traces = OrderedDict()
+        self.lock = threading.Lock()
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def export(self, span: Span) -> None:
+        record = span.to_dict()
+        with self.lock:
+            self.traces.setdefault(span.trace_id, []).append(record)
+            self.traces.move_to_end(span.trace_id)
+            while len(self.traces) > self.max_traces:
+                self.traces.popitem(last=False)
+            if self.path:
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(record, default=str) + "\n")
+
+    def get_trace(self, trace_id: str) -> list:
+        with self.lock:
+            return list(self.traces.get(trace_id, []))
+
+
+exporter = SpanExporter()
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """ times the block as a child of the current span. An exception marks the span as failed and is re-raised."""
+
+    current = Span(name, current_span.get(), **attributes)
+    token = current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.status = "error"
+        current.set(error=f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        current_span.reset(token)
+        current.end()
+        exporter.export(current)
+
+
+def annotate(**attributes) -> None:
+    """ sets attributes on the current span, if there is one."""
+    if (current := current_span.get()) is not None:
+        current.set(**attributes)
+
+
+def count(**counters) -> None:
+    """ accumulates counters (tokens, retries, bytes) on the current span, if there is one."""
+    if (current := current_span.get()) is not None:
+        current.add(**counters)
+
+
+# counters added up per span name in the summaries
+SUMMED = ("input_tokens", "output_tokens", "tokens_before", "tokens_after", "args_bytes", "result_bytes",
+          "image_bytes", "retries", "throttled_ms", "rejected_calls", "round_trips_avoided")
+
+
+def summarize(trace_id: str) -> list:
+    """ per span name: number of spans, total and max duration in ms, errors, cache hits and the summed counters,
+    slowest first."""
+
+    rows = {}
+    for record in exporter.get_trace(trace_id):
+        ms = (record["endTimeUnixNano"] - record["startTimeUnixNano"]) / 1e6
+        row = rows.setdefault(record["name"], {"span": record["name"], "count": 0, "total_ms": 0.0, "max_ms": 0.0,
+                                               "errors": 0, "cache_hits": 0})
+        row["count"] += 1
+        row["total_ms"] += ms
+        row["max_ms"] = max(row["max_ms"], ms)
+        row["errors"] += record["status"] == "error"
+        row["cache_hits"] += record["attributes"].get("cache_hit") is True
+        for key in SUMMED:
+            if isinstance(value := record["attributes"].get(key), (int, float)) and not isinstance(value, bool):
+                row[key] = row.get(key, 0) + value
+    return sorted(rows.values(), key=lambda row: row["total_ms"], reverse=True)
@@ -0,0 +1,163 @@
+from pydantic import BaseModel, ValidationError
+from tracing import count
+from datetime import date
+from typing import Optional
+import threading
+import math
+import re
+
+# Checks of the tool arguments and campaign inputs that can be made locally. A bad argument found here costs
+# nothing, found by Meta it costs an api round trip and another llm turn to fix it.
+
+NUMERIC_ID = re.compile(r"\d+")
+IMAGE_HASH = re.compile(r"[0-9a-fA-F]{32}")
+URL = re.compile(r"https?://[^\s/$.?#][^\s]*", re.IGNORECASE)
+
+
+def numeric_id(value) -> str:
+    value = str(value).strip()
+    if not NUMERIC_ID.fullmatch(value):
+        raise ValueError(f"{value!r} is not a Meta object id, ids are digits only")
+    return value
+
+
+def non_empty(value) -> str:
+    value = str(value).strip()
+    if not value:
+        raise ValueError("must not be empty")
+    return value
+
+
+def whole_amount(value) -> str:
+    """ a budget given as a positive whole number (of the minor unit of the currency), as a string."""
+    try:
+        amount = float(str(value).strip())
+    except ValueError:
+        raise ValueError(f"{value!r} is not a number") from None
+    # inf has no int, nan compares false to everything
+    if not math.isfinite(amount) or not amount > 0 or amount != int(amount):
+        raise ValueError(f"{value!r} must be a positive whole number")
+    return str(int(amount))
+
+
+def hex_hash(value) -> str:
+    value = str(value).strip()
+    if not IMAGE_HASH.fullmatch(value):
+        raise ValueError(f"{value!r} is not an image hash, use the image_hash returned by the image upload")
+    return value
+
+
+def url(value) -> str:
+    value = str(value).strip()
+    if not URL.fullmatch(value):
+        raise ValueError(f"{value!r} is not an http(s) url")
+    return value
+
+
+def age_range(age_min, age_max) -> None:
+    try:
+        if age_min and age_max and int(age_min) > int(age_max):
+            raise ValueError(f"age_min {age_min} is above age_max {age_max}")
+    except (TypeError, OverflowError):
+        raise ValueError(f"ages {age_min!r} and {age_max!r} must be whole numbers") from None
+
+
+# campaign fields without which no campaign can be made
+REQUIRED_CAMPAIGN_FIELDS = ("brand_name", "product_name", "campaign_goal", "daily_budget", "page_id")
+
+
+def as_date(value) -> Optional[date]:
+    if isinstance(value, date) or not value:
+        return value or None
+    return date.fromisoformat(str(value).strip())
+
+
+def validate_campaign(inputs: dict, upload: bool = False) -> list:
+    """ the problems of the campaign inputs of the form, a batch row or a job, checked before the run starts
+    so a campaign that can't be made costs neither llm calls nor api requests. Empty when the inputs are valid.
+    `upload` is set for an uploaded image that the form only writes to the image path once the run starts."""
+
+    # the goals and calls to action are the ones the tools map to meta values
+    from tools import campaign_goal, CTA_MAP
+    from images import image_available
+
+    errors = [f"{field} is required" for field in REQUIRED_CAMPAIGN_FIELDS if not str(inputs.get(field) or "").strip()]
+    checks = [
+        ("page_id", numeric_id),
+        ("campaign_goal", campaign_goal),
+        ("daily_budget", whole_amount),
+        ("landing_page", url),
+    ]
+    for field, check in checks:
+        if str(inputs.get(field) or "").strip():
+            try:
+                check(inputs[field])
+            except ValueError as e:
+                errors.append(f"{field}: {e}")
+    if (cta := inputs.get("call_to_action")) and cta not in CTA_MAP:
+        errors.append(f"call_to_action: unknown {cta!r}, use one of: {', '.join(CTA_MAP)}")
+    try:
+        start, end = as_date(inputs.get("start_date")), as_date(inputs.get("end_date"))
+        if start and end and end < start:
+            errors.append(f"end_date {end} is before start_date {start}")
+    except ValueError as e:
+        errors.append(f"dates: {e}")
+    try:
+        age_range(inputs.get("age_min"), inputs.get("age_max"))
+    except ValueError as e:
+        errors.append(str(e))
+    if (image_path := inputs.get("image_path")) and not image_available(image_path):
+        errors.append(f"image_path: {image_path!r} does not exist")
+    # without an image the run would create the campaign and ad set before failing on the image upload
+    if not (upload or image_path or str(inputs.get("image_style_prompt") or "").strip()):
+        errors.append("upload an image (image_path) or describe the image style to generate it from "
+                      "(image_style_prompt)")
+    return errors
+
+
+# rejected tool calls and campaigns, for the whole process
+validation_stats = {"tool_calls": 0, "rejected_calls": 0, "round_trips_avoided": 0, "rejected_campaigns": 0}
+stats_lock = threading.Lock()
+
+
+def record(**counters) -> None:
+    """ adds to the process wide counters and to the current span."""
+    with stats_lock:
+        for key, value in counters.items():
+            validation_stats[key] += value
+    count(**{key: value for key, value in counters.items() if key != "tool_calls"})
+
+
+def error_details(error: ValidationError) -> list:
+    """ field, message and input of every error of a ValidationError."""
+    return [
+        {"field": ".".join(str(part) for part in detail["loc"]) or None,
+         "message": detail["msg"].removeprefix("Value error, "),
+         "input": detail["input"] if isinstance(detail["input"], (str, int, float, bool, type(None))) else None}
+        for detail in error.errors()
+    ]
+
+
+def validate_tool_call(tool, tool_call: dict) -> tuple:
+    """ validates the arguments of a tool call with the args schema of the tool before it is run.
+    Returns the tool call with the normalized arguments and None, or None and the error details."""
+
+    schema = getattr(tool, "args_schema", None)
+    if not (isinstance(schema, type) and issubclass(schema, BaseModel)):
+        return tool_call, None
+    try:
+        arguments = schema.model_validate(tool_call["args"]).model_dump()
+    except ValidationError as e:
+        return None, error_details(e)
+    # only the arguments of the call, defaults are left to the tool
+    return {**tool_call, "args": {key: arguments[key] for key in tool_call["args"] if key in arguments}}, None
+
+
+def rejection(tool_call: dict, details: list) -> dict:
+    """ the content of the error ToolMessage of a rejected tool call."""
+    return {"error": "invalid_arguments", "tool": tool_call["name"], "details": details,
+            "hint": "nothing was sent, call the tool again with corrected arguments"}
+
+
+def format_errors(errors: list) -> str:
+    return "\n".join(f"- {error}" for error in errors)
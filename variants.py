@@ -0,0 +1,140 @@
+from concurrent.futures import ThreadPoolExecutor
+from graph_utilities import VariantPlan, invoke_tool
+from prompt import generate_variants_prompt
+from tools import make_ad_image, campaign_params, ad_set_params, ad_creative_params, ad_params
+from images import generate_ad_image
+from meta_batch import MetaBatch
+from rate_limiter import get_limiter
+from cache import file_digest
+from llm_cache import CachedLLM
+from tracing import span
+from targeting import targeting_spec
+from clients import MODEL, get_llm, get_ad_account
+from functools import lru_cache
+from dotenv import load_dotenv
+import contextvars
+import uuid
+import os
+
+load_dotenv()
+
+# caps on the size of a multi-variant launch
+MAX_VARIANTS = int(os.getenv("MAX_VARIANTS", 20))
+MAX_IN_FLIGHT = int(os.getenv("VARIANT_MAX_IN_FLIGHT", 4))
+
+# llm that answers with the campaign text and all the copy variants as structured output
+@lru_cache(maxsize=None)
+def get_variants_llm():
+    return CachedLLM(
+        get_llm().with_structured_output(VariantPlan),
+        model = MODEL,
+        settings = {"output": VariantPlan.__name__},
+        output_model = VariantPlan,
+        limiter = get_limiter("gemini", MODEL),
+    )
+
+
+def plan_variants(inputs: dict, n_copies: int) -> VariantPlan:
+    with span("plan_variants", copies=n_copies):
+        plan = get_variants_llm().invoke(generate_variants_prompt(n_copies, **inputs))
+    if len(plan.copies) < n_copies:
+        raise ValueError(f"planner returned {len(plan.copies)} copies instead of {n_copies}")
+    plan.copies = plan.copies[:n_copies]
+    return plan
+
+
+def launch_variants(inputs: dict, n_copies: int, n_images: int, image_style_prompt: str = "",
+                    max_in_flight: int = MAX_IN_FLIGHT) -> dict:
+    """ creates one campaign and ad set with an ad for every combination of `n_copies` ad copies
+    and `n_images` images. The copies come from a single llm call that runs concurrently with the image
+    generation, and all the creatives and ads are created in graph api batch requests."""
+
+    if n_copies * n_images > MAX_VARIANTS:
+        raise ValueError(f"{n_copies} copies x {n_images} images exceeds the limit of {MAX_VARIANTS} variants")
+    if image_style_prompt and inputs.get("image_path"):
+        raise ValueError("give either an image or an image style prompt to generate the images from, not both")
+    if not image_style_prompt and not inputs.get("image_path"):
+        raise ValueError("an image or an image style prompt is needed")
+    if not image_style_prompt and n_images > 1:
+        raise ValueError(f"{n_images} image variants need an image style prompt, an uploaded image is a single image")
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        plan_future = executor.submit(contextvars.copy_context().run, plan_variants, inputs, n_copies)
+
+        if image_style_prompt:
+            run_id = uuid.uuid4().hex[:8]
+            image_futures = [
+                executor.submit(contextvars.copy_context().run, generate_ad_image, image_style_prompt,
+                                os.path.join("./Images", f"variant_{run_id}_{i}.png"), i)
+                for i in range(n_images)
+            ]
+            image_paths = [future.result() for future in image_futures]
+        else:
+            image_paths = [inputs["image_path"]]
+
+        # identical images are only uploaded once
+        digests = {path: file_digest(path) for path in image_paths}
+        unique_paths = {digest: path for path, digest in digests.items()}
+        upload_futures = [
+            executor.submit(contextvars.copy_context().run, invoke_tool, make_ad_image, {"image_path": path})
+            for path in unique_paths.values()
+        ]
+        uploads = dict(zip(unique_paths, (future.result()["image_hash"] for future in upload_futures)))
+        image_hashes = {path: uploads[digest] for path, digest in digests.items()}
+
+        plan = plan_future.result()
+
+    batch = MetaBatch()
+    account_id = get_ad_account().get_id()
+    campaign = batch.add("POST", f"{account_id}/campaigns",
+                         campaign_params(inputs["campaign_goal"], plan.campaign_name), name="campaign")
+    ad_set = batch.add("POST", f"{account_id}/adsets",
+                       ad_set_params(batch.ref(campaign), inputs["page_id"], plan.ad_set_name,
+                                     str(inputs["daily_budget"]), targeting_spec(inputs)), name="ad_set")
+
+    variants = []
+    for copy_index, copy in enumerate(plan.copies):
+        for image_index, image_path in enumerate(image_paths):
+            suffix = f"{copy_index}_{image_index}"
+            creative = batch.add("POST", f"{account_id}/adcreatives", ad_creative_params(
+                copy.ad_description, f"{copy.creative_name} {suffix}", inputs["page_id"],
+                image_hashes[image_path], copy.ad_headline), name=f"creative_{suffix}")
+            ad = batch.add("POST", f"{account_id}/ads", ad_params(
+                batch.ref(ad_set), batch.ref(creative), f"{copy.ad_name} {suffix}"), name=f"ad_{suffix}")
+            variants.append({"copy": copy.model_dump(), "image_path": image_path, "creative": creative, "ad": ad})
+
+    responses = batch.execute()
+    for name in (campaign, ad_set):
+        if isinstance(responses[name], Exception):
+            raise responses[name]
+
+    for variant in variants:
+        creative, ad = responses[variant.pop("creative")], responses[variant.pop("ad")]
+        for key, response in (("creative_id", creative), ("ad_id", ad)):
+            if isinstance(response, Exception):
+                variant["error"] = str(response)
+            else:
+                variant[key] = response["id"]
+
+    return {
+        "campaign_id": responses[campaign]["id"],
+        "ad_set_id": responses[ad_set]["id"],
+        "variants": variants,
+    }
+
+
+def variants_summary(result: dict) -> str:
+    """ markdown summary of a multi-variant launch."""
+
+    lines = [
+        "Ads created in paused state.\n",
+        f"- Campaign ID: {result['campaign_id']}",
+        f"- Ad Set ID: {result['ad_set_id']}\n",
+        "| Headline | Image | Creative ID | Ad ID |",
+        "| --- | --- | --- | --- |",
+    ]
+    for variant in result["variants"]:
+        ad_id = variant.get("ad_id") or f"failed: {variant.get('error')}"
+        lines.append(f"| {variant['copy']['ad_headline']} | {os.path.basename(variant['image_path'])} "
+                     f"| {variant.get('creative_id', '-')} | {ad_id} |")
+    return "\n".join(lines)